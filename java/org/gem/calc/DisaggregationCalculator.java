@@ -112,6 +112,27 @@ public class DisaggregationCalculator {
             double vs30Value,
             double depthTo1pt0KMPS,
             double depthTo2pt5KMPS)
+    {
+        return computeMatrices(
+                lat, lon, erf, imrMap, new double[] {poe}, imls, vs30Type,
+                vs30Value, depthTo1pt0KMPS, depthTo2pt5KMPS)[0];
+    }
+
+    /**
+     * Simplified computeMatrices method for convenient calls from the Python
+     * code: the hazard curve of the site is computed once, for all the PoEs.
+     */
+    public DisaggregationResult[] computeMatrices(
+            double lat,
+            double lon,
+            GEM1ERF erf,
+            Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> imrMap,
+            double[] poes,
+            Double[] imls,
+            String vs30Type,
+            double vs30Value,
+            double depthTo1pt0KMPS,
+            double depthTo2pt5KMPS)
     {
         assertVs30TypeIsValid(vs30Type);
         Site site = new Site(new Location(lat, lon));
@@ -139,7 +160,7 @@ public class DisaggregationCalculator {
 
         double minMag = (Double) erf.getParameter(GEM1ERF.MIN_MAG_NAME).getValue();
 
-        return computeMatrix(site, erf, imrMap, poe, hazardCurve, minMag);
+        return computeMatrices(site, erf, imrMap, poes, hazardCurve, minMag);
     }
 
     public DisaggregationResult computeMatrix(
@@ -150,21 +171,50 @@ public class DisaggregationCalculator {
             DiscretizedFuncAPI hazardCurve,
             double minMag)
     {
+        return computeMatrices(
+                site, erf, imrMap, new double[] {poe}, hazardCurve, minMag)[0];
+    }
+
+    /**
+     * Compute the disaggregation matrices of a site for several PoEs, in a
+     * single pass over the ruptures of the ERF.
+     *
+     * The location and magnitude bins of each rupture do not depend on the
+     * PoE; only the epsilon and the rate of exceedance of the ground motion
+     * value of each PoE are computed for each matrix.
+     *
+     * @return a result for each PoE, in the same order
+     */
+    public DisaggregationResult[] computeMatrices(
+            Site site,
+            EqkRupForecastAPI erf,
+            Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> imrMap,
+            double[] poes,
+            DiscretizedFuncAPI hazardCurve,
+            double minMag)
+    {
 
         assertPoissonian(erf);
         assertNonZeroStdDev(imrMap);
 
-        double disaggMatrix[][][][][] =
-                new double[(int) dims[0]]
+        int numPoes = poes.length;
+
+        double disaggMatrices[][][][][][] =
+                new double[numPoes]
+                          [(int) dims[0]]
                           [(int) dims[1]]
                           [(int) dims[2]]
                           [(int) dims[3]]
                           [(int) dims[4]];
 
-        // value by which to normalize the final matrix
-        double totalAnnualRate = 0.0;
+        // values by which to normalize the final matrices
+        double[] totalAnnualRates = new double[numPoes];
 
-        double logGMV = getGMV(hazardCurve, poe);
+        double[] logGMVs = new double[numPoes];
+        for (int i = 0; i < numPoes; i++)
+        {
+            logGMVs[i] = getGMV(hazardCurve, poes[i]);
+        }
 
         for (int srcCnt = 0; srcCnt < erf.getNumSources(); srcCnt++)
         {
@@ -177,7 +227,6 @@ public class DisaggregationCalculator {
 
             ScalarIntensityMeasureRelationshipAPI imr = imrMap.get(trt);
             imr.setSite(site);
-            imr.setIntensityMeasureLevel(logGMV);
 
             for(int rupCnt = 0; rupCnt < source.getNumRuptures(); rupCnt++)
             {
@@ -186,36 +235,51 @@ public class DisaggregationCalculator {
 
                 Location location = closestLocation(rupture.getRuptureSurface().getLocationList(), site.getLocation());
 
-                double lat, lon, mag, epsilon;
+                double lat, lon, mag;
                 lat = location.getLatitude();
                 lon = location.getLongitude();
                 mag = rupture.getMag();
-                epsilon = imr.getEpsilon();
 
-                if (!allInRange(lat, lon, mag, epsilon))
+                if (!(inRange(this.latBinLims, lat)
+                        && inRange(this.lonBinLims, lon)
+                        && inRange(this.magBinLims, mag)))
                 {
                     // one or more of the parameters is out of range;
                     // skip this rupture
                     continue;
                 }
 
-                int[] binIndices = getBinIndices(lat, lon, mag, epsilon, trt);
+                for (int i = 0; i < numPoes; i++)
+                {
+                    imr.setIntensityMeasureLevel(logGMVs[i]);
+                    double epsilon = imr.getEpsilon();
+
+                    if (!inRange(this.epsilonBinLims, epsilon))
+                    {
+                        continue;
+                    }
 
-                double annualRate = totRate
-                        * imr.getExceedProbability()
-                        * rupture.getProbability();
+                    int[] binIndices = getBinIndices(lat, lon, mag, epsilon, trt);
 
-                disaggMatrix[binIndices[0]][binIndices[1]][binIndices[2]][binIndices[3]][binIndices[4]] += annualRate;
-                totalAnnualRate += annualRate;
+                    double annualRate = totRate
+                            * imr.getExceedProbability()
+                            * rupture.getProbability();
+
+                    disaggMatrices[i][binIndices[0]][binIndices[1]][binIndices[2]][binIndices[3]][binIndices[4]] += annualRate;
+                    totalAnnualRates[i] += annualRate;
+                }  // end PoE loop
             }  // end rupture loop
         }  // end source loop
 
-        disaggMatrix = normalize(disaggMatrix, totalAnnualRate);
-
-        DisaggregationResult daResult = new DisaggregationResult();
-        daResult.setGMV(Math.exp(logGMV));
-        daResult.setMatrix(disaggMatrix);
-        return daResult;
+        DisaggregationResult[] daResults = new DisaggregationResult[numPoes];
+        for (int i = 0; i < numPoes; i++)
+        {
+            DisaggregationResult daResult = new DisaggregationResult();
+            daResult.setGMV(Math.exp(logGMVs[i]));
+            daResult.setMatrix(normalize(disaggMatrices[i], totalAnnualRates[i]));
+            daResults[i] = daResult;
+        }
+        return daResults;
     }
 
     public boolean allInRange(
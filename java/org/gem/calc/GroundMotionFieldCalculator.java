@@ -24,6 +24,7 @@ import java.util.Random;
 
 import org.apache.commons.logging.Log;
 import org.apache.commons.logging.LogFactory;
+import org.apache.commons.math.linear.Array2DRowRealMatrix;
 import org.apache.commons.math.linear.CholeskyDecompositionImpl;
 import org.apache.commons.math.linear.OpenMapRealMatrix;
 import org.apache.commons.math.linear.RealMatrix;
@@ -119,6 +120,10 @@ public class GroundMotionFieldCalculator {
 	 *         values {@link Double}
 	 */
 	public Map<Site, Double> getMeanGroundMotionField() {
+		return getMeanGroundMotionField(sites);
+	}
+
+	private Map<Site, Double> getMeanGroundMotionField(List<Site> siteList) {
 
 		logger.debug("Computing mean ground motion field...");
 		// get current time
@@ -126,7 +131,7 @@ public class GroundMotionFieldCalculator {
 
 		Map<Site, Double> groundMotionMap = new HashMap<Site, Double>();
 		attenRel.setEqkRupture(rup);
-		for (Site site : sites) {
+		for (Site site : siteList) {
 			attenRel.setSite(site);
 			groundMotionMap.put(site, new Double(attenRel.getMean()));
 
@@ -137,6 +142,58 @@ public class GroundMotionFieldCalculator {
 		return groundMotionMap;
 	}
 
+	/**
+	 * Computes, for each site, the mean ground motion and the total,
+	 * inter-event and intra-event standard deviations of the attenuation
+	 * relationship, allowing to generate the ground motion fields outside of
+	 * this class.
+	 *
+	 * @return: array of four arrays of values, indexed by site (in the order
+	 *          of the site list of this calculator): the mean ground motion,
+	 *          the total, the inter-event and the intra-event standard
+	 *          deviation. The values of the standard deviation types not
+	 *          supported by the attenuation relationship are NaN.
+	 */
+	public double[][] getGroundMotionStatistics() {
+
+		logger.debug("Computing ground motion statistics...");
+		// get current time
+		long start = System.currentTimeMillis();
+
+		String[] stdTypes = { StdDevTypeParam.STD_DEV_TYPE_TOTAL,
+				StdDevTypeParam.STD_DEV_TYPE_INTER,
+				StdDevTypeParam.STD_DEV_TYPE_INTRA };
+		boolean[] allowed = new boolean[stdTypes.length];
+		for (int t = 0; t < stdTypes.length; t++) {
+			allowed[t] = attenRel.getParameter(StdDevTypeParam.NAME)
+					.getConstraint().isAllowed(stdTypes[t]);
+		}
+		Object stdType = attenRel.getParameter(StdDevTypeParam.NAME)
+				.getValue();
+
+		int numberOfSites = sites.size();
+		double[][] statistics = new double[stdTypes.length + 1][numberOfSites];
+		attenRel.setEqkRupture(rup);
+		for (int i = 0; i < numberOfSites; i++) {
+			attenRel.setSite(sites.get(i));
+			statistics[0][i] = attenRel.getMean();
+			for (int t = 0; t < stdTypes.length; t++) {
+				if (allowed[t]) {
+					attenRel.getParameter(StdDevTypeParam.NAME).setValue(
+							stdTypes[t]);
+					statistics[t + 1][i] = attenRel.getStdDev();
+				} else {
+					statistics[t + 1][i] = Double.NaN;
+				}
+			}
+		}
+		attenRel.getParameter(StdDevTypeParam.NAME).setValue(stdType);
+
+		getAndPrintElapsedTime(start);
+
+		return statistics;
+	}
+
 	/**
 	 * Computes uncorrelated ground motion field by adding to the mean ground
 	 * motion field Gaussian deviates which takes into account the truncation
@@ -180,6 +237,62 @@ public class GroundMotionFieldCalculator {
 		return groundMotionField;
 	}
 
+	/**
+	 * Computes the uncorrelated ground motion field for the block of sites
+	 * with indices [fromIndex, toIndex) in the site list of this calculator.
+	 *
+	 * The inter-event residual, common to all the sites of the rupture, is
+	 * drawn from interEventRn and computed as for the whole site list, so
+	 * that all the blocks of sites of the same rupture share it. The site
+	 * dependent residuals of the block are drawn from rn, a random number
+	 * generator of the block's own.
+	 *
+	 * @param interEventRn
+	 *            : {@link Random} random number generator for the
+	 *            inter-event residual
+	 * @param rn
+	 *            : {@link Random} random number generator for the site
+	 *            dependent residuals of the block
+	 * @param fromIndex
+	 *            : index of the first site of the block (inclusive)
+	 * @param toIndex
+	 *            : index of the last site of the block (exclusive)
+	 * @return: {@link Map} associating sites ({@link Site}) of the block and
+	 *          ground motion values {@link Double}
+	 */
+	public Map<Site, Double> getUncorrelatedGroundMotionField(
+			Random interEventRn, Random rn, int fromIndex, int toIndex) {
+
+		checkRandomNumberIsNotNull(interEventRn);
+		checkRandomNumberIsNotNull(rn);
+		if (fromIndex < 0 || toIndex > sites.size() || fromIndex >= toIndex) {
+			throw new IllegalArgumentException("Invalid block of sites: ["
+					+ fromIndex + ", " + toIndex + ")");
+		}
+
+		List<Site> blockSites = sites.subList(fromIndex, toIndex);
+		Map<Site, Double> groundMotionField =
+				getMeanGroundMotionField(blockSites);
+		// leave the attenuation relationship in the same state it would be
+		// after computing the mean field of the whole site list
+		attenRel.setSite(sites.get(sites.size() - 1));
+
+		if (attenRel.getParameter(StdDevTypeParam.NAME).getConstraint()
+				.isAllowed(StdDevTypeParam.STD_DEV_TYPE_INTER)
+				&& attenRel.getParameter(StdDevTypeParam.NAME).getConstraint()
+						.isAllowed(StdDevTypeParam.STD_DEV_TYPE_INTRA)) {
+			computeAndAddInterEventResidual(interEventRn, groundMotionField,
+					blockSites);
+			computeAndAddSiteDependentResidual(rn, groundMotionField,
+					StdDevTypeParam.STD_DEV_TYPE_INTRA, blockSites);
+		} else {
+			computeAndAddSiteDependentResidual(rn, groundMotionField,
+					StdDevTypeParam.STD_DEV_TYPE_TOTAL, blockSites);
+		}
+
+		return groundMotionField;
+	}
+
 	/**
 	 * Compute ground motion field with spatial correlation using correlation
 	 * model from Jayamram & Baker (2009):
@@ -210,21 +323,7 @@ public class GroundMotionFieldCalculator {
 		checkRandomNumberIsNotNull(rn);
 		validateInputCorrelatedGmfCalc(attenRel);
 
-		// covariance matrix and cholesky decompositions are computed only once.
-		// If multiple ground motion fields are needed for
-		// the same rupture, these calculations are not redone.
-		if (lowerTriangularCovarianceMatrix == null) {
-			CholeskyDecompositionImpl cholDecomp = null;
-			try {
-				cholDecomp = new CholeskyDecompositionImpl(
-						getCovarianceMatrix_JB2009());
-			} catch (Exception e) {
-				String msg = "Unexpected exception: " + e.getMessage();
-				logger.error(msg);
-				throw new RuntimeException(e);
-			}
-			lowerTriangularCovarianceMatrix = cholDecomp.getL();
-		}
+		computeLowerTriangularCovarianceMatrix();
 
 		Map<Site, Double> groundMotionField = getMeanGroundMotionField();
 
@@ -239,6 +338,106 @@ public class GroundMotionFieldCalculator {
 		return groundMotionField;
 	}
 
+	/**
+	 * Compute multiple ground motion fields with spatial correlation (see
+	 * {@link #getCorrelatedGroundMotionField_JB2009(Random)}), one for each
+	 * of the given random number generators.
+	 *
+	 * The mean ground motion field, the inter-event standard deviation and
+	 * the cholesky decomposition of the covariance matrix are computed once
+	 * for all the fields; the intra-event residuals of all the fields are
+	 * obtained by a single product of the lower triangular matrix with the
+	 * [sites, fields] matrix of the uncorrelated Gaussian deviates.
+	 *
+	 * The deviates of each field are drawn from its random number generator
+	 * in the same order as {@link #getCorrelatedGroundMotionField_JB2009(Random)}
+	 * does: passing the same generator n times gives the same fields as n
+	 * consecutive calls of that method.
+	 *
+	 * @param rns
+	 *            : array of {@link Random} random number generators, one for
+	 *            each ground motion field
+	 * @return: the ground motion values indexed by site (in the order of the
+	 *          site list of this calculator) and field
+	 */
+	public double[][] getCorrelatedGroundMotionFields_JB2009(Random[] rns) {
+
+		logger.debug("Computing " + rns.length
+				+ " correlated (JB2009) ground motion fields...");
+		// get current time
+		long start = System.currentTimeMillis();
+
+		for (Random rn : rns) {
+			checkRandomNumberIsNotNull(rn);
+		}
+		validateInputCorrelatedGmfCalc(attenRel);
+
+		computeLowerTriangularCovarianceMatrix();
+
+		Map<Site, Double> meanGroundMotionField = getMeanGroundMotionField();
+
+		double truncationLevel = (Double) attenRel.getParameter(
+				SigmaTruncLevelParam.NAME).getValue();
+		String truncationType = (String) attenRel.getParameter(
+				SigmaTruncTypeParam.NAME).getValue();
+		double interEventStd = Double.NaN;
+		if (interEvent == true) {
+			attenRel.getParameter(StdDevTypeParam.NAME).setValue(
+					StdDevTypeParam.STD_DEV_TYPE_INTER);
+			interEventStd = attenRel.getStdDev();
+		}
+
+		int numberOfSites = sites.size();
+		double[] interEventResiduals = new double[rns.length];
+		double[][] gaussianDeviates = new double[numberOfSites][rns.length];
+		for (int j = 0; j < rns.length; j++) {
+			if (interEvent == true) {
+				interEventResiduals[j] = getGaussianDeviate(interEventStd,
+						truncationLevel, truncationType, rns[j]);
+			}
+			for (int i = 0; i < numberOfSites; i++) {
+				gaussianDeviates[i][j] = getGaussianDeviate(1.0,
+						truncationLevel, truncationType, rns[j]);
+			}
+		}
+
+		RealMatrix intraEventResiduals = lowerTriangularCovarianceMatrix
+				.multiply(new Array2DRowRealMatrix(gaussianDeviates, false));
+
+		double[][] groundMotionFields = new double[numberOfSites][rns.length];
+		for (int i = 0; i < numberOfSites; i++) {
+			double mean = meanGroundMotionField.get(sites.get(i));
+			for (int j = 0; j < rns.length; j++) {
+				groundMotionFields[i][j] = mean + interEventResiduals[j]
+						+ intraEventResiduals.getEntry(i, j);
+			}
+		}
+
+		getAndPrintElapsedTime(start);
+
+		return groundMotionFields;
+	}
+
+	/**
+	 * Covariance matrix and cholesky decomposition are computed only once. If
+	 * multiple ground motion fields are needed for the same rupture, these
+	 * calculations are not redone.
+	 */
+	private void computeLowerTriangularCovarianceMatrix() {
+		if (lowerTriangularCovarianceMatrix == null) {
+			CholeskyDecompositionImpl cholDecomp = null;
+			try {
+				cholDecomp = new CholeskyDecompositionImpl(
+						getCovarianceMatrix_JB2009());
+			} catch (Exception e) {
+				String msg = "Unexpected exception: " + e.getMessage();
+				logger.error(msg);
+				throw new RuntimeException(e);
+			}
+			lowerTriangularCovarianceMatrix = cholDecomp.getL();
+		}
+	}
+
 	/**
 	 * Set GMPE standard deviation to inter-event, then stochastically generate
 	 * a single inter-event residual, and add this value to the already computed
@@ -246,6 +445,11 @@ public class GroundMotionFieldCalculator {
 	 */
 	private void computeAndAddInterEventResidual(Random rn,
 			Map<Site, Double> groundMotionField) {
+		computeAndAddInterEventResidual(rn, groundMotionField, sites);
+	}
+
+	private void computeAndAddInterEventResidual(Random rn,
+			Map<Site, Double> groundMotionField, List<Site> siteList) {
 
 		logger.debug("Computing and adding inter event residual...");
 		// get current time
@@ -258,7 +462,7 @@ public class GroundMotionFieldCalculator {
 						.getValue(),
 				(String) attenRel.getParameter(SigmaTruncTypeParam.NAME)
 						.getValue(), rn);
-		for (Site site : sites) {
+		for (Site site : siteList) {
 			double val = groundMotionField.get(site);
 			groundMotionField.put(site, val + interEventResidual);
 		}
@@ -274,6 +478,13 @@ public class GroundMotionFieldCalculator {
 	 */
 	private void computeAndAddSiteDependentResidual(Random rn,
 			Map<Site, Double> groundMotionField, String stdType) {
+		computeAndAddSiteDependentResidual(rn, groundMotionField, stdType,
+				sites);
+	}
+
+	private void computeAndAddSiteDependentResidual(Random rn,
+			Map<Site, Double> groundMotionField, String stdType,
+			List<Site> siteList) {
 
 		logger.debug("Computing and adding " + stdType + " residual...");
 		// get current time
@@ -281,7 +492,7 @@ public class GroundMotionFieldCalculator {
 
 		attenRel.getParameter(StdDevTypeParam.NAME).setValue(stdType);
 		attenRel.setEqkRupture(rup);
-		for (Site site : sites) {
+		for (Site site : siteList) {
 			attenRel.setSite(site);
 			Double val = groundMotionField.get(site);
 			double deviate = getGaussianDeviate(attenRel.getStdDev(),
@@ -383,6 +594,19 @@ public class GroundMotionFieldCalculator {
 		return dev * standardDeviation;
 	}
 
+	/**
+	 * Computes the covariance matrix of the intra-event residuals used for
+	 * the correlated ground motion fields (see
+	 * {@link #getCorrelatedGroundMotionField_JB2009(Random)}), allowing to
+	 * check the implementations generating the fields outside of this class.
+	 *
+	 * @return: the covariance matrix, indexed by site (in the order of the
+	 *          site list of this calculator)
+	 */
+	public double[][] getCovarianceMatrixAsArray_JB2009() {
+		return getCovarianceMatrix_JB2009().getData();
+	}
+
 	/**
 	 * Calculates covariance matrix for intra-event residuals using correlation
 	 * model of Jayamram & Baker (2009):
@@ -476,6 +700,10 @@ public class GroundMotionFieldCalculator {
 		return true;
 	}
 
+	public List<Site> getSites() {
+		return sites;
+	}
+
 	public boolean isJB2009_Vs30ClusterParam() {
 		return JB2009_Vs30ClusterParam;
 	}
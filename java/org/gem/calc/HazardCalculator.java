@@ -17,12 +17,13 @@
 
 package org.gem.calc;
 
+import java.nio.ByteBuffer;
 import java.rmi.RemoteException;
 import java.text.DecimalFormat;
 import java.text.DecimalFormatSymbols;
 import java.util.HashMap;
+import java.util.LinkedHashMap;
 import java.util.List;
-import java.util.ListIterator;
 import java.util.Locale;
 import java.util.Map;
 import java.util.Random;
@@ -53,6 +54,8 @@ import com.google.gson.Gson;
 public class HazardCalculator {
 
     private static Log logger = LogFactory.getLog(HazardCalculator.class);
+    // rupture index, first site index, number of sites
+    protected static final int GMF_RECORD_HEADER_SIZE = 12;
 
     /**
      * Calculate hazard curves for a set of sites from an earthquake rupture
@@ -147,6 +150,52 @@ public class HazardCalculator {
         return returnCurves.toArray(new String[returnCurves.size()]);
     }
 
+    /**
+     * Get the hazard curve ordinates (probabilities of exceedence) as a
+     * matrix of primitive doubles, one row per site (in the same order of
+     * siteList) and one column per intensity measure level.
+     *
+     * Unlike {@link #getHazardCurvesAsJson}, the result can be moved to the
+     * Python side in bulk, without any JSON encoding/decoding.
+     *
+     * @param siteList
+     * @param erf
+     * @param gmpeMap
+     * @param imlVals
+     *            : intensity measure levels (double[])
+     * @param integrationDistance
+     * @return a double[sites][imls] matrix
+     */
+    public static
+            double[][]
+            getHazardCurvesAsArray(
+                    List<Site> siteList,
+                    EqkRupForecastAPI erf,
+                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    double[] imlVals, double integrationDistance) {
+        Double[] boxedImlVals = null;
+        if (imlVals != null) {
+            boxedImlVals = new Double[imlVals.length];
+            for (int i = 0; i < imlVals.length; i++) {
+                boxedImlVals[i] = imlVals[i];
+            }
+        }
+        Map<Site, DiscretizedFuncAPI> curves =
+                getHazardCurves(siteList, erf, gmpeMap, boxedImlVals,
+                        integrationDistance);
+        double[][] result = new double[siteList.size()][];
+        int siteIndex = 0;
+        for (Site site : siteList) {
+            DiscretizedFuncAPI curve = curves.get(site);
+            double[] poes = new double[curve.getNum()];
+            for (int i = 0; i < poes.length; i++) {
+                poes[i] = curve.getY(i);
+            }
+            result[siteIndex++] = poes;
+        }
+        return result;
+    }
+
     /**
      * Calculate ground motion fields (correlated or uncorrelated) from a
      * stochastic event set generated through random sampling of an earthquake
@@ -183,7 +232,7 @@ public class HazardCalculator {
             throw new IllegalArgumentException(msg);
         }
         Map<EqkRupture, Map<Site, Double>> groundMotionFields =
-                new HashMap<EqkRupture, Map<Site, Double>>();
+                new LinkedHashMap<EqkRupture, Map<Site, Double>>();
         List<EqkRupture> eqkRupList =
                 StochasticEventSetGenerator
                         .getStochasticEventSetFromPoissonianERF(erf, rn);
@@ -204,31 +253,147 @@ public class HazardCalculator {
         return groundMotionFields;
     }
 
+    /**
+     * Calculate the ground motion fields of a stochastic event set (see
+     * {@link #getGroundMotionFields}) and save them to the cache, as a list
+     * of binary records (see {@link #gmfsToCache}) stored at the given key.
+     */
     public static
             void
             generateAndSaveGMFs(
                     Cache cache,
                     String key,
-                    String gmf_id,
                     List<Site> siteList,
                     EqkRupForecastAPI erf,
                     Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
                     Random rn, boolean correlation) {
         Map<EqkRupture, Map<Site, Double>> gmfs =
                 getGroundMotionFields(siteList, erf, gmpeMap, rn, correlation);
+        gmfsToCache(cache, key, 0, siteList, 0, gmfs);
+    }
+
+    /**
+     * Sample a stochastic event set from a Poissonian earthquake rupture
+     * forecast. The same forecast and seed always yield the same ruptures,
+     * in the same order, so that the event set can be shared (by
+     * re-sampling it) among the tasks computing parts of its ground motion
+     * fields.
+     *
+     * @param erf
+     *            : earthquake rupture forecast {@link EqkRupForecastAPI}
+     * @param seed
+     *            : seed of the random number generator
+     * @return the list of sampled ruptures
+     */
+    public static List<EqkRupture> sampleStochasticEventSet(
+            EqkRupForecastAPI erf, long seed) {
+        return StochasticEventSetGenerator
+                .getStochasticEventSetFromPoissonianERF(erf, new Random(seed));
+    }
+
+    /**
+     * Derive the seed of the random number generator used for the ground
+     * motion field of the ruptureIndex-th rupture of a stochastic event set
+     * (SplitMix64 style increment and finalizer).
+     */
+    public static long ruptureSeed(long seed, int ruptureIndex) {
+        long z = seed + (ruptureIndex + 1) * 0x9E3779B97F4A7C15L;
+        z = (z ^ (z >>> 30)) * 0xBF58476D1CE4E5B9L;
+        z = (z ^ (z >>> 27)) * 0x94D049BB133111EBL;
+        return z ^ (z >>> 31);
+    }
 
-        String[] site_ids = new String[siteList.size()];
-        ListIterator<Site> sites = siteList.listIterator();
-        while (sites.hasNext()) {
-            sites.next();
-            site_ids[sites.nextIndex() - 1] =
-                    Integer.toString(sites.nextIndex() - 1);
+    /**
+     * Derive the seed of the random number generator used for the site
+     * dependent residuals of the ruptureIndex-th rupture of a stochastic
+     * event set, at the block of sites starting with the firstSite-th one.
+     */
+    public static long siteBlockSeed(long seed, int ruptureIndex,
+            int firstSite) {
+        return ruptureSeed(ruptureSeed(seed, ruptureIndex), firstSite);
+    }
+
+    /**
+     * Calculate the ground motion fields of the ruptures with indices
+     * [firstRupture, lastRupture) of a stochastic event set, for the sites
+     * with indices [firstSite, lastSite) of siteList.
+     *
+     * Each rupture draws its inter-event residual (or its whole correlated
+     * field) from its own random number generator, seeded with
+     * {@link #ruptureSeed}, and each block of sites of a rupture draws its
+     * site dependent residuals from a generator seeded with
+     * {@link #siteBlockSeed} (see
+     * {@link GroundMotionFieldCalculator#getUncorrelatedGroundMotionField(Random, Random, int, int)}).
+     * The values do not depend on how the event set is split by ruptures;
+     * they are reproducible for the same blocks of sites. Correlated ground
+     * motion fields need the whole site list.
+     *
+     * @return the ground motion fields, in rupture index order
+     */
+    public static
+            Map<EqkRupture, Map<Site, Double>>
+            getGroundMotionFieldsBlock(
+                    List<EqkRupture> eqkRupList,
+                    int firstRupture,
+                    int lastRupture,
+                    List<Site> siteList,
+                    int firstSite,
+                    int lastSite,
+                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    long seed, boolean correlation) {
+        if (correlation && (firstSite != 0 || lastSite != siteList.size())) {
+            String msg =
+                    "Correlated ground motion fields cannot be split"
+                            + " by blocks of sites";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
         }
-        String[] rupture_ids = new String[gmfs.keySet().size()];
-        for (int x = 0; x < gmfs.keySet().size(); x++) {
-            rupture_ids[x] = Integer.toString(x);
+        Map<EqkRupture, Map<Site, Double>> groundMotionFields =
+                new LinkedHashMap<EqkRupture, Map<Site, Double>>();
+        for (int r = firstRupture; r < lastRupture; r++) {
+            EqkRupture rup = eqkRupList.get(r);
+            Random rn = new Random(ruptureSeed(seed, r));
+            GroundMotionFieldCalculator gmfCalc =
+                    new GroundMotionFieldCalculator(
+                            gmpeMap.get(rup.getTectRegType()), rup, siteList);
+            if (correlation) {
+                groundMotionFields.put(rup,
+                        gmfCalc.getCorrelatedGroundMotionField_JB2009(rn));
+            } else {
+                groundMotionFields.put(rup,
+                        gmfCalc.getUncorrelatedGroundMotionField(rn,
+                                new Random(siteBlockSeed(seed, r, firstSite)),
+                                firstSite, lastSite));
+            }
         }
-        gmfToMemcache(cache, key, gmf_id, rupture_ids, site_ids, gmfs);
+        return groundMotionFields;
+    }
+
+    /**
+     * Like {@link #generateAndSaveGMFs}, for a block of ruptures and sites
+     * (see {@link #getGroundMotionFieldsBlock}). The records are identified
+     * by the (global) indices of their rupture and first site, so that the
+     * blocks of the same stochastic event set can be merged.
+     */
+    public static
+            void
+            generateAndSaveGMFsBlock(
+                    Cache cache,
+                    String key,
+                    List<EqkRupture> eqkRupList,
+                    int firstRupture,
+                    int lastRupture,
+                    List<Site> siteList,
+                    int firstSite,
+                    int lastSite,
+                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    long seed, boolean correlation) {
+        Map<EqkRupture, Map<Site, Double>> gmfs =
+                getGroundMotionFieldsBlock(eqkRupList, firstRupture,
+                        lastRupture, siteList, firstSite, lastSite, gmpeMap,
+                        seed, correlation);
+        gmfsToCache(cache, key, firstRupture,
+                siteList.subList(firstSite, lastSite), firstSite, gmfs);
     }
 
     public static
@@ -343,6 +508,51 @@ public class HazardCalculator {
         return result.toString();
     }
 
+    /**
+     * Encode the ground motion field of a rupture as a binary record (big
+     * endian): the rupture index (int), the index of the first site (int),
+     * the number of sites (int) and the ground motion values (doubles) in
+     * site list order.
+     */
+    protected static byte[] gmfToRecord(int ruptureIndex, int firstSite,
+            List<Site> siteList, Map<Site, Double> groundMotionField) {
+        ByteBuffer buffer =
+                ByteBuffer.allocate(GMF_RECORD_HEADER_SIZE + 8
+                        * siteList.size());
+        buffer.putInt(ruptureIndex);
+        buffer.putInt(firstSite);
+        buffer.putInt(siteList.size());
+        for (Site site : siteList) {
+            buffer.putDouble(groundMotionField.get(site));
+        }
+        return buffer.array();
+    }
+
+    /**
+     * Saves ground motion fields to a Cache object, as a list of binary
+     * records (see {@link #gmfToRecord}), one per rupture, in the iteration
+     * order of <code>groundMotionFields</code>. Any previous value stored at
+     * <code>key</code> is replaced.
+     *
+     * @param firstRupture
+     *            index of the first rupture of groundMotionFields
+     * @param siteList
+     *            the sites of the ground motion fields
+     * @param firstSite
+     *            index of the first site of siteList
+     */
+    protected static void gmfsToCache(Cache cache, String key,
+            int firstRupture, List<Site> siteList, int firstSite,
+            Map<EqkRupture, Map<Site, Double>> groundMotionFields) {
+        logger.debug("Saving GMFs to " + key);
+        cache.delete(key);
+        int ruptureIndex = firstRupture;
+        for (Map<Site, Double> gmf : groundMotionFields.values()) {
+            cache.rpush(key,
+                    gmfToRecord(ruptureIndex++, firstSite, siteList, gmf));
+        }
+    }
+
     /**
      * Saves a ground motion map to a Cache object.<br>
      * <br>
@@ -98,12 +98,6 @@ public class UHSCalculator
         this.maxDistance = maxDistance;
 
         validateInput();
-
-        hazCurveMap = new HashMap<Double, DiscretizedFuncAPI>();
-        for (double period : this.periods)
-        {
-            hazCurveMap.put(period, initHazCurve(this.imls));
-        }
     }
 
     private void validateInput()
@@ -153,6 +147,40 @@ public class UHSCalculator
         return computeUHS(site);
     }
 
+    /**
+     * Compute the UHS results of several sites with the same calculator (and
+     * thus the same ERF and GMPEs).
+     *
+     * The i-th elements of the arrays are the parameters of the i-th site,
+     * as in {@link #computeUHS(double, double, String, double, double, double)}.
+     *
+     * @param lats Latitudes
+     * @param lons Longitudes
+     * @param vs30Types
+     * @param vs30Values
+     * @param depthTo1pt0KMPS
+     * @param depthTo2pt5KMPS
+     * @return list of UHS results (1 per PoE) of each site, in the order of
+     *         the arrays
+     */
+    public List<List<UHSResult>> computeUHS(
+            double[] lats,
+            double[] lons,
+            String[] vs30Types,
+            double[] vs30Values,
+            double[] depthTo1pt0KMPS,
+            double[] depthTo2pt5KMPS)
+    {
+        List<List<UHSResult>> results = new ArrayList<List<UHSResult>>(
+                lats.length);
+        for (int i = 0; i < lats.length; i++)
+        {
+            results.add(computeUHS(lats[i], lons[i], vs30Types[i],
+                    vs30Values[i], depthTo1pt0KMPS[i], depthTo2pt5KMPS[i]));
+        }
+        return results;
+    }
+
     /**
      * Compute a list of UHS results (1 per PoE). Each result is 1D array
      * representing the y-axis values of the UHS curve; x-axis values of UHS
@@ -174,6 +202,15 @@ public class UHSCalculator
     {
         // Final results of the calculation
         List<UHSResult> uhsResults = new ArrayList<UHSResult>();
+
+        // The hazard curves are reset for each site: the calculator can be
+        // reused for several sites.
+        hazCurveMap = new HashMap<Double, DiscretizedFuncAPI>();
+        for (double period : periods)
+        {
+            hazCurveMap.put(period, initHazCurve(imls));
+        }
+
         for (int is = 0; is < erf.getNumSources(); is++)
         {
             ProbEqkSource source = erf.getSource(is);
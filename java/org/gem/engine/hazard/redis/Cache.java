@@ -118,6 +118,38 @@ public class Cache {
         }
     }
 
+    /**
+     * Append a binary value to the list stored at the given key.
+     * <p>
+     * 
+     * @param key
+     *            The key to use.
+     * @param value
+     *            The value to be appended.
+     */
+    public void rpush(String key, byte[] value) {
+        try {
+            client.rpush(key, value);
+        } catch (Exception e) {
+            throw new RuntimeException(e);
+        }
+    }
+
+    /**
+     * Delete the given key.
+     * <p>
+     * 
+     * @param key
+     *            The key to delete.
+     */
+    public void delete(String key) {
+        try {
+            client.del(key);
+        } catch (Exception e) {
+            throw new RuntimeException(e);
+        }
+    }
+
     public void flush() {
         try {
             client.flushdb();
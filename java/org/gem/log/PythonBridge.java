@@ -24,4 +24,6 @@ import org.apache.log4j.spi.LoggingEvent;
  */
 public interface PythonBridge {
     public void append(LoggingEvent event);
+
+    public void appendBatch(LoggingEvent[] events);
 }
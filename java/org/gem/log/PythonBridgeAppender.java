@@ -17,20 +17,97 @@
 
 package org.gem.log;
 
+import java.util.ArrayList;
+import java.util.List;
+import java.util.concurrent.locks.ReentrantLock;
+
 import org.apache.log4j.AppenderSkeleton;
+import org.apache.log4j.Level;
 import org.apache.log4j.spi.LoggingEvent;
 
 import org.gem.log.PythonBridge;
 
 /**
- * Log4J appender class that sends log messages through JPype
+ * Log4J appender class that sends log messages through JPype.
+ *
+ * Events are buffered and handed over to the bridge in batches of at most
+ * batchSize events. Warnings (and more severe events) flush the buffer
+ * immediately, as does any event appended more than maxDelay milliseconds
+ * after the last flush.
+ *
+ * The bridge calls back into Python, which needs the GIL: it is never called
+ * while holding the buffer monitor, and a thread finding another one handing
+ * events over leaves its own events to it instead of waiting (the other
+ * thread may be waiting for the GIL held by this one).
  */
 public class PythonBridgeAppender extends AppenderSkeleton {
     protected static PythonBridge bridge;
 
+    private static final List<LoggingEvent> buffer =
+            new ArrayList<LoggingEvent>();
+    private static int batchSize = 1;
+    private static long maxDelay = 0;
+    private static long lastFlush = System.currentTimeMillis();
+    // Held while handing events over, so that they reach Python in order.
+    private static final ReentrantLock flushLock = new ReentrantLock();
+
+    public static void setBatchSize(int size) {
+        synchronized (buffer) {
+            batchSize = Math.max(1, size);
+        }
+    }
+
+    public static void setMaxDelay(long millis) {
+        synchronized (buffer) {
+            maxDelay = millis;
+        }
+    }
+
     @Override
     public void append(LoggingEvent event) {
-        bridge.append(event);
+        // The location and thread name are computed lazily by log4j; make
+        // sure they refer to the logging call and not to the flush.
+        event.getLocationInformation();
+        event.getThreadName();
+
+        boolean flush;
+        synchronized (buffer) {
+            buffer.add(event);
+            flush = buffer.size() >= batchSize
+                    || event.getLevel().isGreaterOrEqual(Level.WARN)
+                    || System.currentTimeMillis() - lastFlush >= maxDelay;
+        }
+        if (flush) {
+            flushBuffer();
+        }
+    }
+
+    /**
+     * Hand all the buffered events over to the bridge.
+     */
+    public static void flushBuffer() {
+        // the events appended while handing the previous ones over are
+        // handed over as well, by the same thread
+        while (flushLock.tryLock()) {
+            try {
+                LoggingEvent[] events;
+                synchronized (buffer) {
+                    lastFlush = System.currentTimeMillis();
+                    if (buffer.isEmpty()) {
+                        return;
+                    }
+                    events = buffer.toArray(new LoggingEvent[buffer.size()]);
+                    buffer.clear();
+                }
+                if (events.length == 1) {
+                    bridge.append(events[0]);
+                } else {
+                    bridge.appendBatch(events);
+                }
+            } finally {
+                flushLock.unlock();
+            }
+        }
     }
 
     @Override
@@ -39,5 +116,7 @@ public class PythonBridgeAppender extends AppenderSkeleton {
     }
 
     @Override
-    public void close() {}
+    public void close() {
+        flushBuffer();
+    }
 }
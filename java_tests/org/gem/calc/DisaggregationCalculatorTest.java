@@ -22,6 +22,7 @@ import static org.junit.Assert.*;
 import java.util.Arrays;
 
 import org.junit.Test;
+import org.opensha.commons.data.function.DiscretizedFuncAPI;
 import org.opensha.commons.geo.BorderType;
 import org.opensha.commons.geo.Location;
 import org.opensha.commons.geo.LocationList;
@@ -128,6 +129,40 @@ public class DisaggregationCalculatorTest
         assertArrayEquals(EXPECTED, result, 0.00000009);
     }
 
+    /**
+     * The matrices computed for several PoEs in one pass are the same as the
+     * ones computed for each PoE.
+     */
+    @Test
+    public void testComputeMatrices()
+    {
+        DisaggregationCalculator disCalc = new DisaggregationCalculator(
+                LAT_BIN_LIMS, LON_BIN_LIMS, MAG_BIN_LIMS,
+                EPS_BIN_LIMS);
+
+        GEM1ERF erf = makeTestERF(AREA_SRC_DISCRETIZATION, NUM_MFD_PTS, BORDER_TYPE);
+
+        double minMag = (Double) erf.getParameter(GEM1ERF.MIN_MAG_NAME).getValue();
+        DiscretizedFuncAPI hazardCurve = makeHazardCurve(LOG_IMLS, AREA_SRC_DISCRETIZATION, erf);
+        double[] poes = {POE, POE / 10};
+
+        DisaggregationResult[] results = disCalc.computeMatrices(
+                makeTestSite(), erf, makeTestImrMap(), poes, hazardCurve,
+                minMag);
+
+        assertEquals(poes.length, results.length);
+        assertArrayEquals(EXPECTED, results[0].getMatrix(), 0.00000009);
+
+        for (int i = 0; i < poes.length; i++)
+        {
+            DisaggregationResult expected = disCalc.computeMatrix(
+                    makeTestSite(), erf, makeTestImrMap(), poes[i],
+                    hazardCurve, minMag);
+            assertEquals(expected.getGMV(), results[i].getGMV(), 0.0);
+            assertArrayEquals(expected.getMatrix(), results[i].getMatrix(), 0.0);
+        }
+    }
+
     @Test(expected=RuntimeException.class)
     public void testComputeMatrixNonPoissonianErf()
     {
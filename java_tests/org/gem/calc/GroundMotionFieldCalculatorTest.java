@@ -387,6 +387,78 @@ public class GroundMotionFieldCalculatorTest {
 		}
 	}
 
+	@Test
+	public void groundMotionStatistics() {
+		/**
+		 * Check the mean ground motion and the standard deviations of an
+		 * attenuation relationship providing inter- and intra-event standard
+		 * deviations.
+		 */
+		String truncationType = SigmaTruncTypeParam.SIGMA_TRUNC_TYPE_NONE;
+		double truncationLevel = 1.0;
+		setImr(truncationType, truncationLevel, PGA_Param.NAME,
+				new BA_2008_AttenRel(testParamChangeListener));
+		GroundMotionFieldCalculator gmfCalc = new GroundMotionFieldCalculator(
+				imr, rupture, siteList);
+
+		double[][] statistics = gmfCalc.getGroundMotionStatistics();
+		Map<Site, Double> mean = gmfCalc.getMeanGroundMotionField();
+
+		for (int i = 0; i < siteList.size(); i++) {
+			double total = statistics[1][i];
+			double inter = statistics[2][i];
+			double intra = statistics[3][i];
+			assertEquals(mean.get(siteList.get(i)), statistics[0][i], 0.0);
+			assertEquals(total * total, inter * inter + intra * intra, 1e-6);
+		}
+	}
+
+	@Test
+	public void correlatedGroundMotionFields_JB2009() {
+		/**
+		 * Check that the ground motion fields computed in a single batch are
+		 * the same as the ones computed one at a time, both when sharing a
+		 * random number generator and when using one generator per field.
+		 */
+		String truncationType = SigmaTruncTypeParam.SIGMA_TRUNC_TYPE_2SIDED;
+		double truncationLevel = 2.0;
+		setImr(truncationType, truncationLevel, PGA_Param.NAME,
+				new BA_2008_AttenRel(testParamChangeListener));
+		int numFields = 5;
+
+		GroundMotionFieldCalculator gmfCalc = new GroundMotionFieldCalculator(
+				imr, rupture, siteList);
+		Random rn = new Random(seed);
+		Random[] rns = new Random[numFields];
+		for (int j = 0; j < numFields; j++) {
+			rns[j] = rn;
+		}
+		double[][] computed = gmfCalc
+				.getCorrelatedGroundMotionFields_JB2009(rns);
+
+		gmfCalc = new GroundMotionFieldCalculator(imr, rupture, siteList);
+		rn = new Random(seed);
+		for (int j = 0; j < numFields; j++) {
+			Map<Site, Double> map = gmfCalc
+					.getCorrelatedGroundMotionField_JB2009(rn);
+			for (int i = 0; i < siteList.size(); i++) {
+				assertEquals(map.get(siteList.get(i)), computed[i][j], 1e-12);
+			}
+		}
+
+		for (int j = 0; j < numFields; j++) {
+			rns[j] = new Random(seed + j);
+		}
+		computed = gmfCalc.getCorrelatedGroundMotionFields_JB2009(rns);
+		for (int j = 0; j < numFields; j++) {
+			Map<Site, Double> map = gmfCalc
+					.getCorrelatedGroundMotionField_JB2009(new Random(seed + j));
+			for (int i = 0; i < siteList.size(); i++) {
+				assertEquals(map.get(siteList.get(i)), computed[i][j], 1e-12);
+			}
+		}
+	}
+
 	@Test(expected = IllegalArgumentException.class)
 	public void correlatedGroundMotion_JB2009_NullRandomNumberGenerator() {
 		/**
@@ -22,6 +22,7 @@ import static org.junit.Assert.assertTrue;
 import static org.junit.Assert.assertEquals;
 
 import java.io.IOException;
+import java.nio.ByteBuffer;
 import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.Hashtable;
@@ -134,6 +135,83 @@ public class HazardCalculatorTest {
         }
     }
 
+    /**
+     * Check that the matrix returned by getHazardCurvesAsArray holds the same
+     * ordinates, in site list order, as the curves from getHazardCurves
+     */
+    @Test
+    public void checkHazardCurvesAsArray() {
+        Map<Site, DiscretizedFuncAPI> curves =
+                HazardCalculator.getHazardCurves(siteList, erf, gmpeMap,
+                        imlVals, integrationDistance);
+        double[] primitiveImlVals = new double[imlVals.length];
+        for (int i = 0; i < imlVals.length; i++) {
+            primitiveImlVals[i] = imlVals[i];
+        }
+        double[][] results =
+                HazardCalculator.getHazardCurvesAsArray(siteList, erf,
+                        gmpeMap, primitiveImlVals, integrationDistance);
+        assertEquals(siteList.size(), results.length);
+        for (int i = 0; i < siteList.size(); i++) {
+            DiscretizedFuncAPI curve = curves.get(siteList.get(i));
+            assertEquals(imlVals.length, results[i].length);
+            for (int j = 0; j < imlVals.length; j++) {
+                assertEquals(curve.getY(j), results[i][j], 0.0);
+            }
+        }
+    }
+
+    /**
+     * Check that the ground motion fields computed by blocks of ruptures and
+     * sites do not depend on how the ruptures are split, for the same blocks
+     * of sites.
+     */
+    @Test
+    public void checkGroundMotionFieldsBlocks() {
+        long seed = 42L;
+        List<EqkRupture> ruptures =
+                HazardCalculator.sampleStochasticEventSet(erf, seed);
+        int numRuptures = ruptures.size();
+        int numSites = siteList.size();
+        int ruptureChunk = Math.max(1, numRuptures / 3);
+        int siteBlock = Math.max(1, numSites / 4);
+        for (int s = 0; s < numSites; s += siteBlock) {
+            int lastSite = Math.min(s + siteBlock, numSites);
+            Map<EqkRupture, Map<Site, Double>> full =
+                    HazardCalculator.getGroundMotionFieldsBlock(ruptures, 0,
+                            numRuptures, siteList, s, lastSite, gmpeMap,
+                            seed, false);
+            assertEquals(numRuptures, full.size());
+            for (int r = 0; r < numRuptures; r += ruptureChunk) {
+                int lastRupture = Math.min(r + ruptureChunk, numRuptures);
+                Map<EqkRupture, Map<Site, Double>> block =
+                        HazardCalculator.getGroundMotionFieldsBlock(ruptures,
+                                r, lastRupture, siteList, s, lastSite,
+                                gmpeMap, seed, false);
+                assertEquals(lastRupture - r, block.size());
+                for (EqkRupture rup : block.keySet()) {
+                    Map<Site, Double> gmf = block.get(rup);
+                    assertEquals(lastSite - s, gmf.size());
+                    for (Site site : gmf.keySet()) {
+                        assertEquals(full.get(rup).get(site), gmf.get(site),
+                                0.0);
+                    }
+                }
+            }
+        }
+    }
+
+    /**
+     * Correlated ground motion fields cannot be split by blocks of sites
+     */
+    @Test(expected = IllegalArgumentException.class)
+    public void getGroundMotionFieldsBlockCorrelatedSiteBlock() {
+        List<EqkRupture> ruptures =
+                HazardCalculator.sampleStochasticEventSet(erf, 42L);
+        HazardCalculator.getGroundMotionFieldsBlock(ruptures, 0,
+                ruptures.size(), siteList, 0, 1, gmpeMap, 42L, true);
+    }
+
     /**
      * Test getHazardCurves when a null list of site is passed
      */
@@ -408,6 +486,27 @@ public class HazardCalculatorTest {
         assertTrue(jsonFromGmf.compareTo(jsonFromGmf) == 0);
     }
 
+    /**
+     * Check the binary encoding of the ground motion field of a rupture.
+     */
+    @Test
+    public void gmfToRecordTest() {
+        Map<Site, Double> gmf = new HashMap<Site, Double>();
+        for (int i = 0; i < siteList.size(); i++) {
+            gmf.put(siteList.get(i), new Double(0.5 * i - 1.0));
+        }
+        byte[] record = HazardCalculator.gmfToRecord(7, 3, siteList, gmf);
+        assertEquals(HazardCalculator.GMF_RECORD_HEADER_SIZE + 8
+                * siteList.size(), record.length);
+        ByteBuffer buffer = ByteBuffer.wrap(record);
+        assertEquals(7, buffer.getInt());
+        assertEquals(3, buffer.getInt());
+        assertEquals(siteList.size(), buffer.getInt());
+        for (int i = 0; i < siteList.size(); i++) {
+            assertEquals(0.5 * i - 1.0, buffer.getDouble(), 0.0);
+        }
+    }
+
     /**
      * Set up list of sites
      */
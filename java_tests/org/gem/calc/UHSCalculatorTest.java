@@ -216,6 +216,34 @@ public class UHSCalculatorTest
         assertUHSResultsEqual(expected, actual);
     }
 
+    /**
+     * Test the UHS computation of several sites with the same calculator.
+     */
+    @Test
+    public void testComputeUHSOfSeveralSites()
+    {
+        UHSCalculator uhsCalc = new UHSCalculator(
+                PERIODS, POES, LOG_IMLS,
+                ERF, makeTestImrMap(), MAX_DISTANCE);
+
+        String vs30Type = Vs30Type.Measured.toString();
+        double[] lats = {0.0, 0.0};
+        double[] lons = {0.0, 0.0};
+        String[] vs30Types = {vs30Type, vs30Type};
+        double[] vs30Values = {760.0, 760.0};
+        double[] depthTo1pt0KMPS = {100.0, 100.0};
+        double[] depthTo2pt5KMPS = {1.0, 1.0};
+
+        List<List<UHSResult>> actual = uhsCalc.computeUHS(
+                lats, lons, vs30Types, vs30Values,
+                depthTo1pt0KMPS, depthTo2pt5KMPS);
+
+        // the hazard curves of a site do not leak into the next one
+        assertEquals(2, actual.size());
+        assertUHSResultsEqual(expectedUHSResults(), actual.get(0));
+        assertUHSResultsEqual(expectedUHSResults(), actual.get(1));
+    }
+
     @Test(expected=InputValidationException.class)
     public void testComputeUHSThrowsOnInvalidVs30Type()
     {
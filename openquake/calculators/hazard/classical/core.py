@@ -21,6 +21,7 @@
 
 from collections import namedtuple
 import json
+import numpy
 import random
 from itertools import izip
 import time
@@ -389,37 +390,53 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
                 map_func=general.compute_quantile_hazard_maps,
                 map_serializer=psha_exp.map2db)
 
-    @general.create_java_cache
     def compute_hazard_curve(self, sites, realization):
-        """ Compute hazard curves, write them to KVS as JSON,
-        and return a list of the KVS keys for each curve. """
-        jpype = java.jvm()
-        try:
-            calc = java.jclass("HazardCalculator")
-            poes_list = calc.getHazardCurvesAsJson(
-                self.parameterize_sites(sites),
-                self.generate_erf(),
-                self.generate_gmpe_map(),
-                general.get_iml_list(
-                    self.job_ctxt.imls,
-                    self.job_ctxt.params['INTENSITY_MEASURE_TYPE']),
-                self.job_ctxt['MAXIMUM_DISTANCE'])
-        except jpype.JavaException, ex:
-            unwrap_validation_error(jpype, ex)
+        """ Compute hazard curves (see :meth:`compute_hazard_curves_array`),
+        write them to KVS as JSON, and return a list of the KVS keys for each
+        curve. """
+        poes_matrix = self.compute_hazard_curves_array(sites)
 
         # write the poes to the KVS and return a list of the keys
 
         curve_keys = []
-        for site, poes in izip(sites, poes_list):
+        curves = {}
+        for site, poes in izip(sites, poes_matrix):
             curve_key = kvs.tokens.hazard_curve_poes_key(
                 self.job_ctxt.job_id, realization, site)
 
-            kvs.get_client().set(curve_key, poes)
+            curves[curve_key] = json.dumps(poes.tolist())
 
             curve_keys.append(curve_key)
 
+        if curves:
+            kvs.get_client().mset(curves)
+
         return curve_keys
 
+    @general.create_java_cache
+    def compute_hazard_curves_array(self, sites):
+        """Compute the hazard curves for the given sites and return their
+        PoEs as a `numpy.ndarray` of shape (len(sites), len(imls)).
+
+        The curves are moved from the JVM as a primitive double[][] matrix
+        (see :func:`openquake.java.jdouble_matrix_to_array`) instead of as
+        per-site JSON strings."""
+        jpype = java.jvm()
+        imt = self.job_ctxt.params['INTENSITY_MEASURE_TYPE']
+        imls = general.IML_SCALING[imt](numpy.array(self.job_ctxt.imls))
+        try:
+            calc = java.jclass("HazardCalculator")
+            poes_matrix = calc.getHazardCurvesAsArray(
+                self.parameterize_sites(sites),
+                self.generate_erf(),
+                self.generate_gmpe_map(),
+                java.array_to_jdouble_array(imls),
+                self.job_ctxt['MAXIMUM_DISTANCE'])
+        except jpype.JavaException, ex:
+            unwrap_validation_error(jpype, ex)
+
+        return java.jdouble_matrix_to_array(poes_matrix)
+
     @property
     def quantile_levels(self):
         """Returns the quantile levels specified in the config file of this
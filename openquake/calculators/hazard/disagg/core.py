@@ -17,6 +17,7 @@
 """Core functionality for the Disaggregation Hazard calculator."""
 
 import errno
+import functools
 import h5py
 import numpy
 import os
@@ -26,8 +27,11 @@ import uuid
 from celery.task import task
 
 from openquake import java
+from openquake import kvs
 from openquake import logs
 from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
+from openquake.calculators.hazard.disagg import mean
+from openquake.calculators.hazard.disagg import store
 from openquake.calculators.hazard.disagg import subsets
 from openquake.calculators.hazard import general
 from openquake.java import list_to_jdouble_array
@@ -36,14 +40,47 @@ from openquake.output import hazard_disagg as hazard_output
 from openquake.utils import config
 from openquake.utils import stats
 from openquake.utils.tasks import get_running_job
+from openquake.utils.tasks import TaskPipeline
 
 
 LOG = logs.LOG
 
 
+def _by_realization_and_poe(site_results, num_sites):
+    """Group the results of the single sites by (realization, PoE) pair.
+
+    >>> list(_by_realization_and_poe(
+    ...     [(1, 0.1, 1, 'b'), (2, 0.1, 0, 'c'), (1, 0.1, 0, 'a'),
+    ...      (2, 0.1, 1, 'd')], 2))
+    [(1, 0.1, ['a', 'b']), (2, 0.1, ['c', 'd'])]
+
+    :param site_results: an iterable of `(realization, poe, site_index,
+        data)` tuples, in any order
+    :param int num_sites: the number of sites of the calculation
+    :returns: a generator of `(realization, poe, data_list)` tuples, with
+        the data in site order, yielded as soon as the data of all the sites
+        of a pair is available
+    """
+    # (realization, poe) -> [data per site]
+    pending = dict()
+    # (realization, poe) -> number of sites yet to come
+    missing = dict()
+
+    for rlz, poe, index, data in site_results:
+        key = (rlz, poe)
+        if key not in pending:
+            pending[key] = [None] * num_sites
+            missing[key] = num_sites
+        pending[key][index] = data
+        missing[key] -= 1
+        if not missing[key]:
+            del missing[key]
+            yield rlz, poe, pending.pop(key)
+
+
 # pylint: disable=R0914
 @java.unpack_exception
-def compute_disagg_matrix(job_ctxt, site, poe, result_dir):
+def compute_disagg_matrix(job_ctxt, site, poe, result_dir, realization=None):
     """ Compute a complete 5D Disaggregation matrix. This task leans heavily
     on the DisaggregationCalculator (in the OpenQuake Java lib) to handle this
     computation.
@@ -61,9 +98,123 @@ def compute_disagg_matrix(job_ctxt, site, poe, result_dir):
     :param result_dir: location for the Java code to write the matrix in an
         HDF5 file (in a distributed environment, this should be the path of a
         mounted NFS)
+    :param int realization: logic tree sample iteration number, selecting
+        the source model and GMPE map in the KVS (the ones stored under the
+        job keys if `None`)
 
     :returns: 2-tuple of (ground_motion_value, path_to_h5_matrix_file)
     """
+    disagg_calc, erf, gmpe_map, imls, site_params = _disagg_inputs(
+        job_ctxt, site, realization)
+
+    matrix_result = _compute_matrix(
+        disagg_calc, site.latitude, site.longitude, erf, gmpe_map, poe, imls,
+        *site_params)
+
+    matrix_path = save_5d_matrix_to_h5(result_dir,
+                                       numpy.array(matrix_result.getMatrix()))
+
+    return (matrix_result.getGMV(), matrix_path)
+
+
+@java.unpack_exception
+def compute_disagg_subsets(job_ctxt, site, poes, realization, result_dir,
+                           subset_types, consolidated=False):
+    """Compute the complete 5D Disaggregation matrices of a site for all the
+    given PoEs and extract the requested matrix subsets from them.
+
+    The hazard curve of the site is computed once and the matrices of all
+    the PoEs are accumulated in a single pass over the ruptures (see
+    `org.gem.calc.DisaggregationCalculator.computeMatrices`).
+
+    Only the subsets are saved (in a file in HDF5 format per PoE, like
+    :func:`openquake.calculators.hazard.disagg.subsets.extract_subsets`
+    does): the full matrices are not written to disk unless they are one of
+    the requested subsets.
+
+    With `consolidated` the subsets are appended to the shard files of the
+    worker process instead (see
+    :mod:`openquake.calculators.hazard.disagg.store`), to be merged in a
+    store file per PoE.
+
+    :param job_ctxt:
+        A :class:`openquake.engine.JobContext` which holds all of the
+        data we need to run this computation.
+    :param site: a single site of interest
+    :type site: :class:`openquake.shapes.Site` instance`
+    :param poes: Probabilities of Exceedence
+    :type poes: list of floats
+    :param int realization: logic tree sample iteration number
+    :param result_dir: location where the subsets files are saved (in a
+        distributed environment, this should be the path of a mounted NFS)
+    :param subset_types: the matrix subset results requested in the job
+        config
+    :param bool consolidated: write to the consolidated store
+
+    :returns: a list of 2-tuples of (ground_motion_value,
+        path_to_h5_subsets_file), one for each PoE; the path is the one of
+        the store file when `consolidated` is set
+    """
+    disagg_calc, erf, gmpe_map, imls, site_params = _disagg_inputs(
+        job_ctxt, site, realization)
+
+    matrix_results = _compute_matrices(
+        disagg_calc, site.latitude, site.longitude, erf, gmpe_map, poes,
+        imls, *site_params)
+
+    lat_bin_lims = job_ctxt[job_cfg.LAT_BIN_LIMITS]
+    lon_bin_lims = job_ctxt[job_cfg.LON_BIN_LIMITS]
+    mag_bin_lims = job_ctxt[job_cfg.MAG_BIN_LIMITS]
+    eps_bin_lims = job_ctxt[job_cfg.EPS_BIN_LIMITS]
+    dist_bin_lims = job_ctxt[job_cfg.DIST_BIN_LIMITS]
+
+    results = []
+    for poe, matrix_result in zip(poes, matrix_results):
+        gmv = matrix_result.getGMV()
+        matrix = numpy.array(matrix_result.getMatrix())
+        if consolidated:
+            site_subsets = subsets.compute_subsets(
+                site, matrix, lat_bin_lims, lon_bin_lims, mag_bin_lims,
+                eps_bin_lims, dist_bin_lims, subset_types)
+            store.write_to_shard(
+                result_dir, realization, poe, [site], [gmv],
+                dict((subset_type, [subset])
+                     for subset_type, subset in site_subsets.iteritems()))
+            subsets_path = store.store_path(result_dir, realization, poe)
+        else:
+            subsets_path = subsets_file_path(result_dir, realization, gmv,
+                                             site)
+            subsets.save_subsets(
+                site, matrix, lat_bin_lims, lon_bin_lims, mag_bin_lims,
+                eps_bin_lims, dist_bin_lims, subsets_path, subset_types)
+        results.append((gmv, subsets_path))
+
+    return results
+
+
+def subsets_file_path(result_dir, realization, gmv, site):
+    """Return the path of the file holding the matrix subsets of a site, for
+    the given realization and ground motion value.
+
+    >>> from openquake.shapes import Site
+    >>> subsets_file_path('/tmp', 1, 0.2257, Site(0.0, 0.0))
+    '/tmp/disagg-results-sample:1-gmv:0.2257000-lat:0.0000000-lon:0.0000000.h5'
+    """
+    subset_file = 'disagg-results-sample:%s-gmv:%.7f-lat:%.7f-lon:%.7f.h5'
+    subset_file %= (realization, gmv, site.latitude, site.longitude)
+    return os.path.join(result_dir, subset_file)
+
+
+def _disagg_inputs(job_ctxt, site, realization=None):
+    """Build the Java DisaggregationCalculator, the ERF and the GMPE map of
+    the job (realization) and the site parameters used to compute the
+    disaggregation matrices of a site.
+
+    See :func:`compute_disagg_matrix` for the parameters.
+
+    :returns: a tuple (disagg_calc, erf, gmpe_map, imls, site_params), where
+        site_params is the tuple (vs30_type, vs30, z1pt0, z2pt5)
+    """
     lat_bin_lims = job_ctxt[job_cfg.LAT_BIN_LIMITS]
     lon_bin_lims = job_ctxt[job_cfg.LON_BIN_LIMITS]
     mag_bin_lims = job_ctxt[job_cfg.MAG_BIN_LIMITS]
@@ -79,37 +230,20 @@ def compute_disagg_matrix(job_ctxt, site, poe, result_dir):
         config.get('kvs', 'host'),
         int(config.get('kvs', 'port')))
 
-    erf = general.generate_erf(job_ctxt.job_id, cache)
-    gmpe_map = general.generate_gmpe_map(job_ctxt.job_id, cache)
+    src_key = gmpe_key = None
+    if realization is not None:
+        src_key = kvs.tokens.source_model_key(job_ctxt.job_id, realization)
+        gmpe_key = kvs.tokens.gmpe_key(job_ctxt.job_id, realization)
+
+    erf = general.generate_erf(job_ctxt.job_id, cache, src_key)
+    gmpe_map = general.generate_gmpe_map(job_ctxt.job_id, cache, gmpe_key)
     general.set_gmpe_params(gmpe_map, job_ctxt.params)
 
     imls = general.get_iml_list(job_ctxt['INTENSITY_MEASURE_LEVELS'],
                                 job_ctxt['INTENSITY_MEASURE_TYPE'])
 
-    site_model = general.get_site_model(job_ctxt.oq_job.id)
-
-    if site_model is not None:
-        sm_data = general.get_closest_site_model_data(site_model, site)
-        vs30_type = sm_data.vs30_type.capitalize()
-        vs30 = sm_data.vs30
-        z1pt0 = sm_data.z1pt0
-        z2pt5 = sm_data.z2pt5
-    else:
-        jp = job_ctxt.oq_job_profile
-
-        vs30_type = jp.vs30_type.capitalize()
-        vs30 = jp.reference_vs30_value
-        z1pt0 = jp.depth_to_1pt_0km_per_sec
-        z2pt5 = jp.reference_depth_to_2pt5km_per_sec_param
-
-    matrix_result = _compute_matrix(
-        disagg_calc, site.latitude, site.longitude, erf, gmpe_map, poe, imls,
-        vs30_type, vs30, z1pt0, z2pt5)
-
-    matrix_path = save_5d_matrix_to_h5(result_dir,
-                                       numpy.array(matrix_result.getMatrix()))
-
-    return (matrix_result.getGMV(), matrix_path)
+    return (disagg_calc, erf, gmpe_map, imls,
+            general.site_parameters(job_ctxt, [site])[0])
 
 
 # Disabling 'Too many arguments'
@@ -156,6 +290,23 @@ def _compute_matrix(calc, lat, lon, erf, gmpe_map, poe, imls, vs30_type, vs30,
         lat, lon, erf, gmpe_map, poe, imls, vs30_type, vs30, z1pt0, z2pt5)
 
 
+def _compute_matrices(calc, lat, lon, erf, gmpe_map, poes, imls, vs30_type,
+                      vs30, z1pt0, z2pt5):
+    """Helper function for executing `computeMatrices` in the java
+    calculator, computing the matrices of several PoEs at once.
+
+    See :func:`_compute_matrix` for the parameters; `poes` is a list of
+    Probability of Exceedence values.
+
+    :returns:
+        list of jpype `org.gem.calc.DisaggregationResult` objects, one for
+        each PoE.
+    """
+    return list(calc.computeMatrices(
+        lat, lon, erf, gmpe_map, java.array_to_jdouble_array(poes), imls,
+        vs30_type, vs30, z1pt0, z2pt5))
+
+
 def save_5d_matrix_to_h5(directory, matrix):
     """Save a full disaggregation matrix to the specified directory with a
     random unique filename (using uuid).
@@ -206,7 +357,44 @@ def compute_disagg_matrix_task(job_id, realization, poe, result_dir, site):
     log_msg %= (job_ctxt.job_id, site, realization, poe, result_dir)
     LOG.info(log_msg)
 
-    return compute_disagg_matrix(job_ctxt, site, poe, result_dir)
+    return compute_disagg_matrix(job_ctxt, site, poe, result_dir, realization)
+
+
+@task
+@java.unpack_exception
+@stats.count_progress("h", data_arg="site")
+def compute_disagg_subsets_task(job_id, realization, poes, result_dir,
+                                subset_types, site, consolidated=False):
+    """Compute the complete 5D Disaggregation matrices of a site for all the
+    PoEs and extract the matrix subsets from them, in a single task (see
+    :func:`compute_disagg_subsets`).
+
+    :param job_id: id of the calculation record in the KVS
+    :type job_id: `str`
+    :param int realization: logic tree sample iteration number
+    :param poes: Probabilities of Exceedence
+    :type poes: list of floats
+    :param result_dir: location where the subsets files are saved (in a
+        distributed environment, this should be the path of a mounted NFS)
+    :param subset_types: the matrix subset results requested in the job
+        config
+    :param site: a single site of interest
+    :type site: :class:`openquake.shapes.Site` instance`
+    :param bool consolidated: write to the consolidated store
+
+    :returns: a list of 2-tuples of (ground_motion_value,
+        path_to_h5_subsets_file), one for each PoE
+    """
+    job_ctxt = get_running_job(job_id)
+
+    log_msg = (
+        "Computing disaggregation matrix subsets for job_id=%s, site=%s, "
+        "realization=%s, PoEs=%s. Subsets will be serialized to `%s`.")
+    log_msg %= (job_ctxt.job_id, site, realization, poes, result_dir)
+    LOG.info(log_msg)
+
+    return compute_disagg_subsets(job_ctxt, site, poes, realization,
+                                  result_dir, subset_types, consolidated)
 
 
 class DisaggHazardCalculator(general.BaseHazardCalculator):
@@ -223,6 +411,15 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
     3) Finally, the jobber collects the calculation results (including paths to
         matrix subset files) and serializes a set of NRML files to represent
         the final output.
+
+    When the `disagg_fused_subsets` flag is set in openquake.cfg, steps 1)
+    and 2) are performed by the same tasks, which extract the subsets from
+    the matrix in memory: the full matrices are neither written nor read
+    back. One task is created per site per realization, computing the
+    matrices of all the PoE values in a single pass. With the
+    `disagg_consolidated_store` flag the subsets of all the sites of a
+    (realization, PoE) pair are stored in a single file (see
+    :mod:`openquake.calculators.hazard.disagg.store`).
     """
 
     @general.preload
@@ -236,7 +433,13 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
         3) Distribute full disaggregation matrix computation to workers.
         4) Distribute matrix subset extraction (using full disagg. results as
             input.
-        5) Finally, write an NRML/XML wrapper around the disagg. results.
+        5) Finally, write an NRML/XML wrapper around the disagg. results
+            (and around their mean across the realizations, if
+            COMPUTE_MEAN_DISAGGREGATION is set).
+
+        Steps 3) to 5) overlap: the task results are collected as the tasks
+        complete, and the NRML file of a (realization, PoE) pair is written
+        as soon as all its sites are computed.
         """
         # matrix results for this job will go here:
         result_dir = DisaggHazardCalculator.create_result_dir(
@@ -253,13 +456,23 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
         log_msg %= (self.job_ctxt.job_id, len(sites), realizations, poes)
         LOG.info(log_msg)
 
-        full_disagg_results = self.distribute_disagg(sites, realizations, poes,
-                                                     result_dir)
-
         subset_types = self.job_ctxt['DISAGGREGATION_RESULTS']
 
-        subset_results = self.distribute_subsets(full_disagg_results,
-                                                 subset_types, result_dir)
+        if config.flag_set("hazard", "disagg_fused_subsets"):
+            subset_results = self.distribute_disagg_subsets(
+                sites, realizations, poes, result_dir, subset_types)
+        else:
+            # the matrix and the subset extraction tasks share the budget
+            pipeline = TaskPipeline(config.hazard_disagg_tasks_in_flight())
+            full_disagg_results = self.distribute_disagg(
+                sites, realizations, poes, result_dir, pipeline)
+            subset_results = self.distribute_subsets(
+                full_disagg_results, subset_types, result_dir, sites,
+                pipeline)
+
+        if self.job_ctxt['COMPUTE_MEAN_DISAGGREGATION']:
+            subset_results = self.with_mean_subsets(
+                subset_results, sites, realizations, subset_types, result_dir)
 
         DisaggHazardCalculator.serialize_nrml(self.job_ctxt, subset_types,
                                               subset_results)
@@ -294,14 +507,46 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
                 raise
         return output_path
 
-    def distribute_disagg(self, sites, realizations, poes, result_dir):
+    def _store_models(self, realizations):
+        """Store the source model and the GMPE model of each realization in
+        the KVS (so the Java code can access them), under keys of their own:
+        the tasks of several realizations may be running at the same time.
+        Yield the realization numbers (1 to N, inclusive) once the models
+        are stored.
+        """
+        src_model_rnd = random.Random()
+        src_model_rnd.seed(self.job_ctxt['SOURCE_MODEL_LT_RANDOM_SEED'])
+        gmpe_rnd = random.Random()
+        gmpe_rnd.seed(self.job_ctxt['GMPE_LT_RANDOM_SEED'])
+
+        job_id = self.job_ctxt.job_id
+        for rlz in xrange(1, realizations + 1):
+            general.store_source_model(
+                job_id, src_model_rnd.getrandbits(32), self.job_ctxt.params,
+                self.calc, kvs.tokens.source_model_key(job_id, rlz))
+            general.store_gmpe_map(
+                job_id, gmpe_rnd.getrandbits(32), self.calc,
+                kvs.tokens.gmpe_key(job_id, rlz))
+            yield rlz
+
+    def _delete_models(self, realization):
+        """Remove the source model and the GMPE model of a realization from
+        the KVS."""
+        job_id = self.job_ctxt.job_id
+        kvs.get_client().delete(
+            kvs.tokens.source_model_key(job_id, realization),
+            kvs.tokens.gmpe_key(job_id, realization))
+
+    def distribute_disagg(self, sites, realizations, poes, result_dir,
+                          pipeline=None):
         """Compute disaggregation by splitting up the calculation over sites,
         realizations, and PoE values.
 
-        :param the_job:
-            JobContext definition
-        :type the_job:
-            :class:`openquake.engine.JobContext` instance
+        At most `disagg_tasks_in_flight` (see openquake.cfg) tasks are
+        running at any time, and the results are yielded as the tasks
+        complete. The models of a realization are stored when its first
+        task is submitted and deleted when its last task completes.
+
         :param sites:
             List of :class:`openquake.shapes.Site` objects
         :param poes:
@@ -310,90 +555,140 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
             List of floats
         :param result_dir:
             Path where full disaggregation results should be stored
+        :param pipeline:
+            The :class:`~openquake.utils.tasks.TaskPipeline` running the
+            tasks, to share its budget with the subset extraction tasks (see
+            :meth:`DisaggHazardCalculator.distribute_subsets`)
         :returns:
-            Result data in the following form::
-                [(realization_1, poe_1,
-                  [(site_1, gmv_1, matrix_path_1),
-                   (site_2, gmv_2, matrix_path_2)]
-                 ),
-                 (realization_1, poe_2,
-                  [(site_1, gmv_1, matrix_path_3),
-                   (site_2, gmv_2, matrix_path_4)]
-                 ),
-                 ...
-                 (realization_N, poe_N,
-                  [(site_1, gmv_1, matrix_path_N-1),
-                   (site_2, gmv_2, matrix_path_N)]
-                 ),
-                ]
-
-            A single matrix result in this form looks like this::
-                [(1, 0.1,
-                  [(Site(0.0, 0.0), 0.2257,
-                    '/var/lib/openquake/disagg-results/job-372/some_guid.h5'),]
-                 ),
-                ]
+            A generator of the results of the single sites, in completion
+            order, in the following form::
+                (realization, poe, site_index, (site, gmv, matrix_path))
+
+            where `site_index` is the position of the site in `sites`. A
+            single matrix result in this form looks like this::
+                (1, 0.1, 0,
+                 (Site(0.0, 0.0), 0.2257,
+                  '/var/lib/openquake/disagg-results/job-372/some_guid.h5'))
         """
-        # accumulates the final results of this method
-        full_da_results = []
-
-        # accumulates task data across the realization and poe loops
-        task_data = []
+        # number of tasks of each realization yet to complete
+        remaining = dict()
+
+        def submissions():
+            for rlz in self._store_models(realizations):
+                remaining[rlz] = len(poes) * len(sites)
+                for poe in poes:
+                    for index, site in enumerate(sites):
+                        submit = functools.partial(
+                            compute_disagg_matrix_task.delay,
+                            self.job_ctxt.job_id, rlz, poe, result_dir,
+                            site=site)
+                        yield submit, (rlz, poe, index, site)
+
+        if pipeline is None:
+            pipeline = TaskPipeline(config.hazard_disagg_tasks_in_flight())
+
+        for a_task, (rlz, poe, index, site) in pipeline.run(submissions()):
+            if not a_task.successful():
+                msg = (
+                    "Full Disaggregation matrix computation task"
+                    " for job %s with task_id=%s, realization=%s, PoE=%s,"
+                    " site=%s has failed with the following error: %s")
+                msg %= (
+                    self.job_ctxt.job_id, a_task.task_id, rlz, poe,
+                    site, a_task.result)
+                LOG.critical(msg)
+                raise RuntimeError(msg)
+
+            logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
+            remaining[rlz] -= 1
+            if not remaining[rlz]:
+                self._delete_models(rlz)
+
+            gmv, matrix_path = a_task.result
+            yield rlz, poe, index, (site, gmv, matrix_path)
+
+    def distribute_disagg_subsets(self, sites, realizations, poes, result_dir,
+                                  subset_types):
+        """Compute disaggregation and extract the matrix subsets, splitting
+        up the calculation over sites and realizations: each task computes
+        the matrices of all the PoE values (see
+        :func:`compute_disagg_subsets`).
+
+        As in :meth:`DisaggHazardCalculator.distribute_disagg`, at most
+        `disagg_tasks_in_flight` tasks are running at any time and the
+        results are collected as the tasks complete.
 
-        src_model_rnd = random.Random()
-        src_model_rnd.seed(self.job_ctxt['SOURCE_MODEL_LT_RANDOM_SEED'])
-        gmpe_rnd = random.Random()
-        gmpe_rnd.seed(self.job_ctxt['GMPE_LT_RANDOM_SEED'])
-
-        for rlz in xrange(1, realizations + 1):  # 1 to N, inclusive
-            # cache the source model and gmpe model in the KVS
-            # so the Java code can access it
-            general.store_source_model(self.job_ctxt.job_id,
-                                       src_model_rnd.getrandbits(32),
-                                       self.job_ctxt.params, self.calc)
-            general.store_gmpe_map(
-                self.job_ctxt.job_id, gmpe_rnd.getrandbits(32), self.calc)
-
-            for poe in poes:
-                task_site_pairs = []
-                for site in sites:
-                    a_task = compute_disagg_matrix_task.delay(
-                        self.job_ctxt.job_id, rlz, poe, result_dir, site=site)
-
-                    task_site_pairs.append((a_task, site))
-
-                task_data.append((rlz, poe, task_site_pairs))
-
-        for rlz, poe, task_site_pairs in task_data:
-            # accumulates all data for a given (realization, poe) pair
-            rlz_poe_data = []
-            for a_task, site in task_site_pairs:
-                a_task.wait()
+        :param sites:
+            List of :class:`openquake.shapes.Site` objects
+        :param poes:
+            Probability of Exceedence levels for the calculation
+        :type poes:
+            List of floats
+        :param result_dir:
+            Path where the subset results should be stored
+        :param subset_types:
+            The matrix subset results requested in the job config.
+        :returns:
+            A generator of subset result data, in the form returned by
+            :meth:`DisaggHazardCalculator.distribute_subsets` (all the paths
+            of a (realization, PoE) pair being the one of its store file
+            with the `disagg_consolidated_store` flag).
+        """
+        consolidated = config.flag_set("hazard", "disagg_consolidated_store")
+
+        # number of tasks of each realization yet to complete
+        remaining = dict()
+
+        def submissions():
+            for rlz in self._store_models(realizations):
+                remaining[rlz] = len(sites)
+                for index, site in enumerate(sites):
+                    submit = functools.partial(
+                        compute_disagg_subsets_task.delay,
+                        self.job_ctxt.job_id, rlz, poes, result_dir,
+                        subset_types, site=site, consolidated=consolidated)
+                    yield submit, (rlz, index, site)
+
+        def site_results():
+            pipeline = TaskPipeline(config.hazard_disagg_tasks_in_flight())
+            for a_task, (rlz, index, site) in pipeline.run(submissions()):
                 if not a_task.successful():
                     msg = (
-                        "Full Disaggregation matrix computation task"
-                        " for job %s with task_id=%s, realization=%s, PoE=%s,"
-                        " site=%s has failed with the following error: %s")
+                        "Disaggregation matrix subsets computation task"
+                        " for job %s with task_id=%s, realization=%s,"
+                        " PoEs=%s, site=%s has failed with the following"
+                        " error: %s")
                     msg %= (
-                        self.job_ctxt.job_id, a_task.task_id, rlz, poe,
+                        self.job_ctxt.job_id, a_task.task_id, rlz, poes,
                         site, a_task.result)
                     LOG.critical(msg)
                     raise RuntimeError(msg)
-                else:
-                    gmv, matrix_path = a_task.result
-                    rlz_poe_data.append((site, gmv, matrix_path))
+
                 logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
+                remaining[rlz] -= 1
+                if not remaining[rlz]:
+                    self._delete_models(rlz)
 
-            full_da_results.append((rlz, poe, rlz_poe_data))
+                for poe, (gmv, subsets_path) in zip(poes, a_task.result):
+                    yield rlz, poe, index, (site, gmv, subsets_path)
 
-        return full_da_results
+        for rlz, poe, rlz_poe_data in _by_realization_and_poe(
+                site_results(), len(sites)):
+            if consolidated:
+                store.merge_shards(result_dir, rlz, poe, sites)
+            yield rlz, poe, rlz_poe_data
 
     def distribute_subsets(self, full_disagg_results, subset_types,
-                           target_dir):
+                           target_dir, sites, pipeline=None):
         """Given the results of the first phase of the disaggregation
         calculation, extract the matrix subsets (as requested in the job
         configuration).
 
+        The extraction tasks are queued as the full disaggregation results
+        come in, as follow-up tasks of `pipeline` (a new one by default),
+        and the subsets of a (realization, PoE) pair are yielded as soon as
+        all its sites are extracted.
+
         :param full_disagg_results:
             Results of :method:`DisaggHazardCalculator.distribute_disagg`.
         :param subset_types:
@@ -401,30 +696,26 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
         :param target_dir:
             Directory where subset matrix results should be stored (a directory
             connected to an NFS, for example).
+        :param sites:
+            List of :class:`openquake.shapes.Site` objects
+        :param pipeline:
+            The :class:`~openquake.utils.tasks.TaskPipeline` running the
+            tasks of `full_disagg_results`, if any
 
         :returns:
-            Subset result data in the following form::
-                [(realization_1, poe_1,
-                  [(site_1, gmv_1, matrix_path_1),
-                   (site_2, gmv_2, matrix_path_2)]
-                 ),
-                 (realization_1, poe_2,
-                  [(site_1, gmv_1, matrix_path_3),
-                   (site_2, gmv_2, matrix_path_4)]
-                 ),
-                 ...
-                 (realization_N, poe_N,
-                  [(site_1, gmv_1, matrix_path_N-1),
-                   (site_2, gmv_2, matrix_path_N)]
-                 ),
-                ]
-
-            A single matrix result in this form looks like this::
-                [(1, 0.1,
-                  [(Site(0.0, 0.0), 0.2257,
-                   'disagg-results-sample:1-gmv:0.2257-lat:0.0-lon:0.0.h5'),]
-                 ),
-                ]
+            A generator of subset result data, in completion order, in the
+            following form::
+                (realization, poe,
+                 [(site_1, gmv_1, matrix_path_1),
+                  (site_2, gmv_2, matrix_path_2)]
+                )
+
+            with the data in the order of `sites`. A single matrix result in
+            this form looks like this::
+                (1, 0.1,
+                 [(Site(0.0, 0.0), 0.2257,
+                  'disagg-results-sample:1-gmv:0.2257-lat:0.0-lon:0.0.h5'),]
+                )
         """
         lat_bin_lims = self.job_ctxt[job_cfg.LAT_BIN_LIMITS]
         lon_bin_lims = self.job_ctxt[job_cfg.LON_BIN_LIMITS]
@@ -432,51 +723,92 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
         eps_bin_lims = self.job_ctxt[job_cfg.EPS_BIN_LIMITS]
         dist_bin_lims = self.job_ctxt[job_cfg.DIST_BIN_LIMITS]
 
-        rlz_poe_task_data = []
-
-        for rlz, poe, data_list in full_disagg_results:
-            task_data = []
-            for site, gmv, matrix_path in data_list:
-
-                subset_file = (
-                    'disagg-results-sample:%s-gmv:%.7f-lat:%.7f-lon:%.7f.h5')
-                subset_file %= (rlz, gmv, site.latitude, site.longitude)
-                target_file = os.path.join(target_dir, subset_file)
-
-                a_task = subsets.extract_subsets.delay(
-                    self.job_ctxt.job_id, site, matrix_path, lat_bin_lims,
-                    lon_bin_lims, mag_bin_lims, eps_bin_lims, dist_bin_lims,
-                    target_file, subset_types)
-
-                task_data.append((a_task, site, gmv, matrix_path, target_file))
+        if pipeline is None:
+            pipeline = TaskPipeline(config.hazard_disagg_tasks_in_flight())
+
+        def extracted(a_task, (rlz, poe, index, site, gmv, matrix_path,
+                               target_file)):
+            """Check an extraction task and return its site result."""
+            if not a_task.successful():
+                msg = (
+                    "Matrix subset extraction task for job %s with"
+                    " task_id=%s, realization=%s, PoE=%s, target_file=%s"
+                    " has failed with the following error: %s")
+                msg %= (self.job_ctxt.job_id, a_task.task_id, rlz, poe,
+                        target_file, a_task.result)
+                LOG.critical(msg)
+                raise RuntimeError(msg)
+
+            # We don't need the full matrix file anymore.
+            os.unlink(matrix_path)
+
+            return rlz, poe, index, (site, gmv, target_file)
+
+        def site_results():
+            for rlz, poe, index, (site, gmv, matrix_path) in (
+                    full_disagg_results):
+                target_file = subsets_file_path(target_dir, rlz, gmv, site)
+
+                pipeline.follow_up(
+                    functools.partial(
+                        subsets.extract_subsets.delay,
+                        self.job_ctxt.job_id, site, matrix_path,
+                        lat_bin_lims, lon_bin_lims, mag_bin_lims,
+                        eps_bin_lims, dist_bin_lims, target_file,
+                        subset_types),
+                    (rlz, poe, index, site, gmv, matrix_path, target_file))
+
+                for a_task, context in pipeline.follow_ups():
+                    yield extracted(a_task, context)
+
+            for a_task, context in pipeline.follow_ups(wait=True):
+                yield extracted(a_task, context)
+
+        return _by_realization_and_poe(site_results(), len(sites))
+
+    def with_mean_subsets(self, subsets_data, sites, realizations,
+                          subset_types, result_dir):
+        """Pass the subset results of the realizations through, adding the
+        mean subsets across the realizations of each PoE value as soon as
+        all the realizations of the PoE have come in.
 
-            rlz_poe_task_data.append((rlz, poe, task_data))
-
-        final_results = []
-
-        for rlz, poe, task_data in rlz_poe_task_data:
-            rlz_poe_results = []  # list of data/results per (rlz, poe) pair
-            for a_task, site, gmv, matrix_path, target_file in task_data:
+        :param subsets_data:
+            Results of :meth:`DisaggHazardCalculator.distribute_subsets`.
+        :param sites:
+            List of :class:`openquake.shapes.Site` objects
+        :param int realizations:
+            The number of logic tree realizations.
+        :param subset_types:
+            The matrix subset results requested in the job config.
+        :param result_dir:
+            Path where the mean subset results should be stored
+        :returns:
+            A generator of subset result data, in the form of `subsets_data`,
+            the mean results having
+            :const:`openquake.calculators.hazard.disagg.mean.MEAN` as
+            realization.
+        """
+        consolidated = (
+            config.flag_set("hazard", "disagg_fused_subsets")
+            and config.flag_set("hazard", "disagg_consolidated_store"))
 
-                a_task.wait()
-                if not a_task.successful():
-                    msg = (
-                        "Matrix subset extraction task for job %s with"
-                        " task_id=%s, realization=%s, PoE=%s, target_file=%s"
-                        " has failed with the following error: %s")
-                    msg %= (self.job_ctxt.job_id, a_task.task_id, poe,
-                            target_file, a_task.result)
-                    LOG.critical(msg)
-                    raise RuntimeError(msg)
-                else:
-                    rlz_poe_results.append((site, gmv, target_file))
+        # poe -> running sum of the subsets of the realizations computed
+        # so far
+        sums = dict()
 
-                # We don't need the full matrix file anymore.
-                os.unlink(matrix_path)
+        for rlz, poe, data in subsets_data:
+            yield rlz, poe, data
 
-            final_results.append((rlz, poe, rlz_poe_results))
+            if poe not in sums:
+                sums[poe] = mean.MeanSubsets(sites, subset_types,
+                                             consolidated)
+            sums[poe].add(data)
 
-        return final_results
+            if sums[poe].count == realizations:
+                LOG.info("Computing the mean disaggregation for job=%s,"
+                         " PoE=%s" % (self.job_ctxt.job_id, poe))
+                yield mean.MEAN, poe, sums.pop(poe).save(
+                    result_dir, poe, subsets_file_path)
 
     @staticmethod
     def serialize_nrml(the_job, subset_types, subsets_data):
@@ -489,7 +821,9 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
         :param subset_types:
             The matrix subset results requested in the job config.
         :param subsets_data:
-            Results of :method:`DisaggHazardCalculator.distribute_subsets`.
+            Results of :method:`DisaggHazardCalculator.distribute_subsets`;
+            the NRML file of a (realization, PoE) pair is written as soon as
+            its data is available.
         """
         LOG.info("Serializing XML results for job=%s" % the_job.job_id)
         imt = the_job['INTENSITY_MEASURE_TYPE']
@@ -507,8 +841,13 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
             file_name %= (rlz, poe)
             path = os.path.join(base_output_dir, file_name)
             LOG.info("Serializing XML results to %s" % path)
-            writer = hazard_output.DisaggregationBinaryMatrixXMLWriter(
-                path, poe, imt, subset_types, end_branch_label=rlz)
+            if rlz == mean.MEAN:
+                writer = hazard_output.DisaggregationBinaryMatrixXMLWriter(
+                    path, poe, imt, subset_types, statistics=mean.MEAN,
+                    comment=mean.GMV_NOTE)
+            else:
+                writer = hazard_output.DisaggregationBinaryMatrixXMLWriter(
+                    path, poe, imt, subset_types, end_branch_label=rlz)
 
             writer.open()
 
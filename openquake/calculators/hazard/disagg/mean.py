@@ -0,0 +1,141 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Mean of the disaggregation matrix subsets across the logic tree
+realizations.
+
+All the subsets are marginal sums of the full disaggregation matrix, so the
+mean of the subsets of the realizations is the subsets of the mean matrix:
+the subsets (rather than the full matrices) of each realization are added
+to a running sum as the results of the realization come in. Only the sums
+of the PoEs not yet computed for all the realizations are kept in memory,
+whatever the number of realizations.
+
+The logic tree realizations are randomly sampled, hence they all have the
+same weight.
+
+The subsets of a realization are computed at the ground motion value of its
+PoE, which differs across the realizations: the ground motion value of the
+mean results is the mean of the ones of the realizations, and the mean
+subsets are not the subsets at that value. The NRML files of the mean
+results say so (see :data:`GMV_NOTE`).
+"""
+
+import h5py
+import numpy
+
+from openquake.calculators.hazard.disagg import store
+from openquake.calculators.hazard.disagg.subsets import DATA_TYPE
+
+#: The label of the mean results, in place of the realization number.
+MEAN = 'mean'
+
+#: The comment of the NRML files of the mean results.
+GMV_NOTE = (
+    "statistics=mean: each groundMotionValue is the mean of the ground "
+    "motion values of the realizations; the subsets are the mean of the "
+    "subsets of the realizations, each computed at its own ground motion "
+    "value, not the subsets at the mean ground motion value")
+
+
+class MeanSubsets(object):
+    """Running sum of the subsets of the sites of a PoE value, across the
+    logic tree realizations.
+
+    :param sites: the :class:`openquake.shapes.Site` instances of the
+        calculation.
+    :param subset_types: the matrix subset results requested in the job
+        config.
+    :param bool consolidated: `True` if the subsets of all the sites are
+        stored in a single file (see
+        :mod:`openquake.calculators.hazard.disagg.store`).
+    """
+
+    def __init__(self, sites, subset_types, consolidated=False):
+        self.sites = sites
+        self.subset_types = subset_types
+        self.consolidated = consolidated
+        self.count = 0
+        self.gmvs = numpy.zeros(len(sites), dtype=DATA_TYPE)
+        # subset type -> [site, ...] array, allocated with the first subset
+        self.sums = dict()
+
+    def add(self, data):
+        """Add the subsets of a realization to the sums.
+
+        :param data: the `[(site, gmv, subsets_path)]` list of a
+            realization, in site order, as yielded by
+            :meth:`DisaggHazardCalculator.distribute_subsets` (see
+            :mod:`openquake.calculators.hazard.disagg.core`).
+        """
+        self.gmvs += [gmv for _, gmv, _ in data]
+
+        if self.consolidated:
+            with h5py.File(data[0][2], 'r') as subsets_file:
+                for subset_type in self.subset_types:
+                    self._add(subset_type, slice(None),
+                              subsets_file[subset_type][:])
+        else:
+            for index, (_, _, subsets_path) in enumerate(data):
+                with h5py.File(subsets_path, 'r') as subsets_file:
+                    for subset_type in self.subset_types:
+                        self._add(subset_type, index,
+                                  subsets_file[subset_type][:])
+
+        self.count += 1
+
+    def _add(self, subset_type, index, value):
+        """Add the subset(s) of the site(s) with the given index (or slice)
+        to the sum of the subset type."""
+        if subset_type not in self.sums:
+            shape = numpy.shape(value)
+            if isinstance(index, slice):
+                shape = shape[1:]
+            self.sums[subset_type] = numpy.zeros(
+                (len(self.sites),) + shape, dtype=DATA_TYPE)
+        self.sums[subset_type][index] += value
+
+    def save(self, result_dir, poe, file_path):
+        """Save the mean subsets, in the same layout as the ones of the
+        realizations.
+
+        :param file_path: the function returning the path of the subsets
+            file of a site when they are stored in a file per site, called
+            with the same arguments as
+            :func:`openquake.calculators.hazard.disagg.core.subsets_file_path`.
+        :returns: the `[(site, mean_gmv, subsets_path)]` list of the mean
+            subsets, in site order.
+        """
+        gmvs = self.gmvs / self.count
+        means = dict((subset_type, total / self.count)
+                     for subset_type, total in self.sums.iteritems())
+
+        if self.consolidated:
+            path = store.write_store(
+                result_dir, MEAN, poe, self.sites, gmvs, means)
+            return [(site, float(gmv), path)
+                    for site, gmv in zip(self.sites, gmvs)]
+
+        data = []
+        for index, (site, gmv) in enumerate(zip(self.sites, gmvs)):
+            gmv = float(gmv)
+            path = file_path(result_dir, MEAN, gmv, site)
+            with h5py.File(path, 'w') as target:
+                for subset_type, mean in means.iteritems():
+                    target.create_dataset(subset_type, data=mean[index])
+            data.append((site, gmv, path))
+        return data
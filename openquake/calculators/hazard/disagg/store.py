@@ -0,0 +1,265 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Consolidated storage of the disaggregation matrix subsets.
+
+Instead of a file per (realization, PoE, site), the subsets of all the
+sites of a (realization, PoE) pair are stored in a single HDF5 file, with a
+dataset per subset type of shape ``[site, ...]``, chunked by site and
+compressed, so that the subsets of a site are read without loading the
+whole file. The ``lons``, ``lats`` and ``gmvs`` datasets hold the
+coordinates and the ground motion value of each site.
+
+HDF5 files cannot be written concurrently: each worker process appends the
+subsets it computes to its own shard file, and the shards of a (realization,
+PoE) pair are merged into the store file by the job executor once all the
+sites are computed.
+"""
+
+import os
+import socket
+
+import h5py
+import numpy
+
+from openquake.calculators.hazard.disagg.subsets import DATA_TYPE
+
+#: Compression filter of the subset datasets ('gzip' or 'lzf').
+COMPRESSION = 'gzip'
+
+#: Number of rows of a shard read at once when merging the shards.
+MERGE_BLOCK_SIZE = 64
+
+LONS = 'lons'
+LATS = 'lats'
+GMVS = 'gmvs'
+
+
+def store_path(result_dir, realization, poe):
+    """Return the path of the store file of a (realization, PoE) pair.
+
+    >>> store_path('/tmp', 1, 0.1)
+    '/tmp/disagg-results-sample:1-PoE:0.1.h5'
+    """
+    return os.path.join(
+        result_dir, 'disagg-results-sample:%s-PoE:%s.h5' % (realization, poe))
+
+
+def _shard_prefix(result_dir, realization, poe):
+    """The path of the shard files of a (realization, PoE) pair, without
+    the worker id."""
+    return store_path(result_dir, realization, poe)[:-len('.h5')] + '-shard:'
+
+
+def shard_path(result_dir, realization, poe):
+    """Return the path of the shard file of the current worker process for
+    a (realization, PoE) pair."""
+    return '%s%s-%s.h5' % (_shard_prefix(result_dir, realization, poe),
+                           socket.gethostname(), os.getpid())
+
+
+def _append(h5file, name, values, compression=None):
+    """Append the rows of `values` to a dataset resizable along its first
+    axis, creating it if needed (chunked by row), with a single resize."""
+    values = numpy.asarray(values, dtype=DATA_TYPE)
+    shape = values.shape[1:]
+    if name not in h5file:
+        h5file.create_dataset(
+            name, shape=(0,) + shape, dtype=DATA_TYPE,
+            maxshape=(None,) + shape, chunks=(1,) + shape,
+            compression=compression)
+    dataset = h5file[name]
+    size = len(dataset)
+    dataset.resize(size + len(values), axis=0)
+    dataset[size:] = values
+
+
+def write_to_shard(result_dir, realization, poe, sites, gmvs, subsets):
+    """Append the subsets of the given sites to the shard file of the
+    current worker process, opening it once.
+
+    :param sites: :class:`openquake.shapes.Site` instances.
+    :param gmvs: the ground motion values of the sites for the PoE.
+    :param subsets: a dict mapping the subset types to the `[site, ...]`
+        arrays of the subsets (as returned by
+        :func:`openquake.calculators.hazard.disagg.subsets.compute_subsets`
+        for each site), in the order of `sites`.
+    """
+    with h5py.File(shard_path(result_dir, realization, poe), 'a') as shard:
+        _append(shard, LONS, [site.longitude for site in sites])
+        _append(shard, LATS, [site.latitude for site in sites])
+        _append(shard, GMVS, gmvs)
+        for subset_type, subset in subsets.iteritems():
+            _append(shard, subset_type, subset, compression=COMPRESSION)
+
+
+def _create_locations(store, sites, gmvs):
+    """Create the datasets of the coordinates and of the ground motion
+    values of the sites in a store file."""
+    store.create_dataset(
+        LONS, data=numpy.array([s.longitude for s in sites], dtype=DATA_TYPE))
+    store.create_dataset(
+        LATS, data=numpy.array([s.latitude for s in sites], dtype=DATA_TYPE))
+    store.create_dataset(GMVS, data=numpy.array(gmvs, dtype=DATA_TYPE))
+
+
+def write_store(result_dir, realization, poe, sites, gmvs, subsets):
+    """Write the store file of a (realization, PoE) pair, the subsets of
+    all the sites being available.
+
+    :param gmvs: the ground motion values of the sites.
+    :param subsets: a dict mapping the subset types to the `[site, ...]`
+        arrays of the subsets, in the order of `sites`.
+    :returns: the path of the store file.
+    """
+    path = store_path(result_dir, realization, poe)
+    with h5py.File(path, 'w') as store:
+        _create_locations(store, sites, gmvs)
+        for subset_type, subset in subsets.iteritems():
+            store.create_dataset(
+                subset_type, data=numpy.asarray(subset, dtype=DATA_TYPE),
+                chunks=(1,) + numpy.shape(subset)[1:],
+                compression=COMPRESSION)
+    return path
+
+
+def _subset_types(shard):
+    """The subset types stored in a shard (or store) file."""
+    return sorted(name for name in shard if name not in (LONS, LATS, GMVS))
+
+
+def _shard_positions(shards, sites, realization, poe):
+    """Return, for each shard, the positions in `sites` of its rows; -1 for
+    the rows not to be copied: the ones of other sites and the ones
+    superseded by a later row of the same site (computed twice by retried
+    tasks).
+
+    :raises: :exc:`RuntimeError` if the shards do not hold the same subset
+        types or if some sites are missing.
+    """
+    if not shards:
+        raise RuntimeError(
+            "No disaggregation shard files for realization %s, PoE %s"
+            % (realization, poe))
+    subset_types = _subset_types(shards[0])
+    for shard in shards[1:]:
+        if _subset_types(shard) != subset_types:
+            raise RuntimeError(
+                "The disaggregation shard files %s and %s of realization %s,"
+                " PoE %s hold different subset types: %s, %s"
+                % (shards[0].filename, shard.filename, realization, poe,
+                   subset_types, _subset_types(shard)))
+
+    site_indices = dict(((site.longitude, site.latitude), i)
+                        for i, site in enumerate(sites))
+    # position in sites -> (shard number, row), the last one wins
+    locations = {}
+    for number, shard in enumerate(shards):
+        for row, lon_lat in enumerate(zip(shard[LONS][:], shard[LATS][:])):
+            if lon_lat in site_indices:
+                locations[site_indices[lon_lat]] = (number, row)
+
+    missing = [site for i, site in enumerate(sites) if i not in locations]
+    if missing:
+        raise RuntimeError(
+            "The disaggregation subsets of %s of %s sites are missing from"
+            " the shard files of realization %s, PoE %s: %s"
+            % (len(missing), len(sites), realization, poe,
+               ", ".join(str(site) for site in missing)))
+
+    positions = [-numpy.ones(len(shard[LONS]), dtype=int) for shard in shards]
+    for position, (number, row) in locations.iteritems():
+        positions[number][row] = position
+    return positions
+
+
+def _merge_dataset(shards, positions, name, dataset):
+    """Copy the rows of the dataset `name` of the shards to `dataset`, at
+    their positions; the shards are read in contiguous blocks of
+    `MERGE_BLOCK_SIZE` rows."""
+    for shard, shard_positions in zip(shards, positions):
+        source = shard[name]
+        for start in xrange(0, len(shard_positions), MERGE_BLOCK_SIZE):
+            block_positions = shard_positions[start:start + MERGE_BLOCK_SIZE]
+            rows = numpy.flatnonzero(block_positions >= 0)
+            if not len(rows):
+                continue
+            block = source[start:start + len(block_positions)][rows]
+            order = numpy.argsort(block_positions[rows])
+            # h5py writes the rows at increasing positions
+            dataset[list(block_positions[rows][order])] = block[order]
+
+
+def merge_shards(result_dir, realization, poe, sites):
+    """Merge the shard files of a (realization, PoE) pair into its store
+    file, with the sites in the given order, and delete them.
+
+    :param sites: the :class:`openquake.shapes.Site` instances of the
+        calculation.
+    :returns: the path of the store file.
+    :raises: :exc:`RuntimeError` if the subsets of some sites are missing
+        from the shards (the shards are then left in place).
+    """
+    prefix = _shard_prefix(result_dir, realization, poe)
+    shard_paths = sorted(
+        os.path.join(result_dir, name) for name in os.listdir(result_dir)
+        if os.path.join(result_dir, name).startswith(prefix))
+    shards = [h5py.File(path, 'r') for path in shard_paths]
+    path = store_path(result_dir, realization, poe)
+
+    try:
+        positions = _shard_positions(shards, sites, realization, poe)
+
+        with h5py.File(path, 'w') as store:
+            gmvs = numpy.zeros(len(sites), dtype=DATA_TYPE)
+            for shard, shard_positions in zip(shards, positions):
+                rows = shard_positions >= 0
+                gmvs[shard_positions[rows]] = shard[GMVS][:][rows]
+            _create_locations(store, sites, gmvs)
+
+            for subset_type in _subset_types(shards[0]):
+                shape = shards[0][subset_type].shape[1:]
+                dataset = store.create_dataset(
+                    subset_type, shape=(len(sites),) + shape,
+                    dtype=DATA_TYPE, chunks=(1,) + shape,
+                    compression=COMPRESSION)
+                _merge_dataset(shards, positions, subset_type, dataset)
+    finally:
+        for shard in shards:
+            shard.close()
+
+    for shard_file in shard_paths:
+        os.unlink(shard_file)
+
+    return path
+
+
+def read_subset(path, subset_type, site):
+    """Read the subset of the given type of a site from a store file; only
+    the chunk of the site is read.
+
+    :param path: the path of the store file.
+    :param site: :class:`openquake.shapes.Site` instance.
+    :raises: :exc:`KeyError` if the site is not in the store.
+    """
+    with h5py.File(path, 'r') as store:
+        matches = numpy.flatnonzero(
+            (store[LONS][:] == site.longitude)
+            & (store[LATS][:] == site.latitude))
+        if not len(matches):
+            raise KeyError(site)
+        return store[subset_type][matches[0]]
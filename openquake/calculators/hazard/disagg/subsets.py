@@ -33,6 +33,11 @@ from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
 #: byte order. The same is used by java side.
 DATA_TYPE = numpy.float64
 
+# Per worker process cache of the distance bins of the latitude-longitude
+# cells, for the bin edges of the last job (they are job constants):
+# (lat, lon, distance bin edges) -> {(site lon, site lat) -> bins}
+_DISTANCE_BINS_CACHE = {}
+
 
 def fulldisaggmatrix(site, full_matrix, *args, **kwargs):
     """
@@ -41,49 +46,80 @@ def fulldisaggmatrix(site, full_matrix, *args, **kwargs):
     return full_matrix
 
 
-def magpmf(site, full_matrix,
-           lat_bin_edges, lon_bin_edges, distance_bin_edges,
-           nlat, nlon, nmag, neps, ntrt, ndist):
+def _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt):
     """
-    Magnitude PMF extractor (1D).
+    Return the part of the full matrix covered by the bins (the matrix can
+    have more bins than the job parameters define, see bug 932765).
     """
-    shape = [nmag - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nmag - 1):
-        ds[i] = sum(full_matrix[j][k][i][l][m]
-                    for j in xrange(nlat - 1)
-                    for k in xrange(nlon - 1)
-                    for l in xrange(neps - 1)
-                    for m in xrange(ntrt))
-    return ds
+    return numpy.asarray(full_matrix)[
+        :nlat - 1, :nlon - 1, :nmag - 1, :neps - 1, :ntrt]
 
 
-def _distgen(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
-             nlat, nlon, nmag, neps, ntrt, ndist):
+def _distance_bins(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                   nlat, nlon, ndist):
     """
     Common part of the code for all extractors that compute distances.
+
+    The bins only depend on the site and on the bin edges, so they are
+    computed once per site and reused for all the realizations and PoEs
+    (and all the extractors).
+
+    :returns: a (latitude indices, longitude indices, distance indices)
+        triple of read-only arrays, one element for each cell within the
+        distance bins.
+    """
+    edges = (tuple(lat_bin_edges[:nlat]), tuple(lon_bin_edges[:nlon]),
+             tuple(distance_bin_edges[:ndist]))
+    site_bins = _DISTANCE_BINS_CACHE.get(edges)
+    if site_bins is None:
+        _DISTANCE_BINS_CACHE.clear()
+        site_bins = _DISTANCE_BINS_CACHE[edges] = {}
+
+    key = (site.longitude, site.latitude)
+    bins = site_bins.get(key)
+    if bins is None:
+        bins = _compute_distance_bins(site, *edges)
+        for array in bins:
+            array.setflags(write=False)
+        site_bins[key] = bins
+    return bins
+
+
+def _compute_distance_bins(site, lat_bin_edges, lon_bin_edges,
+                           distance_bin_edges):
+    """
+    Compute the distance bins of the latitude-longitude cells.
+
+    The distance from the site to the center of each latitude-longitude
+    cell is computed at once; the cells out of the distance bins are
+    discarded, the others are assigned to the distance bin containing them
+    (the last bin includes its upper edge).
+
+    See :func:`_distance_bins`.
     """
-    slat = site.latitude
-    slon = site.longitude
-    enumeration = ((i, j, k, l, m)
-                   for i in xrange(nlat - 1)
-                   for j in xrange(nlon - 1)
-                   for k in xrange(nmag - 1)
-                   for l in xrange(neps - 1)
-                   for m in xrange(ntrt))
-    for i, j, k, l, m in enumeration:
-        meanlat = (lat_bin_edges[i] + lat_bin_edges[i + 1]) / 2
-        meanlon = (lon_bin_edges[j] + lon_bin_edges[j + 1]) / 2
-        dist = hdistance(meanlat, meanlon, slat, slon)
-        if dist < distance_bin_edges[0] \
-                or dist > distance_bin_edges[-1]:
-            continue
-        ii = 0
-        for ii in xrange(ndist - 1):
-            if dist >= distance_bin_edges[ii] \
-                    and dist < distance_bin_edges[ii + 1]:
-                break
-        yield i, j, k, l, m, ii
+    lat_bin_edges = numpy.asarray(lat_bin_edges, DATA_TYPE)
+    lon_bin_edges = numpy.asarray(lon_bin_edges, DATA_TYPE)
+    distance_bin_edges = numpy.asarray(distance_bin_edges, DATA_TYPE)
+    meanlats = (lat_bin_edges[:-1] + lat_bin_edges[1:]) / 2
+    meanlons = (lon_bin_edges[:-1] + lon_bin_edges[1:]) / 2
+    dists = hdistance(meanlats[:, numpy.newaxis], meanlons[numpy.newaxis, :],
+                      site.latitude, site.longitude)
+    lat_idx, lon_idx = numpy.nonzero((dists >= distance_bin_edges[0])
+                                     & (dists <= distance_bin_edges[-1]))
+    dist_idx = numpy.searchsorted(distance_bin_edges, dists[lat_idx, lon_idx],
+                                  side='right') - 1
+    return (lat_idx, lon_idx,
+            numpy.minimum(dist_idx, len(distance_bin_edges) - 2))
+
+
+def magpmf(site, full_matrix,
+           lat_bin_edges, lon_bin_edges, distance_bin_edges,
+           nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Magnitude PMF extractor (1D).
+    """
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(0, 1, 3, 4), dtype=DATA_TYPE)
 
 
 def distpmf(site, full_matrix,
@@ -92,13 +128,13 @@ def distpmf(site, full_matrix,
     """
     Distance PMF extractor (1D).
     """
-    shape = [ndist - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    distgen = _distgen(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
-                       nlat, nlon, nmag, neps, ntrt, ndist)
-    for i, j, k, l, m, ii in distgen:
-        ds[ii] += full_matrix[i][j][k][l][m]
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    lat_idx, lon_idx, dist_idx = _distance_bins(
+        site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
+        nlat, nlon, ndist)
+    latlon = matrix.sum(axis=(2, 3, 4), dtype=DATA_TYPE)
+    return numpy.bincount(dist_idx, weights=latlon[lat_idx, lon_idx],
+                          minlength=ndist - 1).astype(DATA_TYPE)
 
 
 def trtpmf(site, full_matrix,
@@ -107,15 +143,8 @@ def trtpmf(site, full_matrix,
     """
     Tectonic region type PMF extractor (1D).
     """
-    shape = [ntrt]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(ntrt):
-        ds[i] = sum(full_matrix[j][k][l][m][i]
-                    for j in xrange(nlat - 1)
-                    for k in xrange(nlon - 1)
-                    for l in xrange(nmag - 1)
-                    for m in xrange(neps - 1))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(0, 1, 2, 3), dtype=DATA_TYPE)
 
 
 def magdistpmf(site, full_matrix,
@@ -125,12 +154,15 @@ def magdistpmf(site, full_matrix,
     Magnitude-distance PMF extractor (2D).
     """
     ndist = len(distance_bin_edges)
-    shape = [nmag - 1, ndist - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    distgen = _distgen(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
-                       nlat, nlon, nmag, neps, ntrt, ndist)
-    for i, j, k, l, m, ii in distgen:
-        ds[k][ii] += full_matrix[i][j][k][l][m]
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    lat_idx, lon_idx, dist_idx = _distance_bins(
+        site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
+        nlat, nlon, ndist)
+    ds = numpy.zeros([nmag - 1, ndist - 1], DATA_TYPE)
+    latlonmag = matrix.sum(axis=(3, 4), dtype=DATA_TYPE)
+    # magnitudes along the first axis, cells along the second one
+    numpy.add.at(ds, (slice(None), dist_idx),
+                 latlonmag[lat_idx, lon_idx].transpose())
     return ds
 
 
@@ -140,12 +172,14 @@ def magdistepspmf(site, full_matrix,
     """
     Magnitude-distance-epsilon PMF extractor (3D).
     """
-    shape = [nmag - 1, ndist - 1, neps - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    distgen = _distgen(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
-                       nlat, nlon, nmag, neps, ntrt, ndist)
-    for i, j, k, l, m, ii in distgen:
-        ds[k][ii][l] += full_matrix[i][j][k][l][m]
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    lat_idx, lon_idx, dist_idx = _distance_bins(
+        site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
+        nlat, nlon, ndist)
+    ds = numpy.zeros([nmag - 1, ndist - 1, neps - 1], DATA_TYPE)
+    latlonmageps = matrix.sum(axis=4, dtype=DATA_TYPE)
+    numpy.add.at(ds, (slice(None), dist_idx),
+                 latlonmageps[lat_idx, lon_idx].transpose(1, 0, 2))
     return ds
 
 
@@ -155,15 +189,8 @@ def latlonpmf(site, full_matrix,
     """
     Latitude-longitude PMF extractor (2D).
     """
-    shape = [nlat - 1, nlon - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nlat - 1):
-        for j in xrange(nlon - 1):
-            ds[i][j] = sum(full_matrix[i][j][k][l][m]
-                           for k in xrange(nmag - 1)
-                           for l in xrange(neps - 1)
-                           for m in xrange(ntrt))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(2, 3, 4), dtype=DATA_TYPE)
 
 
 def latlonmagpmf(site, full_matrix,
@@ -172,15 +199,8 @@ def latlonmagpmf(site, full_matrix,
     """
     Latitude-longitude-magnitude PMF extractor (3D).
     """
-    shape = [nlat - 1, nlon - 1, nmag - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nlat - 1):
-        for j in xrange(nlon - 1):
-            for k in xrange(nmag - 1):
-                ds[i][j][k] = sum(full_matrix[i][j][k][l][m]
-                                  for l in xrange(neps - 1)
-                                  for m in xrange(ntrt))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(3, 4), dtype=DATA_TYPE)
 
 
 def latlonmagepspmf(site, full_matrix,
@@ -189,15 +209,8 @@ def latlonmagepspmf(site, full_matrix,
     """
     Latitude-longitude-magnitude-epsilon PMF extractor (4D).
     """
-    shape = [nlat - 1, nlon - 1, nmag - 1, neps - 1]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nlat - 1):
-        for j in xrange(nlon - 1):
-            for k in xrange(nmag - 1):
-                for l in xrange(neps - 1):
-                    ds[i][j][k][l] = sum(full_matrix[i][j][k][l][m]
-                                         for m in xrange(ntrt))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=4, dtype=DATA_TYPE)
 
 
 def magtrtpmf(site, full_matrix,
@@ -206,15 +219,8 @@ def magtrtpmf(site, full_matrix,
     """
     Magnitude -- tectonic region type PMF extractor (2D).
     """
-    shape = [nmag - 1, ntrt]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nmag - 1):
-        for j in xrange(ntrt):
-            ds[i][j] = sum(full_matrix[k][l][i][m][j]
-                           for k in xrange(nlat - 1)
-                           for l in xrange(nlon - 1)
-                           for m in xrange(neps - 1))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(0, 1, 3), dtype=DATA_TYPE)
 
 
 def latlontrtpmf(site, full_matrix,
@@ -223,15 +229,8 @@ def latlontrtpmf(site, full_matrix,
     """
     Latitude -- longitude -- tectonic region type PMF extractor (3D).
     """
-    shape = [nlat - 1, nlon - 1, ntrt]
-    ds = numpy.zeros(shape, DATA_TYPE)
-    for i in xrange(nlat - 1):
-        for j in xrange(nlon - 1):
-            for k in xrange(ntrt):
-                ds[i][j][k] = sum(full_matrix[i][j][l][m][k]
-                                  for l in xrange(nmag - 1)
-                                  for m in xrange(neps - 1))
-    return ds
+    matrix = _matrix(full_matrix, nlat, nlon, nmag, neps, ntrt)
+    return matrix.sum(axis=(2, 3), dtype=DATA_TYPE)
 
 
 #: Mapping "extractor name -- extractor function".
@@ -275,6 +274,43 @@ def extract_subsets(
     :param target_path: Path to the file where the result should be saved.
     :param subsets: A list of PMF extractor names.
     """
+    with h5py.File(full_matrix_path, 'r') as source:
+        full_matrix = source[FULL_DISAGG_MATRIX].value
+    save_subsets(site, full_matrix, lat_bin_edges, lon_bin_edges,
+                 mag_bin_edges, eps_bin_edges, distance_bin_edges,
+                 target_path, subsets)
+
+
+def save_subsets(site, full_matrix, lat_bin_edges, lon_bin_edges,
+                 mag_bin_edges, eps_bin_edges, distance_bin_edges,
+                 target_path, subsets):
+    """
+    Extract the subsets from a full disaggregation matrix and save them in
+    one file, with dataset name equal to the extractor name.
+
+    The parameters are the ones of :func:`extract_subsets`, except for
+    ``full_matrix``, the 5D matrix itself.
+    """
+    datasets = compute_subsets(
+        site, full_matrix, lat_bin_edges, lon_bin_edges, mag_bin_edges,
+        eps_bin_edges, distance_bin_edges, subsets)
+    with h5py.File(target_path, 'w') as target:
+        for subset_type, dataset in datasets.iteritems():
+            target.create_dataset(subset_type, data=dataset)
+
+
+def compute_subsets(site, full_matrix, lat_bin_edges, lon_bin_edges,
+                    mag_bin_edges, eps_bin_edges, distance_bin_edges,
+                    subsets):
+    """
+    Extract the subsets from a full disaggregation matrix.
+
+    The parameters are the ones of :func:`save_subsets`, except for
+    ``target_path``.
+
+    :returns: a dict mapping the extractor names to the subsets
+        (:class:`numpy.ndarray` instances).
+    """
     nlat = len(lat_bin_edges)
     nlon = len(lon_bin_edges)
     nmag = len(mag_bin_edges)
@@ -284,14 +320,12 @@ def extract_subsets(
     subsets = set(subsets)
     assert not subsets - set(SUBSET_EXTRACTORS)
     assert subsets
-    with h5py.File(full_matrix_path, 'r') as source:
-        full_matrix = source[FULL_DISAGG_MATRIX].value
-    with h5py.File(target_path, 'w') as target:
-        for subset_type in subsets:
-            extractor = SUBSET_EXTRACTORS[subset_type]
-            dataset = extractor(
-                site, full_matrix,
-                lat_bin_edges, lon_bin_edges, distance_bin_edges,
-                nlat, nlon, nmag, neps, ntrt, ndist
-            )
-            target.create_dataset(subset_type, data=dataset)
+    datasets = {}
+    for subset_type in subsets:
+        extractor = SUBSET_EXTRACTORS[subset_type]
+        datasets[subset_type] = extractor(
+            site, full_matrix,
+            lat_bin_edges, lon_bin_edges, distance_bin_edges,
+            nlat, nlon, nmag, neps, ntrt, ndist
+        )
+    return datasets
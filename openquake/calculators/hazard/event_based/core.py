@@ -15,23 +15,41 @@
 
 """Core functionality for Event-Based hazard calculations."""
 
-import math
+import functools
+import itertools
 import os
 import random
+import struct
+
+import numpy
 
 from celery.task import task
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
-from openquake import shapes
 from openquake.output import hazard as hazard_output
+from openquake.utils import config
 from openquake.utils import stats
 from openquake.utils import tasks as utils_tasks
 from openquake.calculators.hazard import general
 
 LOG = logs.LOG
 
+# Header of the binary per rupture records of a stochastic event set, as
+# written by HazardCalculator.gmfToRecord(): rupture index, index of the first
+# site and number of sites, followed by as many (big endian) doubles.
+GMF_RECORD_HEADER = struct.Struct(">iii")
+
+# Number of records fetched at once from the KVS when reading stochastic
+# event sets.
+GMF_RECORD_FETCH_SIZE = 100
+
+# Per worker process cache of the last sampled stochastic event set, shared
+# by the tasks computing its ground motion fields by blocks:
+# (job_id, history, realization, seed) -> Java list of ruptures
+_SES_CACHE = {}
+
 
 @task
 @java.unpack_exception
@@ -44,6 +62,27 @@ def compute_ground_motion_fields(job_id, sites, history, realization, seed):
         sites, history, realization, seed)
 
 
+@task
+@java.unpack_exception
+def compute_ground_motion_field_block(job_id, sites, history, realization,
+                                      seed, rupture_range, site_range):
+    """ Generate the ground motion fields of a block of ruptures and sites
+    of a stochastic event set """
+    calculator = utils_tasks.calculator_for_task(job_id, 'hazard')
+
+    calculator.compute_ground_motion_field_block(
+        sites, history, realization, seed, rupture_range, site_range)
+
+
+@task
+@java.unpack_exception
+def count_ruptures(job_id, history, realization, seed):
+    """ Return the number of ruptures of a stochastic event set """
+    calculator = utils_tasks.calculator_for_task(job_id, 'hazard')
+
+    return calculator.count_ruptures(history, realization, seed)
+
+
 class EventBasedHazardCalculator(general.BaseHazardCalculator):
     """Probabilistic Event Based method for performing Hazard calculations."""
 
@@ -65,7 +104,9 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         """Main hazard processing block.
 
         Loops through various random realizations, spawning tasks to compute
-        GMFs."""
+        GMFs. At most `hazard_ses_in_flight` event sets are computed at the
+        same time; the completed ones are serialized here, on the master,
+        after the pipeline was topped up so the workers are kept busy."""
         source_model_generator = random.Random()
         source_model_generator.seed(
             self.job_ctxt['SOURCE_MODEL_LT_RANDOM_SEED'])
@@ -84,81 +125,342 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
             "Going to run hazard for %s histories of %s realizations each."
             % (histories, realizations))
 
-        for i in range(0, histories):
-            pending_tasks = []
-            for j in range(0, realizations):
-                self.store_source_model(source_model_generator.getrandbits(32))
-                self.store_gmpe_map(gmpe_generator.getrandbits(32))
-                pending_tasks.append(
-                    compute_ground_motion_fields.delay(
-                        self.job_ctxt.job_id,
-                        self.job_ctxt.sites_to_compute(),
-                        i, realization=j, seed=gmf_generator.getrandbits(32)))
-
-            for each_task in pending_tasks:
-                each_task.wait()
-                if each_task.status != 'SUCCESS':
-                    raise Exception(each_task.result)
-                logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
-
-            for j in range(0, realizations):
-                stochastic_set_key = kvs.tokens.stochastic_set_key(
-                    self.job_ctxt.job_id, i, j)
-                LOG.info("Writing output for ses %s" % stochastic_set_key)
-                ses = kvs.get_value_json_decoded(stochastic_set_key)
-                if ses:
-                    self.serialize_gmf(ses)
-
-    def serialize_gmf(self, ses):
+        site_block_size, rupture_chunk_size = config.hazard_gmf_split()
+        if site_block_size or rupture_chunk_size:
+            self.execute_blocks(
+                source_model_generator, gmpe_generator, gmf_generator,
+                site_block_size, rupture_chunk_size)
+            return
+
+        sites = self.job_ctxt.sites_to_compute()
+        pipeline = utils_tasks.TaskPipeline(config.hazard_ses_in_flight())
+        event_sets = self._event_set_submissions(
+            source_model_generator, gmpe_generator, gmf_generator,
+            compute_ground_motion_fields, sites)
+
+        # serialize one event set at a time, in completion order; the
+        # pipeline was topped up before each one is yielded
+        for each_task, (i, j, _) in pipeline.run(event_sets):
+            if each_task.status != 'SUCCESS':
+                raise Exception(each_task.result)
+            logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
+
+            stochastic_set_key = kvs.tokens.stochastic_set_key(
+                self.job_ctxt.job_id, i, j)
+            LOG.info("Writing output for ses %s" % stochastic_set_key)
+            self.serialize_gmf(
+                "%s!%s" % (i, j), sites,
+                read_stochastic_set([[stochastic_set_key]]))
+            self.delete_realization_models(i, j)
+
+    def _event_set_submissions(self, source_model_generator, gmpe_generator,
+                               gmf_generator, a_task, *args):
+        """Yield the `(submit, (history, realization, seed))` triples of the
+        stochastic event sets to compute, for a
+        :class:`~openquake.utils.tasks.TaskPipeline`: `submit` submits
+        `a_task` with the job id, `args`, the history, the realization and
+        the seed of the event set. The models of each event set are stored
+        as it is about to be submitted."""
+        histories = self.job_ctxt['NUMBER_OF_SEISMICITY_HISTORIES']
+        realizations = self.job_ctxt['NUMBER_OF_LOGIC_TREE_SAMPLES']
+
+        for i in xrange(histories):
+            for j in xrange(realizations):
+                self.store_realization_models(
+                    i, j, source_model_generator.getrandbits(32),
+                    gmpe_generator.getrandbits(32))
+                seed = gmf_generator.getrandbits(32)
+                submit = functools.partial(
+                    a_task.delay, self.job_ctxt.job_id, *(args + (i, j, seed)))
+                yield submit, (i, j, seed)
+
+    def store_realization_models(self, history, realization,
+                                 source_model_seed, gmpe_seed):
+        """Sample the source model and GMPE map of the given stochastic
+        event set and store them in the KVS, under keys of their own: the
+        tasks of several event sets may be running at the same time."""
+        job_id = self.job_ctxt.job_id
+        self.store_source_model(
+            source_model_seed,
+            kvs.tokens.source_model_key(job_id, history, realization))
+        self.store_gmpe_map(
+            gmpe_seed, kvs.tokens.gmpe_key(job_id, history, realization))
+
+    def delete_realization_models(self, history, realization):
+        """Remove the source model and GMPE map of the given stochastic
+        event set from the KVS."""
+        job_id = self.job_ctxt.job_id
+        kvs.get_client().delete(
+            kvs.tokens.source_model_key(job_id, history, realization),
+            kvs.tokens.gmpe_key(job_id, history, realization))
+
+    def generate_realization_erf(self, history, realization):
+        """Generate the ERF of the given stochastic event set."""
+        return self.generate_erf(kvs.tokens.source_model_key(
+            self.job_ctxt.job_id, history, realization))
+
+    def generate_realization_gmpe_map(self, history, realization):
+        """Generate the GMPE map of the given stochastic event set."""
+        return self.generate_gmpe_map(kvs.tokens.gmpe_key(
+            self.job_ctxt.job_id, history, realization))
+
+    def execute_blocks(self, source_model_generator, gmpe_generator,
+                       gmf_generator, site_block_size, rupture_chunk_size):
+        """Like :meth:`execute` but each stochastic event set is computed by
+        tasks handling blocks of at most `rupture_chunk_size` ruptures and
+        `site_block_size` sites (0 meaning no limit).
+
+        Each event set is sampled by a worker first (see
+        :func:`count_ruptures`), which keeps it for the blocks it computes;
+        its block tasks are then queued as follow-ups of the same
+        :class:`~openquake.utils.tasks.TaskPipeline`, sharing its budget of
+        `hazard_ses_in_flight` tasks. The event sets are serialized as soon
+        as all of their blocks are completed.
+
+        The ground motion fields do not depend on `rupture_chunk_size` but,
+        being drawn from a random number generator per block of sites, they
+        differ from the ones computed by :meth:`execute` and depend on
+        `site_block_size` (see :meth:`compute_ground_motion_field_block`)."""
+        correlate = self.job_ctxt['GROUND_MOTION_CORRELATION']
+
+        sites = self.job_ctxt.sites_to_compute()
+        if correlate or not site_block_size:
+            site_block_size = len(sites)
+
+        pipeline = utils_tasks.TaskPipeline(config.hazard_ses_in_flight())
+        event_sets = self._event_set_submissions(
+            source_model_generator, gmpe_generator, gmf_generator,
+            count_ruptures)
+        # (history, realization) -> [number of block tasks not completed
+        # yet, KVS keys of the parts]
+        in_progress = dict()
+
+        for count_task, (i, j, seed) in pipeline.run(event_sets):
+            if count_task.status != 'SUCCESS':
+                raise Exception(count_task.result)
+
+            part_keys, num_blocks = self._submit_blocks(
+                pipeline, sites, i, j, seed, count_task.result,
+                site_block_size, rupture_chunk_size)
+            if num_blocks:
+                in_progress[(i, j)] = [num_blocks, part_keys]
+            else:
+                self._serialize_blocks(sites, i, j, part_keys)
+
+            self._collect_blocks(pipeline.follow_ups(), sites, in_progress)
+
+        self._collect_blocks(pipeline.follow_ups(wait=True), sites,
+                             in_progress)
+
+    def _submit_blocks(self, pipeline, sites, history, realization, seed,
+                       num_ruptures, site_block_size, rupture_chunk_size):
+        """Queue the block tasks of a stochastic event set as follow-ups in
+        the given pipeline.
+
+        :returns: the KVS keys of the parts of the event set, grouped by
+            chunk of ruptures (see :func:`read_stochastic_set`), and the
+            number of tasks queued
+        """
+        job_id = self.job_ctxt.job_id
+        num_sites = len(sites)
+        chunk_size = rupture_chunk_size or max(num_ruptures, 1)
+
+        part_keys = []
+        for first_rupture in xrange(0, num_ruptures, chunk_size):
+            rupture_range = (
+                first_rupture, min(first_rupture + chunk_size, num_ruptures))
+            chunk_keys = []
+            for first_site in xrange(0, num_sites, site_block_size):
+                site_range = (
+                    first_site, min(first_site + site_block_size, num_sites))
+                chunk_keys.append(kvs.tokens.stochastic_set_part_key(
+                    job_id, history, realization, first_rupture, first_site))
+                pipeline.follow_up(
+                    functools.partial(
+                        compute_ground_motion_field_block.delay, job_id,
+                        sites, history, realization, seed, rupture_range,
+                        site_range),
+                    (history, realization))
+            part_keys.append(chunk_keys)
+
+        return part_keys, sum(len(keys) for keys in part_keys)
+
+    def _collect_blocks(self, completed, sites, in_progress):
+        """Check the completed block tasks and serialize the event sets
+        whose blocks are all completed.
+
+        :param completed: `(task, (history, realization))` pairs, as yielded
+            by :meth:`openquake.utils.tasks.TaskPipeline.follow_ups`
+        :param dict in_progress: the event sets whose blocks are being
+            computed, see :meth:`execute_blocks`
+        """
+        for block_task, (i, j) in completed:
+            if block_task.status != 'SUCCESS':
+                raise Exception(block_task.result)
+            in_progress[(i, j)][0] -= 1
+            if not in_progress[(i, j)][0]:
+                _, part_keys = in_progress.pop((i, j))
+                self._serialize_blocks(sites, i, j, part_keys)
+
+    def _serialize_blocks(self, sites, history, realization, part_keys):
+        """Serialize a stochastic event set computed by blocks."""
+        stats.pk_inc(self.job_ctxt.job_id, "nhzrd_done", 1)
+        logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
+
+        LOG.info("Writing output for ses %s!%s (%s parts)"
+                 % (history, realization,
+                    sum(len(keys) for keys in part_keys)))
+        self.serialize_gmf("%s!%s" % (history, realization), sites,
+                           read_stochastic_set(part_keys))
+        self.delete_realization_models(history, realization)
+
+    def serialize_gmf(self, event_set, sites, ruptures):
         """
         Write each GMF to an NRML file or to DB depending on job configuration.
+
+        :param str event_set: the stochastic event set identifier
+            ("history!realization")
+        :param sites: the sites of the ground motion fields
+        :type sites: list of :class:`openquake.shapes.Site`
+        :param ruptures: the ground motion fields of the ruptures, as
+            yielded by :func:`read_stochastic_set`; consumed one at a time
+        :returns: the paths of the NRML files written
         """
         iml_list = self.job_ctxt['INTENSITY_MEASURE_LEVELS']
 
         LOG.debug("IML: %s" % (iml_list))
-        files = []
-
-        nrml_path = ''
-
-        for event_set in ses:
-            for rupture in ses[event_set]:
-
-                if self.job_ctxt['SAVE_GMFS']:
-                    common_path = os.path.join(
-                        self.job_ctxt.base_path, self.job_ctxt['OUTPUT_DIR'],
-                        "gmf-%s-%s" % (str(event_set.replace("!", "_")),
-                        str(rupture.replace("!", "_"))))
-                    nrml_path = "%s.xml" % common_path
-
-                gmf_writer = hazard_output.create_gmf_writer(
-                    self.job_ctxt.job_id,
-                    self.job_ctxt.serialize_results_to,
-                    nrml_path)
-                gmf_data = {}
-                for site_key in ses[event_set][rupture]:
-                    site = ses[event_set][rupture][site_key]
-                    site_obj = shapes.Site(site['lon'], site['lat'])
-                    gmf_data[site_obj] = \
-                        {'groundMotion': math.exp(float(site['mag']))}
-
-                gmf_writer.serialize(gmf_data)
-                files.append(nrml_path)
-        return files
+
+        nrml_path_template = None
+        if self.job_ctxt['SAVE_GMFS']:
+            common_path = os.path.join(
+                self.job_ctxt.base_path, self.job_ctxt['OUTPUT_DIR'],
+                "gmf-%s-" % event_set.replace("!", "_"))
+            nrml_path_template = common_path.replace("%", "%%") + "%s.xml"
+
+        gmf_writer = hazard_output.GmfBulkWriter(
+            self.job_ctxt.job_id, self.job_ctxt.serialize_results_to,
+            nrml_path_template)
+        return gmf_writer.serialize(sites, ruptures)
 
     @general.create_java_cache
     def compute_ground_motion_fields(self, site_list, history, realization,
                                      seed):
-        """Ground motion field calculation, runs on the workers."""
+        """Ground motion field calculation, runs on the workers.
+
+        The stochastic event set and its ground motion fields are drawn, in
+        this order, from a single random number generator seeded with
+        `seed`."""
         jpype = java.jvm()
 
         jsite_list = self.parameterize_sites(site_list)
         key = kvs.tokens.stochastic_set_key(self.job_ctxt.job_id, history,
                                             realization)
         correlate = self.job_ctxt['GROUND_MOTION_CORRELATION']
-        stochastic_set_id = "%s!%s" % (history, realization)
         java.jclass("HazardCalculator").generateAndSaveGMFs(
-                self.cache, key, stochastic_set_id, jsite_list,
-                self.generate_erf(),
-                self.generate_gmpe_map(),
+                self.cache, key, jsite_list,
+                self.generate_realization_erf(history, realization),
+                self.generate_realization_gmpe_map(history, realization),
                 java.jclass("Random")(seed),
                 jpype.JBoolean(correlate))
+
+    @general.create_java_cache
+    def compute_ground_motion_field_block(self, site_list, history,
+                                          realization, seed, rupture_range,
+                                          site_range):
+        """Ground motion field calculation for the ruptures with indices in
+        [rupture_range[0], rupture_range[1]) of a stochastic event set and
+        the sites with indices in [site_range[0], site_range[1]) of
+        `site_list`; runs on the workers.
+
+        Each rupture draws its inter-event residual from a random number
+        generator of its own, and the site dependent residuals of each block
+        of sites from another one, both seeded from `seed` and the rupture
+        and first site indices (see `HazardCalculator.ruptureSeed()` and
+        `HazardCalculator.siteBlockSeed()`)."""
+        jpype = java.jvm()
+
+        ruptures = self.sample_stochastic_event_set(history, realization,
+                                                    seed)
+        key = kvs.tokens.stochastic_set_part_key(
+            self.job_ctxt.job_id, history, realization, rupture_range[0],
+            site_range[0])
+        jsite_list = self.parameterize_sites(site_list)
+        correlate = self.job_ctxt['GROUND_MOTION_CORRELATION']
+        java.jclass("HazardCalculator").generateAndSaveGMFsBlock(
+                self.cache, key, ruptures,
+                rupture_range[0], rupture_range[1], jsite_list,
+                site_range[0], site_range[1],
+                self.generate_realization_gmpe_map(history, realization),
+                jpype.JLong(seed),
+                jpype.JBoolean(correlate))
+
+    @general.create_java_cache
+    def count_ruptures(self, history, realization, seed):
+        """Return the number of ruptures of a stochastic event set (see
+        :meth:`sample_stochastic_event_set`)."""
+        return self.sample_stochastic_event_set(
+            history, realization, seed).size()
+
+    def sample_stochastic_event_set(self, history, realization, seed):
+        """Return the (Java) list of ruptures of the given stochastic event
+        set, sampling it only once per worker process."""
+        key = (self.job_ctxt.job_id, history, realization, seed)
+        if key not in _SES_CACHE:
+            _SES_CACHE.clear()
+            _SES_CACHE[key] = java.jclass(
+                "HazardCalculator").sampleStochasticEventSet(
+                    self.generate_realization_erf(history, realization),
+                    seed)
+        return _SES_CACHE[key]
+
+
+def decode_gmf_record(record):
+    """Decode a binary per rupture record of a stochastic event set.
+
+    >>> rupture, first_site, gmvs = decode_gmf_record(
+    ...     GMF_RECORD_HEADER.pack(3, 10, 2) + struct.pack(">2d", -1.5, 0.25))
+    >>> rupture, first_site, gmvs.tolist()
+    (3, 10, [-1.5, 0.25])
+
+    :returns: the rupture index, the index of the first site and the
+        ground motion values (natural logarithms) at the sites
+    """
+    rupture, first_site, num_sites = GMF_RECORD_HEADER.unpack_from(record)
+    gmvs = numpy.frombuffer(record, dtype=">f8", count=num_sites,
+                            offset=GMF_RECORD_HEADER.size)
+    return rupture, first_site, gmvs
+
+
+def _iter_records(client, key):
+    """Yield the records stored in the KVS list `key`, a few at a time."""
+    start = 0
+    while True:
+        records = client.lrange(key, start, start + GMF_RECORD_FETCH_SIZE - 1)
+        for record in records:
+            yield record
+        if len(records) < GMF_RECORD_FETCH_SIZE:
+            break
+        start += GMF_RECORD_FETCH_SIZE
+
+
+def read_stochastic_set(key_groups):
+    """Stream the ground motion fields of a stochastic event set from the
+    KVS, one rupture at a time, and delete the keys once read.
+
+    :param key_groups: lists of KVS keys; the keys of a group hold the
+        records of the same ruptures for consecutive blocks of sites (see
+        :func:`compute_ground_motion_field_block`), a group holding a single
+        key when the sites were not split
+    :returns: a generator of (rupture index, ground motion values) pairs,
+        the values (natural logarithms) being aligned with the sites
+    """
+    client = kvs.get_client()
+    for keys in key_groups:
+        for records in itertools.izip(
+                *[_iter_records(client, key) for key in keys]):
+            blocks = [decode_gmf_record(record) for record in records]
+            rupture = blocks[0][0]
+            assert all(block[0] == rupture for block in blocks), \
+                "Misaligned stochastic event set records"
+            yield rupture, numpy.concatenate([block[2] for block in blocks])
+        client.delete(*keys)
@@ -18,6 +18,7 @@
 
 """Common code for the hazard calculators."""
 
+import collections
 import functools
 import hashlib
 import json
@@ -26,13 +27,15 @@ import numpy
 import StringIO
 
 from django.db import transaction
-from nhlib import geo as nhlib_geo
+from nhlib.geo import polygon as nhlib_polygon
+from nhlib.geo import utils as nhlib_utils
 from scipy.interpolate import interp1d
 from scipy.stats.mstats import mquantiles
 from shapely import geometry
 
 from openquake import java
 from openquake import kvs
+from openquake import writer
 from openquake.calculators.base import Calculator
 from openquake.db import models
 from openquake.input import logictree
@@ -48,6 +51,18 @@ from openquake.utils import stats
 QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES"
 
+# Maximum number of `hzrdi.site_model` records written by a single
+# multi-row insert, see `store_site_model_bulk()`.
+SITE_MODEL_INSERT_CHUNK_SIZE = 1000
+
+# The cached Java site lists are evicted when the JVM heap usage is above
+# this ratio, see `site_cache()`.
+SITE_CACHE_MAX_HEAP_RATIO = 0.75
+
+# Maximum number of site collections whose parameters are cached by each
+# worker process, see `site_parameters_cache()`.
+SITE_PARAMETERS_CACHE_ENTRIES = 256
+
 
 # NOTE: this refers to how the values are stored in KVS. In the config
 # file, values are stored untransformed (i.e., the list of IMLs is
@@ -86,6 +101,162 @@ def create_java_cache(fn):
     return decorated
 
 
+class SiteCache(object):
+    """Per worker process LRU cache of parameterized site collections: the
+    Java site lists built by :meth:`BaseHazardCalculator.parameterize_sites`
+    (see :func:`site_cache`) or the site parameters returned by
+    :func:`site_parameters` (see :func:`site_parameters_cache`).
+
+    Entries are keyed by (job id, site list digest) so they can be reused
+    across realizations and across the task types of the same job. The least
+    recently used entries are evicted when the total number of cached sites
+    exceeds ``max_sites``, when there are more than ``max_entries`` entries
+    or, if ``max_heap_ratio`` is given, when the JVM heap is more than
+    ``max_heap_ratio`` full. All entries of other jobs are dropped as soon as
+    a new job shows up.
+    """
+
+    def __init__(self, max_sites, max_entries=None, max_heap_ratio=None):
+        self.max_sites = max_sites
+        self.max_entries = max_entries
+        self.max_heap_ratio = max_heap_ratio
+        self.entries = collections.OrderedDict()
+        self.job_id = None
+        self.num_sites = 0
+
+    @staticmethod
+    def digest(site_list):
+        """Return a digest identifying the given sequence of
+        :class:`openquake.shapes.Site` objects."""
+        return hashlib.md5(
+            repr([(s.longitude, s.latitude) for s in site_list])).hexdigest()
+
+    def get(self, job_id, digest):
+        """Return the cached entry or `None`."""
+        entry = self.entries.pop((job_id, digest), None)
+        if entry is None:
+            return None
+        # re-insert as the most recently used entry
+        self.entries[(job_id, digest)] = entry
+        return entry[0]
+
+    def put(self, job_id, digest, value, num_sites):
+        """Cache the given entry, evicting other entries as needed."""
+        if num_sites > self.max_sites:
+            return
+
+        if job_id != self.job_id:
+            self.clear()
+            self.job_id = job_id
+
+        self.entries[(job_id, digest)] = (value, num_sites)
+        self.num_sites += num_sites
+
+        while self.entries and self._is_full():
+            _, (_, evicted_sites) = self.entries.popitem(last=False)
+            self.num_sites -= evicted_sites
+
+    def fetch(self, job_id, key, num_sites, build):
+        """Return the cached entry with the given key, calling `build()` to
+        create (and cache) it if there is none."""
+        if self.max_sites <= 0:
+            return build()
+
+        entry = self.get(job_id, key)
+        if entry is None:
+            entry = build()
+            self.put(job_id, key, entry, num_sites)
+        return entry
+
+    def clear(self):
+        """Drop all the cached entries."""
+        self.entries.clear()
+        self.num_sites = 0
+
+    def _is_full(self):
+        """True if the least recently used entry must be evicted."""
+        if self.num_sites > self.max_sites:
+            return True
+        if (self.max_entries is not None
+                and len(self.entries) > self.max_entries):
+            return True
+        return self.max_heap_ratio is not None and self._heap_is_full()
+
+    def _heap_is_full(self):
+        """True if the JVM heap usage is above `max_heap_ratio`."""
+        runtime = java.jclass("Runtime").getRuntime()
+        used = runtime.totalMemory() - runtime.freeMemory()
+        return used > self.max_heap_ratio * runtime.maxMemory()
+
+
+# Per worker process caches, see site_cache() and site_parameters_cache().
+_SITE_CACHE = None
+_SITE_PARAMETERS_CACHE = None
+
+
+def site_cache():
+    """Return the per worker process :class:`SiteCache` of Java site lists,
+    creating it (with the configured size) on first use. The Java entries
+    are also evicted when the JVM heap gets full."""
+    global _SITE_CACHE
+    if _SITE_CACHE is None:
+        _SITE_CACHE = SiteCache(config.hazard_site_cache_size(),
+                                max_heap_ratio=SITE_CACHE_MAX_HEAP_RATIO)
+    return _SITE_CACHE
+
+
+def site_parameters_cache():
+    """Return the per worker process :class:`SiteCache` of site parameters,
+    creating it (with the configured size) on first use. At most
+    `SITE_PARAMETERS_CACHE_ENTRIES` site collections are kept."""
+    global _SITE_PARAMETERS_CACHE
+    if _SITE_PARAMETERS_CACHE is None:
+        _SITE_PARAMETERS_CACHE = SiteCache(
+            config.hazard_site_cache_size(),
+            max_entries=SITE_PARAMETERS_CACHE_ENTRIES)
+    return _SITE_PARAMETERS_CACHE
+
+
+def site_parameters(job_ctxt, sites):
+    """Return the (vs30_type, vs30, z1pt0, z2pt5) parameters of each of the
+    given sites, from the closest site model node or from the job profile if
+    there is no site model.
+
+    The parameters are cached by the worker process (see
+    :func:`site_parameters_cache`), so that the site model lookups are not
+    repeated for each realization.
+
+    :param job_ctxt:
+        :class:`openquake.engine.JobContext` instance.
+    :param sites:
+        `list` of :class:`openquake.shapes.Site` objects.
+    :returns:
+        `list` of (vs30_type, vs30, z1pt0, z2pt5) tuples, in site order.
+    """
+    cache = site_parameters_cache()
+    return cache.fetch(
+        job_ctxt.job_id, ('params', cache.digest(sites)), len(sites),
+        lambda: _site_parameters(job_ctxt, sites))
+
+
+def _site_parameters(job_ctxt, sites):
+    """Look up the site parameters, see :func:`site_parameters`."""
+    site_model = get_site_model(job_ctxt.oq_job.id)
+
+    if site_model is not None:
+        params = []
+        for site in sites:
+            sm_data = get_closest_site_model_data(site_model, site)
+            params.append((sm_data.vs30_type.capitalize(), sm_data.vs30,
+                           sm_data.z1pt0, sm_data.z2pt5))
+        return params
+    else:
+        jp = job_ctxt.oq_job_profile
+        return [(jp.vs30_type.capitalize(), jp.reference_vs30_value,
+                 jp.depth_to_1pt_0km_per_sec,
+                 jp.reference_depth_to_2pt5km_per_sec_param)] * len(sites)
+
+
 def get_iml_list(imls, intensity_measure_type):
     """Build the appropriate Arbitrary Discretized Func from the IMLs,
     based on the IMT"""
@@ -110,16 +281,19 @@ def preload(fn):
 
 
 @java.unpack_exception
-def generate_erf(job_id, cache):
+def generate_erf(job_id, cache, src_key=None):
     """ Generate the Earthquake Rupture Forecast from the source model data
     stored in the KVS.
 
     :param int job_id: id of the job
     :param cache: jpype instance of `org.gem.engine.hazard.redis.Cache`
+    :param str src_key: the KVS key of the source model, defaults to
+        :func:`openquake.kvs.tokens.source_model_key`
     :returns: jpype instance of
         `org.opensha.sha.earthquake.rupForecastImpl.GEM1.GEM1ERF`
     """
-    src_key = kvs.tokens.source_model_key(job_id)
+    if src_key is None:
+        src_key = kvs.tokens.source_model_key(job_id)
     job_key = kvs.tokens.generate_job_key(job_id)
 
     sources = java.jclass("JsonSerializer").getSourceListFromCache(
@@ -133,22 +307,25 @@ def generate_erf(job_id, cache):
     return erf
 
 
-def generate_gmpe_map(job_id, cache):
+def generate_gmpe_map(job_id, cache, gmpe_key=None):
     """ Generate the GMPE map from the GMPE data stored in the KVS.
 
     :param int job_id: id of the job
     :param cache: jpype instance of `org.gem.engine.hazard.redis.Cache`
+    :param str gmpe_key: the KVS key of the GMPE data, defaults to
+        :func:`openquake.kvs.tokens.gmpe_key`
     :returns: jpype instace of
         `HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>`
     """
-    gmpe_key = kvs.tokens.gmpe_key(job_id)
+    if gmpe_key is None:
+        gmpe_key = kvs.tokens.gmpe_key(job_id)
 
     gmpe_map = java.jclass(
         "JsonSerializer").getGmpeMapFromCache(cache, gmpe_key)
     return gmpe_map
 
 
-def store_source_model(job_id, seed, params, calc):
+def store_source_model(job_id, seed, params, calc, key=None):
     """Generate source model from the source model logic tree and store it in
     the KVS.
 
@@ -157,15 +334,18 @@ def store_source_model(job_id, seed, params, calc):
     :param dict params: the config parameters as (dict)
     :param calc: logic tree processor
     :type calc: :class:`openquake.input.logictree.LogicTreeProcessor` instance
+    :param str key: the KVS key to use, defaults to
+        :func:`openquake.kvs.tokens.source_model_key`
     """
     LOG.info("Storing source model from job config")
-    key = kvs.tokens.source_model_key(job_id)
+    if key is None:
+        key = kvs.tokens.source_model_key(job_id)
     mfd_bin_width = float(params.get('WIDTH_OF_MFD_BIN'))
     calc.sample_and_save_source_model_logictree(
         kvs.get_client(), key, seed, mfd_bin_width)
 
 
-def store_gmpe_map(job_id, seed, calc):
+def store_gmpe_map(job_id, seed, calc, key=None):
     """Generate a hash map of GMPEs (keyed by Tectonic Region Type) and store
     it in the KVS.
 
@@ -173,9 +353,12 @@ def store_gmpe_map(job_id, seed, calc):
     :param int seed: seed for random logic tree sampling
     :param calc: logic tree processor
     :type calc: :class:`openquake.input.logictree.LogicTreeProcessor` instance
+    :param str key: the KVS key to use, defaults to
+        :func:`openquake.kvs.tokens.gmpe_key`
     """
     LOG.info("Storing GMPE map from job config")
-    key = kvs.tokens.gmpe_key(job_id)
+    if key is None:
+        key = kvs.tokens.gmpe_key(job_id)
     calc.sample_and_save_gmpe_logictree(kvs.get_client(), key, seed)
 
 
@@ -218,11 +401,82 @@ def set_gmpe_params(gmpe_map, params):
         gmpe_map.put(tect_region, gmpe)
 
 
+def derive_seed(seed, index):
+    """Derive the seed of the index-th of a family of random number
+    generators from a master seed, so that the generators can be used
+    independently (e.g. by different tasks). Same as
+    `org.gem.calc.HazardCalculator.ruptureSeed()`.
+
+    >>> derive_seed(42, 0), derive_seed(42, 1)
+    (-4767286540954276203, 2949826092126892291)
+
+    :returns: a (signed, 64 bit) seed for `java.util.Random`
+    """
+    mask = (1 << 64) - 1
+    z = (seed + (index + 1) * 0x9E3779B97F4A7C15) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    z ^= z >> 31
+    if z >= 1 << 63:
+        z -= 1 << 64
+    return int(z)
+
+
+def _wkt_point_coords(wkt):
+    """Extract the (lon, lat) coordinates from a `POINT(lon lat)` WKT string.
+
+    >>> _wkt_point_coords('POINT(-122.5 37.5)')
+    (-122.5, 37.5)
+    """
+    lon, lat = wkt[wkt.index('(') + 1:wkt.rindex(')')].split()
+    return float(lon), float(lat)
+
+
 @transaction.commit_on_success(using='job_init')
+def store_site_model_bulk(input_mdl, source,
+                          chunk_size=SITE_MODEL_INSERT_CHUNK_SIZE):
+    """Invoke the site model parser and stream the site-specific parameter
+    data into the `hzrdi.site_model` table, using multi-row inserts of
+    ``chunk_size`` records each.
+
+    :param input_mdl:
+        The `uiapi.input` record which the new `hzrdi.site_model` records
+        reference. This `input` record acts as a container for the site model
+        data.
+    :param source:
+        Filename or file-like object containing the site model XML data.
+    :param int chunk_size:
+        Maximum number of records inserted by a single query.
+    :returns:
+        A `numpy.ndarray` of shape (N, 2) holding the (lon, lat) coordinates
+        of the N inserted site model nodes, in document order.
+    """
+    parser = nrml_parsers.SiteModelParser(source)
+    inserter = writer.BulkInserter(models.SiteModel)
+
+    coords = []
+
+    for node in parser.parse():
+        inserter.add_entry(
+            input_id=input_mdl.id, vs30=node.vs30, vs30_type=node.vs30_type,
+            z1pt0=node.z1pt0, z2pt5=node.z2pt5, location=node.wkt)
+        coords.append(_wkt_point_coords(node.wkt))
+
+        if inserter.count >= chunk_size:
+            inserter.flush()
+
+    inserter.flush()
+
+    return numpy.array(coords, dtype=numpy.float64).reshape((-1, 2))
+
+
 def store_site_model(input_mdl, source):
     """Invoke site model parser and save the site-specified parameter data to
     the database.
 
+    Same as :func:`store_site_model_bulk`, but returns the newly-inserted
+    records instead of their coordinates.
+
     :param input_mdl:
         The `uiapi.input` record which the new `hzrdi.site_model` records
         reference. This `input` record acts as a container for the site model
@@ -232,35 +486,76 @@ def store_site_model(input_mdl, source):
     :returns:
         `list` of :class:`openquake.db.models.SiteModel` objects. These
         represent to newly-inserted `hzrdi.site_model` records.
-    ."""
-    parser = nrml_parsers.SiteModelParser(source)
+    """
+    store_site_model_bulk(input_mdl, source)
 
-    sm_data = []
+    return list(models.SiteModel.objects.filter(
+        input=input_mdl).order_by('id'))
 
-    for node in parser.parse():
-        sm = models.SiteModel()
-        sm.vs30 = node.vs30
-        sm.vs30_type = node.vs30_type
-        sm.z1pt0 = node.z1pt0
-        sm.z2pt5 = node.z2pt5
-        sm.location = node.wkt
-        sm.input = input_mdl
-        sm.save()
-        sm_data.append(sm)
 
-    return sm_data
+def _points_in_polygon2d(vxx, vyy, pxx, pyy, tolerance=1e-9):
+    """Vectorized point-in-polygon test on a 2d (projected) polygon.
 
+    Points lying on an edge or on a vertex of the polygon (within
+    ``tolerance``) are considered inside.
 
-def validate_site_model(sm_nodes, sites):
-    """Given the geometry for a site model and the geometry of interest for the
-    calculation, make sure the geometry of interest lies completely inside of
-    the convex hull formed by the site model locations.
+    :param vxx, vyy:
+        `numpy.ndarray` with the coordinates of the polygon vertices; the
+        sequence must be closed (the last vertex equal to the first one).
+    :param pxx, pyy:
+        `numpy.ndarray` with the coordinates of the points to check.
+    :returns:
+        A boolean `numpy.ndarray` with the same shape as ``pxx``.
+
+    >>> square_x = numpy.array([0.0, 1.0, 1.0, 0.0, 0.0])
+    >>> square_y = numpy.array([0.0, 0.0, 1.0, 1.0, 0.0])
+    >>> _points_in_polygon2d(square_x, square_y,
+    ...                      numpy.array([0.5, 1.0, 0.0, 1.5]),
+    ...                      numpy.array([0.5, 0.5, 0.0, 0.5])).tolist()
+    [True, True, True, False]
+    """
+    inside = numpy.zeros(pxx.shape, dtype=bool)
+    on_boundary = numpy.zeros(pxx.shape, dtype=bool)
+
+    for i in xrange(len(vxx) - 1):
+        x1, y1, x2, y2 = vxx[i], vyy[i], vxx[i + 1], vyy[i + 1]
+        dx, dy = x2 - x1, y2 - y1
+
+        # Even-odd rule: count the edges crossed by a ray cast along the
+        # positive x axis.
+        crosses = (y1 > pyy) != (y2 > pyy)
+        if crosses.any():
+            x_cross = x1 + (pyy[crosses] - y1) * dx / dy
+            inside[crosses] ^= pxx[crosses] < x_cross
+
+        # Distance from each point to the edge segment.
+        seg_len2 = dx * dx + dy * dy
+        if seg_len2 > 0:
+            t = ((pxx - x1) * dx + (pyy - y1) * dy) / seg_len2
+            t = numpy.clip(t, 0.0, 1.0)
+        else:
+            t = numpy.zeros(pxx.shape)
+        dist2 = (pxx - (x1 + t * dx)) ** 2 + (pyy - (y1 + t * dy)) ** 2
+        on_boundary |= dist2 <= tolerance ** 2
 
-    If a site of interest lies directly on top of a vertex or edge of the site
-    model area (a polygon), it is considered "inside"
+    return inside | on_boundary
 
-    :param sm_nodes:
-        Sequence of :class:`~openquake.db.models.SiteModel` objects.
+
+def validate_site_model_coords(sm_coords, sites):
+    """Given the coordinates of the site model nodes and the geometry of
+    interest for the calculation, make sure the geometry of interest lies
+    completely inside of the convex hull formed by the site model locations.
+
+    The hull edges are great circle arcs, exactly as for an nhlib
+    :class:`~nhlib.geo.polygon.Polygon`: the hull is upsampled and projected
+    once, then all the sites of interest are checked against it with array
+    operations instead of one geometry operation per site. If a site of
+    interest lies directly on top of a vertex or edge of the site model area
+    (a polygon), it is considered "inside".
+
+    :param sm_coords:
+        `numpy.ndarray` of shape (N, 2) with the (lon, lat) coordinates of the
+        site model nodes (as returned by :func:`store_site_model_bulk`).
     :param sites:
         Sequence of :class:`~openquake.shapes.Site` objects which represent the
         calculation points of interest.
@@ -270,21 +565,24 @@ def validate_site_model(sm_nodes, sites):
         interest (given as a collection of sites) is not entirely contained by
         the site model.
     """
-    sm_mp = geometry.MultiPoint(
-        [(n.location.x, n.location.y) for n in sm_nodes]
-    )
-    sm_poly = nhlib_geo.Polygon(
-        [nhlib_geo.Point(*x) for x in sm_mp.convex_hull.exterior.coords]
-    )
+    hull = geometry.MultiPoint(sm_coords).convex_hull
+    # The exterior ring is closed, nhlib polygons are not.
+    hull_lons, hull_lats = numpy.array(hull.exterior.coords[:-1]).T
 
-    interest_mesh = nhlib_geo.Mesh.from_points_list(sites)
+    # Same projection and upsampling as `nhlib.geo.polygon.Polygon`, so that
+    # points close to the boundary are treated as in `Polygon.intersects`.
+    proj = nhlib_utils.get_orthographic_projection(
+        *nhlib_utils.get_spherical_bounding_box(hull_lons, hull_lats))
+    vxx, vyy = proj(
+        *nhlib_polygon.get_resampled_coordinates(hull_lons, hull_lats))
+    vxx = numpy.append(vxx, vxx[0])
+    vyy = numpy.append(vyy, vyy[0])
 
-    # "Intersects" is the correct operation (not "contains"), since we're just
-    # checking a collection of points (mesh). "Contains" would tell us if the
-    # points are inside the polygon, but would return `False` if a point was
-    # directly on top of a polygon edge or vertex. We want these points to be
-    # included.
-    intersects = sm_poly.intersects(interest_mesh)
+    pxx, pyy = proj(numpy.array([s.longitude for s in sites]),
+                    numpy.array([s.latitude for s in sites]))
+
+    intersects = _points_in_polygon2d(
+        vxx, vyy, numpy.asarray(pxx), numpy.asarray(pyy))
 
     if not intersects.all():
         raise ValidationException(
@@ -293,6 +591,28 @@ def validate_site_model(sm_nodes, sites):
         )
 
 
+def validate_site_model(sm_nodes, sites):
+    """Given the geometry for a site model and the geometry of interest for the
+    calculation, make sure the geometry of interest lies completely inside of
+    the convex hull formed by the site model locations.
+
+    See :func:`validate_site_model_coords`.
+
+    :param sm_nodes:
+        Sequence of :class:`~openquake.db.models.SiteModel` objects.
+    :param sites:
+        Sequence of :class:`~openquake.shapes.Site` objects which represent the
+        calculation points of interest.
+
+    :raises:
+        :exc:`openquake.job.config.ValidationException` if the area of
+        interest (given as a collection of sites) is not entirely contained by
+        the site model.
+    """
+    validate_site_model_coords(
+        numpy.array([(n.location.x, n.location.y) for n in sm_nodes]), sites)
+
+
 def get_site_model(job_id):
     """Get the site model :class:`~openquake.db.models.Input` record for the
     given job id.
@@ -408,12 +728,12 @@ class BaseHazardCalculator(Calculator):
             # Explicit cast to `str` here because the XML parser doesn't like
             # unicode. (More specifically, lxml doesn't like unicode.)
             site_model_content = str(site_model.model_content.raw_content)
-            site_model_data = store_site_model(
+            sm_coords = store_site_model_bulk(
                 site_model, StringIO.StringIO(site_model_content)
             )
 
-            validate_site_model(
-                site_model_data, self.job_ctxt.sites_to_compute()
+            validate_site_model_coords(
+                sm_coords, self.job_ctxt.sites_to_compute()
             )
 
     def pre_execute(self):
@@ -430,32 +750,33 @@ class BaseHazardCalculator(Calculator):
         """Calculation logic goes here; subclasses must implement this."""
         raise NotImplementedError()
 
-    def store_source_model(self, seed):
+    def store_source_model(self, seed, key=None):
         """Generates a source model from the source model logic tree."""
         if getattr(self, "calc", None) is None:
             self.pre_execute()
         store_source_model(self.job_ctxt.job_id, seed,
-                           self.job_ctxt.params, self.calc)
+                           self.job_ctxt.params, self.calc, key)
 
-    def store_gmpe_map(self, seed):
+    def store_gmpe_map(self, seed, key=None):
         """Generates a hash of tectonic regions and GMPEs, using the logic tree
         specified in the job config file."""
         if getattr(self, "calc", None) is None:
             self.pre_execute()
-        store_gmpe_map(self.job_ctxt.job_id, seed, self.calc)
+        store_gmpe_map(self.job_ctxt.job_id, seed, self.calc, key)
 
-    def generate_erf(self):
+    def generate_erf(self, src_key=None):
         """Generate the Earthquake Rupture Forecast from the currently stored
         source model logic tree."""
-        return generate_erf(self.job_ctxt.job_id, self.cache)
+        return generate_erf(self.job_ctxt.job_id, self.cache, src_key)
 
     def set_gmpe_params(self, gmpe_map):
         """Push parameters from configuration file into the GMPE objects"""
         set_gmpe_params(gmpe_map, self.job_ctxt.params)
 
-    def generate_gmpe_map(self):
+    def generate_gmpe_map(self, gmpe_key=None):
         """Generate the GMPE map from the stored GMPE logic tree."""
-        gmpe_map = generate_gmpe_map(self.job_ctxt.job_id, self.cache)
+        gmpe_map = generate_gmpe_map(self.job_ctxt.job_id, self.cache,
+                                     gmpe_key)
         self.set_gmpe_params(gmpe_map)
         return gmpe_map
 
@@ -470,7 +791,11 @@ class BaseHazardCalculator(Calculator):
         site-specific parameters. This method handles both cases.
 
         NOTE: If a `SITE_MODEL` is used, it needs to be properly stored first.
-        See :function:`~openquake.calculators.hazard.general.store_site_model`.
+        See :function:`store_site_model_bulk`.
+
+        The resulting site lists are cached by the worker process (see
+        :func:`site_cache`) and reused whenever the same sites are
+        parameterized again for the same job.
 
         :param site_list:
             `list` of :class:`~openquake.shapes.Site` objects.
@@ -481,6 +806,15 @@ class BaseHazardCalculator(Calculator):
         # make sure the JVM is started
         java.jvm()
 
+        cache = site_cache()
+        return cache.fetch(
+            self.job_ctxt.job_id, ('jsites', cache.digest(site_list)),
+            len(site_list), lambda: self._parameterize_sites(site_list))
+
+    def _parameterize_sites(self, site_list):
+        """Build the parameterized Java site list, see
+        :meth:`parameterize_sites`."""
+
         # the return value
         jsite_list = java.jclass("ArrayList")()
 
@@ -22,16 +22,54 @@ event based approach.
 
 import os
 import math
+import functools
+import itertools
 import jpype
-import json
+import numpy
+
+from celery.task import task
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
 from openquake.calculators.hazard.general import BaseHazardCalculator
+from openquake.calculators.hazard.general import derive_seed
+from openquake.calculators.hazard.scenario import gmf as numpy_gmf
 from openquake.output import hazard as hazard_output
+from openquake.utils import config
 from openquake.utils import stats
+from openquake.utils import tasks as utils_tasks
+
+# Number of realizations whose ground motion values are appended at once to
+# the per site arrays.
+GMV_APPEND_CHUNK_SIZE = 100
+
+# Per worker process cache of the numpy ground motion field generator of the
+# last job: job_id -> gmf.GmfGenerator
+_GMF_GENERATOR_CACHE = {}
+
+# Per worker process cache of the ground motion field calculator of the
+# last job, holding the cholesky decomposition of the covariance matrix of
+# the correlated fields: job_id -> GroundMotionFieldCalculator
+_GMF_CALCULATOR_CACHE = {}
+
+
+@task
+@java.unpack_exception
+@stats.count_progress("h", data_arg="realizations")
+def compute_ground_motion_fields(job_id, realizations):
+    """Compute (and serialize, if requested) the scenario ground motion
+    fields with the given indices and store their values in the KVS.
+
+    :param int job_id: the id of the job
+    :param realizations: the consecutive indices of the ground motion fields
+    :type realizations: list of ints
+    :returns: the number of fields computed
+    """
+    calculator = utils_tasks.calculator_for_task(job_id, 'hazard')
+
+    return calculator.store_ground_motion_fields(realizations)
 
 
 class ScenarioHazardCalculator(BaseHazardCalculator):
@@ -53,15 +91,40 @@ class ScenarioHazardCalculator(BaseHazardCalculator):
     def execute(self):
         """Entry point to trigger the computation."""
 
-        random_generator = java.jclass(
-            "Random")(int(self.job_ctxt.params["GMF_RANDOM_SEED"]))
-
-        encoder = json.JSONEncoder()
-        kvs_client = kvs.get_client()
+        seed = int(self.job_ctxt.params["GMF_RANDOM_SEED"])
 
         num_calculations = self._number_of_calculations()
         self.initialize_pr_data(num_calculations=num_calculations)
 
+        chunk_size = config.hazard_scenario_gmf_chunk_size()
+        if chunk_size:
+            self.distribute_ground_motion_fields(num_calculations, chunk_size)
+            return
+
+        gmv_store = GmvArrayStore(self.job_ctxt.job_id)
+        random_generator = self.new_random_generator(seed)
+        if self.batch_gmfs():
+            for first in xrange(0, num_calculations, GMV_APPEND_CHUNK_SIZE):
+                realizations = range(
+                    first, min(first + GMV_APPEND_CHUNK_SIZE,
+                               num_calculations))
+                try:
+                    coords, fields = self.compute_gmfs(
+                        [random_generator] * len(realizations))
+                    stats.pk_inc(self.job_ctxt.job_id, "nhzrd_done",
+                                 len(realizations))
+                except:
+                    # Count failure
+                    stats.pk_inc(self.job_ctxt.job_id, "nhzrd_failed", 1)
+                    raise
+                logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
+                for cnum, values in zip(realizations, fields.T):
+                    self._save_gmf(coords, values, cnum)
+                    gmv_store.add(coords, values)
+            gmv_store.flush()
+            self._close_gmf_set()
+            return
+
         for cnum in xrange(num_calculations):
             try:
                 gmf = self.compute_ground_motion_field(random_generator)
@@ -72,14 +135,163 @@ class ScenarioHazardCalculator(BaseHazardCalculator):
                 raise
             logs.log_percent_complete(self.job_ctxt.job_id, "hazard")
             imt = self.job_ctxt.params["INTENSITY_MEASURE_TYPE"]
-            self._serialize_gmf(gmf, imt, cnum)
+            coords, values = gmf_to_arrays(gmf, imt)
+            if self.single_gmf_file():
+                self._add_to_gmf_set(coords, values)
+            else:
+                self._serialize_gmf(gmf, imt, cnum)
+
+            gmv_store.add(coords, values)
+        gmv_store.flush()
+        self._close_gmf_set()
+
+    def distribute_ground_motion_fields(self, num_calculations, chunk_size):
+        """Compute the ground motion fields in tasks of `chunk_size` fields.
+
+        Each field is computed with its own random number generator, seeded
+        with :func:`derive_seed` from GMF_RANDOM_SEED and the field index:
+        the fields do not depend on the chunk size.
+
+        The workers store the values of their fields in the KVS, at the
+        position of the field indices (see :class:`GmvArrayStore`), so the
+        tasks are collected in completion order; at most
+        `scenario_gmf_tasks_in_flight` (see openquake.cfg) are running at
+        any time.
+
+        The fields are serialized by the workers, unless they are all saved
+        to a single file (see :meth:`single_gmf_file`): then they are read
+        back from the KVS and added to the file in field order, as soon as
+        the fields preceding them are computed."""
+        job_id = self.job_ctxt.job_id
+        submissions = (
+            (functools.partial(
+                compute_ground_motion_fields.delay, job_id,
+                realizations=range(first, min(first + chunk_size,
+                                              num_calculations))), first)
+            for first in xrange(0, num_calculations, chunk_size))
+
+        gmv_store = None
+        if self.single_gmf_file():
+            gmv_store = GmvArrayStore(job_id)
+            coords = self.site_coords()
+        completed = set()
+        next_first = 0
+
+        pipeline = utils_tasks.TaskPipeline(
+            config.hazard_scenario_gmf_tasks_in_flight())
+        for each_task, first in pipeline.run(submissions):
+            if each_task.status != 'SUCCESS':
+                raise Exception(each_task.result)
+            logs.log_percent_complete(job_id, "hazard")
+
+            if gmv_store is None:
+                continue
+            completed.add(first)
+            while next_first in completed:
+                completed.remove(next_first)
+                count = min(chunk_size, num_calculations - next_first)
+                fields = gmv_store.read(coords, next_first, count)
+                for values in fields.T:
+                    self._add_to_gmf_set(coords, values)
+                next_first += count
+        self._close_gmf_set()
+
+    def store_ground_motion_fields(self, realizations):
+        """Compute (and serialize, if requested) the ground motion fields
+        with the given consecutive indices and store their values in the KVS,
+        at the position of the indices; runs on the workers.
+
+        :returns: the number of fields computed
+        """
+        coords, fields = self.compute_ground_motion_fields(realizations)
+
+        gmv_store = GmvArrayStore(self.job_ctxt.job_id, first=realizations[0])
+        for values in fields:
+            gmv_store.add(coords, values)
+        gmv_store.flush()
+
+        return len(fields)
+
+    def compute_ground_motion_fields(self, realizations):
+        """Compute (and serialize, if requested) the ground motion fields
+        with the given indices; runs on the workers.
+
+        :returns: the (lon, lat) pairs of the sites and, for each field, the
+            list of its ground motion values, aligned with the sites
+        """
+        seed = int(self.job_ctxt.params["GMF_RANDOM_SEED"])
+        imt = self.job_ctxt.params["INTENSITY_MEASURE_TYPE"]
+        # a single file is written by the job executor process
+        serialize = not self.single_gmf_file()
+
+        if self.batch_gmfs():
+            coords, fields = self.compute_gmfs([
+                self.new_random_generator(derive_seed(seed, cnum))
+                for cnum in realizations])
+            if serialize:
+                for cnum, values in zip(realizations, fields.T):
+                    self._serialize_gmf_values(coords, values, cnum)
+            return coords, fields.T.tolist()
+
+        coords = None
+        fields = []
+        for cnum in realizations:
+            random_generator = self.new_random_generator(
+                derive_seed(seed, cnum))
+            gmf = self.compute_ground_motion_field(random_generator)
+            if serialize:
+                self._serialize_gmf(gmf, imt, cnum)
+            gmf_coords, values = gmf_to_arrays(gmf, imt)
+            if coords is None:
+                coords = gmf_coords
+            fields.append(align_gmvs(coords, gmf_coords, values).tolist())
+        return coords, fields
+
+    def single_gmf_file(self):
+        """Return `True` if all the ground motion fields are saved
+        (SAVE_GMFS) to a single NRML file, `gmfs.xml`, instead of a
+        `gmf-<n>.xml` file per field (see the `scenario_gmfs_single_file`
+        and `scenario_gmfs_hdf5` settings in openquake.cfg)."""
+        return bool(self.job_ctxt['SAVE_GMFS']) and config.flag_set(
+            "hazard", "scenario_gmfs_single_file")
+
+    def _save_gmf(self, coords, values, cnum):
+        """Save (if requested) the GMF with the given ground motion
+        `values` at the sites with the given (lon, lat) `coords`, either to
+        the single GMF set file or to its own file."""
+        if self.single_gmf_file():
+            self._add_to_gmf_set(coords, values)
+        else:
+            self._serialize_gmf_values(coords, values, cnum)
 
-            for gmv in gmf_to_dict(gmf, imt):
-                site = shapes.Site(gmv["site_lon"], gmv["site_lat"])
+    def _add_to_gmf_set(self, coords, values):
+        """Queue a GMF for serialization to the single GMF set file (and
+        to the HDF5 file with the matrix of all the fields, if requested).
 
-                key = kvs.tokens.ground_motion_values_key(
-                    self.job_ctxt.job_id, site)
-                kvs_client.rpush(key, encoder.encode(gmv))
+        The serialization runs on a background thread, started when the
+        first field is added."""
+        gmf_set_writer = getattr(self, "gmf_set_writer", None)
+
+        if gmf_set_writer is None:
+            path = os.path.join(self.job_ctxt.base_path,
+                                self.job_ctxt['OUTPUT_DIR'], "gmfs")
+            hdf5_path = None
+            if config.flag_set("hazard", "scenario_gmfs_hdf5"):
+                hdf5_path = path + ".hdf5"
+            gmf_set_writer = hazard_output.GmfSetWriter(
+                self.job_ctxt.job_id, self.job_ctxt.serialize_results_to,
+                path + ".xml", coords, hdf5_path=hdf5_path)
+            setattr(self, "gmf_set_writer", gmf_set_writer)
+
+        gmf_set_writer.add(align_gmvs(gmf_set_writer.coords, coords, values))
+
+    def _close_gmf_set(self):
+        """Wait for the serialization of the GMF set to complete."""
+        gmf_set_writer = getattr(self, "gmf_set_writer", None)
+
+        if gmf_set_writer is not None:
+            gmf_set_writer.close()
+            setattr(self, "gmf_set_writer", None)
 
     def _serialize_gmf(self, hashmap, imt, cnum):
         """Write the GMF as returned by the java calculator to file.
@@ -102,16 +314,37 @@ class ScenarioHazardCalculator(BaseHazardCalculator):
         if not self.job_ctxt['SAVE_GMFS']:
             return False
 
+        self._write_gmf(_prepare_gmf_serialization(hashmap, imt), cnum)
+
+        return True
+
+    def _serialize_gmf_values(self, coords, values, cnum):
+        """Write to file the GMF with the given ground motion `values`
+        (already exponentiated, unless the intensity measure type is "MMI")
+        at the sites with the given (lon, lat) `coords`.
+
+        :returns: `True` if the GMF was serialized, `False` otherwise.
+        """
+        if not self.job_ctxt['SAVE_GMFS']:
+            return False
+
+        gmf_data = dict(
+            (shapes.Site(lon, lat), {'groundMotion': float(value)})
+            for (lon, lat), value in zip(coords, values))
+        self._write_gmf(gmf_data, cnum)
+
+        return True
+
+    def _write_gmf(self, gmf_data, cnum):
+        """Write the GMF in the format expected by the GMF serializer (see
+        :func:`_prepare_gmf_serialization`) to file."""
         path = os.path.join(self.job_ctxt.base_path,
                             self.job_ctxt['OUTPUT_DIR'], "gmf-%s.xml" % cnum)
         gmf_writer = hazard_output.create_gmf_writer(
             self.job_ctxt.job_id, self.job_ctxt.serialize_results_to, path)
 
-        gmf_data = _prepare_gmf_serialization(hashmap, imt)
         gmf_writer.serialize(gmf_data)
 
-        return True
-
     def _number_of_calculations(self):
         """Return the number of calculations to trigger.
 
@@ -143,17 +376,145 @@ class ScenarioHazardCalculator(BaseHazardCalculator):
 
         calculator = self.gmf_calculator(self.job_ctxt.sites_to_compute())
 
-        if (self.job_ctxt.params["GROUND_MOTION_CORRELATION"].lower()
-            == "true"):
+        if self.correlated_gmfs():
             return calculator.getCorrelatedGroundMotionField_JB2009(
                 random_generator)
         else:
             return calculator.getUncorrelatedGroundMotionField(
                 random_generator)
 
+    def correlated_gmfs(self):
+        """Return `True` if the ground motion fields are spatially
+        correlated (GROUND_MOTION_CORRELATION)."""
+        return (self.job_ctxt.params["GROUND_MOTION_CORRELATION"].lower()
+                == "true")
+
+    @property
+    def gmf_engine(self):
+        """The configured ground motion field engine, "java" or "numpy"
+        (see :func:`openquake.utils.config.hazard_scenario_gmf_engine`)."""
+        return config.hazard_scenario_gmf_engine()
+
+    def batch_gmfs(self):
+        """Return `True` if the ground motion fields are computed in
+        batches (see :meth:`compute_gmfs`): with the numpy engine or when
+        the fields are spatially correlated."""
+        return self.gmf_engine == "numpy" or self.correlated_gmfs()
+
+    def new_random_generator(self, seed):
+        """Return a random number generator with the given seed for the
+        configured ground motion field engine: a jpype wrapper around an
+        instance of java.util.Random or a
+        :class:`numpy.random.RandomState`."""
+        if self.gmf_engine == "numpy":
+            return numpy_gmf.random_state(seed)
+        return java.jclass("Random")(jpype.JLong(seed))
+
+    def compute_gmfs(self, random_generators):
+        """Compute a batch of ground motion fields for the entire region,
+        one for each of the given generators (see
+        :meth:`new_random_generator`), with the configured engine.
+
+        :returns: the list of the (lon, lat) pairs of the sites and the
+            [sites, fields] array of the ground motion values (the
+            exponentials of the values computed by the GMPE, unless the
+            intensity measure type is "MMI")
+        """
+        if self.gmf_engine != "numpy":
+            return self.compute_correlated_gmfs(random_generators)
+
+        generator = self.numpy_gmf_generator()
+        # consecutive fields sharing a generator are drawn at once
+        fields = numpy.hstack([
+            generator.generate(rng, len(list(group)))
+            for rng, group in itertools.groupby(random_generators)])
+        if self.job_ctxt.params["INTENSITY_MEASURE_TYPE"].lower() != "mmi":
+            fields = numpy.exp(fields)
+
+        return self.site_coords(), fields
+
+    def numpy_gmf_generator(self):
+        """Return the numpy ground motion field generator of the job.
+
+        The mean ground motion and the standard deviations at the sites
+        (and, for correlated fields, the cholesky decomposition of the
+        covariance matrix) are computed once per job and worker process.
+
+        :returns: a :class:`numpy_gmf.GmfGenerator`
+        """
+        job_id = self.job_ctxt.job_id
+        generator = _GMF_GENERATOR_CACHE.get(job_id)
+
+        if generator is None:
+            calculator = self.gmf_calculator(self.job_ctxt.sites_to_compute())
+            statistics = numpy.array(
+                [row[:] for row in calculator.getGroundMotionStatistics()],
+                dtype=float)
+
+            correlation = None
+            if self.correlated_gmfs():
+                lons, lats = zip(*self.site_coords())
+                period = 0.0
+                if (self.job_ctxt.params["INTENSITY_MEASURE_TYPE"].upper()
+                    == "SA"):
+                    period = float(self.job_ctxt.params["PERIOD"])
+                correlation = (lons, lats, period,
+                               bool(calculator.isJB2009_Vs30ClusterParam()))
+
+            generator = numpy_gmf.GmfGenerator(
+                statistics, self.job_ctxt.params["GMPE_TRUNCATION_TYPE"],
+                float(self.job_ctxt.params["TRUNCATION_LEVEL"]), correlation,
+                inter_event=bool(calculator.isInterEvent()))
+
+            _GMF_GENERATOR_CACHE.clear()
+            _GMF_GENERATOR_CACHE[job_id] = generator
+
+        return generator
+
+    def site_coords(self):
+        """Return the (lon, lat) pairs of the sites of the ground motion
+        field calculator, in its order."""
+        calculator = self.gmf_calculator(self.job_ctxt.sites_to_compute())
+        coords = []
+        for site in calculator.getSites():
+            location = site.getLocation()
+            coords.append((location.getLongitude(), location.getLatitude()))
+        return coords
+
+    def compute_correlated_gmfs(self, random_generators):
+        """Compute a batch of spatially correlated ground motion fields for
+        the entire region, one for each of the given generators.
+
+        The covariance matrix of the intra-event residuals and its cholesky
+        decomposition are computed only once per job and worker process (see
+        :meth:`gmf_calculator`); the residuals of the whole batch are then
+        obtained by a single matrix product. Passing the same generator n
+        times gives the same fields as n calls of
+        :meth:`compute_ground_motion_field`.
+
+        :param random_generators: jpype wrappers around instances of
+            java.util.Random
+        :returns: the list of the (lon, lat) pairs of the sites and the
+            [sites, fields] array of the ground motion values (the
+            exponentials of the values computed by the java calculator,
+            unless the intensity measure type is "MMI")
+        """
+        calculator = self.gmf_calculator(self.job_ctxt.sites_to_compute())
+
+        fields = calculator.getCorrelatedGroundMotionFields_JB2009(
+            jpype.JArray(java.jclass("Random"))(random_generators))
+        fields = numpy.array([row[:] for row in fields], dtype=float)
+        if self.job_ctxt.params["INTENSITY_MEASURE_TYPE"].lower() != "mmi":
+            fields = numpy.exp(fields)
+
+        return self.site_coords(), fields
+
     def gmf_calculator(self, sites):
         """Return the ground motion field calculator.
 
+        The calculator is cached by the worker process and reused by all the
+        tasks of the same job.
+
         :param sites: sites used to compute the ground motion field.
         :type sites: list of :py:class:`shapes.Site`
         :returns: jpype wrapper around an instance of
@@ -163,10 +524,17 @@ class ScenarioHazardCalculator(BaseHazardCalculator):
         calculator = getattr(self, "calculator", None)
 
         if calculator is None:
-            sites = self.parameterize_sites(sites)
+            job_id = self.job_ctxt.job_id
+            calculator = _GMF_CALCULATOR_CACHE.get(job_id)
+
+            if calculator is None:
+                sites = self.parameterize_sites(sites)
 
-            calculator = java.jclass(
-                "GMFCalculator")(self.gmpe, self.rupture_model, sites)
+                calculator = java.jclass(
+                    "GMFCalculator")(self.gmpe, self.rupture_model, sites)
+
+                _GMF_CALCULATOR_CACHE.clear()
+                _GMF_CALCULATOR_CACHE[job_id] = calculator
 
             setattr(self, "calculator", calculator)
 
@@ -262,6 +630,115 @@ def gmf_to_dict(hashmap, intensity_measure_type):
         yield gmv
 
 
+def gmf_to_arrays(hashmap, intensity_measure_type):
+    """Transform the ground motion field as returned by the java
+    calculator (see :func:`gmf_to_dict`) into arrays.
+
+    :returns: the list of the (lon, lat) pairs of the sites and the array of
+        the ground motion values (the exponentials of the values computed by
+        the java calculator, unless the intensity measure type is "MMI"),
+        in the iteration order of `hashmap`
+    """
+    coords = []
+    values = []
+    for site in hashmap.keySet():
+        values.append(hashmap.get(site).doubleValue())
+        location = site.getLocation()
+        coords.append((location.getLongitude(), location.getLatitude()))
+
+    values = numpy.array(values, dtype=float)
+    if intensity_measure_type.lower() != "mmi":
+        values = numpy.exp(values)
+
+    return coords, values
+
+
+def align_gmvs(ref_coords, coords, values):
+    """Reorder the ground motion `values` at the sites with the given
+    `coords` to follow the order of `ref_coords`.
+
+    >>> align_gmvs([(0, 0), (1, 1)], [(1, 1), (0, 0)], [0.5, 0.25]).tolist()
+    [0.25, 0.5]
+    """
+    values = numpy.asarray(values)
+    if coords == ref_coords:
+        return values
+    positions = dict((coord, i) for i, coord in enumerate(coords))
+    return values[[positions[coord] for coord in ref_coords]]
+
+
+class GmvArrayStore(object):
+    """Store the ground motion values of consecutive realizations in the
+    KVS, as one array per site (see
+    :func:`openquake.kvs.tokens.ground_motion_values_array_key`).
+
+    The values are buffered and written to the per site arrays by blocks
+    of `chunk_size` realizations, at the position of their indices: the
+    first realization added is the one with index `first`. Stores of
+    disjoint ranges of realizations can thus write in any order.
+    """
+
+    def __init__(self, job_id, chunk_size=GMV_APPEND_CHUNK_SIZE, first=0):
+        self.job_id = job_id
+        self.chunk_size = chunk_size
+        self.first = first
+        self.coords = None
+        self.keys = None
+        self.columns = []
+
+    def _set_coords(self, coords):
+        """Set the (lon, lat) pairs of the sites and their keys."""
+        self.coords = coords
+        self.keys = [
+            kvs.tokens.ground_motion_values_array_key(
+                self.job_id, shapes.Site(lon, lat))
+            for lon, lat in coords]
+
+    def add(self, coords, values):
+        """Add the ground motion values of a realization.
+
+        :param coords: the (lon, lat) pairs of the sites
+        :param values: the ground motion values, aligned with `coords`
+        """
+        if self.coords is None:
+            self._set_coords(coords)
+        self.columns.append(align_gmvs(self.coords, coords, values))
+        if len(self.columns) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered values to the per site arrays."""
+        if not self.columns:
+            return
+        gmvs = numpy.column_stack(self.columns).astype(
+            kvs.tokens.GMV_ARRAY_DTYPE)
+        offset = self.first * gmvs.itemsize
+        pipe = kvs.get_client().pipeline(transaction=False)
+        for key, site_gmvs in zip(self.keys, gmvs):
+            pipe.setrange(key, offset, site_gmvs.tostring())
+        pipe.execute()
+        self.first += len(self.columns)
+        self.columns = []
+
+    def read(self, coords, first, count):
+        """Read the values of `count` realizations, starting from the one
+        with index `first`, at the sites with the given (lon, lat) `coords`.
+
+        :returns: the [sites, realizations] array of the values
+        """
+        if self.coords is None:
+            self._set_coords(coords)
+        itemsize = numpy.dtype(kvs.tokens.GMV_ARRAY_DTYPE).itemsize
+        pipe = kvs.get_client().pipeline(transaction=False)
+        for key in self.keys:
+            pipe.getrange(key, first * itemsize,
+                          (first + count) * itemsize - 1)
+        gmvs = numpy.array([
+            numpy.frombuffer(data, dtype=kvs.tokens.GMV_ARRAY_DTYPE)
+            for data in pipe.execute()], dtype=float)
+        return align_gmvs(coords, self.coords, gmvs)
+
+
 def _prepare_gmf_serialization(hashmap, imt):
     """Returns a GMF in the format expected by the GMF serializer.
 
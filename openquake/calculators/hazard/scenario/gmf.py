@@ -0,0 +1,208 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Numpy generation of scenario ground motion fields.
+
+The mean ground motion and the standard deviations at the sites are
+computed once (see
+:meth:`org.gem.calc.GroundMotionFieldCalculator.getGroundMotionStatistics`);
+the ground motion fields are then drawn as arrays, following the model of
+the Java ground motion field calculator: a single (truncated) inter-event
+residual per field, with the inter-event standard deviation of the last
+site, and (truncated) intra-event residuals per site, correlated according
+to Jayaram & Baker (2009) if requested.
+"""
+
+import numpy
+
+# Rows of the array returned by getGroundMotionStatistics()
+MEAN, TOTAL_STD, INTER_STD, INTRA_STD = range(4)
+
+# Mean earth radius (km) used by OpenSHA to compute horizontal distances.
+EARTH_RADIUS = 6371.0072
+
+# Distances larger than this number of correlation ranges have no
+# correlation (the default of the Java calculator).
+CORRELATION_TRUNCATION_LEVEL = 2.0
+
+
+def random_state(seed):
+    """Return a numpy random number generator for the given (Python or
+    Java long) integer seed.
+
+    >>> random_state(-1).randint(1000) == random_state(2 ** 64 - 1).randint(
+    ...     1000)
+    True
+    """
+    seed = int(seed) & 0xffffffffffffffff
+    return numpy.random.RandomState([seed & 0xffffffff, seed >> 32])
+
+
+def truncated_normal(rng, size, truncation_type, truncation_level):
+    """Draw standard Gaussian deviates, redrawing the ones beyond the
+    truncation level like the Java ground motion field calculator does.
+
+    >>> devs = truncated_normal(random_state(1), 1000, "2 Sided", 0.5)
+    >>> bool(abs(devs).max() <= 0.5)
+    True
+
+    :param rng: a :class:`numpy.random.RandomState`
+    :param size: the shape of the returned array
+    :param str truncation_type: "None", "1 Sided" (upper truncation) or
+        "2 Sided" (the values of GMPE_TRUNCATION_TYPE)
+    :param float truncation_level: the truncation level, in units of
+        standard deviation
+    """
+    devs = rng.standard_normal(size)
+    truncation_type = truncation_type.lower()
+    if truncation_type == "2 sided":
+        rejected = lambda values: abs(values) > truncation_level
+    elif truncation_type == "1 sided":
+        rejected = lambda values: values > truncation_level
+    else:
+        return devs
+
+    mask = rejected(devs)
+    while mask.any():
+        devs[mask] = rng.standard_normal(mask.sum())
+        mask = rejected(devs)
+    return devs
+
+
+def horizontal_distances(lons, lats):
+    """Return the matrix of the horizontal (haversine) distances, in km,
+    between the points with the given coordinates (in decimal degrees).
+
+    >>> horizontal_distances([0, 0], [0, 1]).round(1).tolist()
+    [[0.0, 111.2], [111.2, 0.0]]
+    """
+    lons = numpy.radians(lons)
+    lats = numpy.radians(lats)
+    dlat = lats[:, None] - lats[None, :]
+    dlon = lons[:, None] - lons[None, :]
+    hav = (numpy.sin(dlat / 2.0) ** 2
+           + numpy.cos(lats[:, None]) * numpy.cos(lats[None, :])
+           * numpy.sin(dlon / 2.0) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(hav, 1)))
+
+
+def jb2009_correlation_range(period, vs30_cluster=False):
+    """Return the correlation range (km) of the intra-event residuals of
+    Jayaram & Baker (2009) for the given spectral period (0 for PGA).
+
+    >>> jb2009_correlation_range(0.0)
+    8.5
+    >>> jb2009_correlation_range(0.0, vs30_cluster=True)
+    40.7
+
+    :param bool vs30_cluster: `True` if the Vs30 values of the sites are
+        clustered (see `setJB2009_Vs30ClusterParam()` of the Java
+        calculator)
+    """
+    if period >= 1:
+        return 22.0 + 3.7 * period
+    elif vs30_cluster:
+        return 40.7 - 15.0 * period
+    else:
+        return 8.5 + 17.2 * period
+
+
+def jb2009_covariance(lons, lats, intra_std, period, vs30_cluster=False):
+    """Return the covariance matrix of the intra-event residuals at the
+    given sites, according to the correlation model of Jayaram & Baker
+    (2009), as the Java ground motion field calculator computes it.
+
+    :param intra_std: the intra-event standard deviations at the sites
+    :param bool vs30_cluster: see :func:`jb2009_correlation_range`
+    """
+    correlation_range = jb2009_correlation_range(period, vs30_cluster)
+    distances = horizontal_distances(lons, lats)
+    correlation = numpy.exp(-3 * distances / correlation_range)
+    correlation[distances >
+                CORRELATION_TRUNCATION_LEVEL * correlation_range] = 0
+    intra_std = numpy.asarray(intra_std)
+    return correlation * intra_std[:, None] * intra_std[None, :]
+
+
+class GmfGenerator(object):
+    """Generate ground motion fields at a fixed set of sites as numpy
+    arrays.
+
+    :param statistics: the mean ground motion and the total, inter- and
+        intra-event standard deviations at the sites, as returned by
+        `getGroundMotionStatistics()` (NaN for the missing standard
+        deviation types)
+    :param str truncation_type: the GMPE_TRUNCATION_TYPE
+    :param float truncation_level: the TRUNCATION_LEVEL
+    :param correlation: `None` for uncorrelated fields, or the (lons, lats,
+        period, vs30_cluster) of the sites, for fields correlated according
+        to Jayaram & Baker (2009) (see :func:`jb2009_covariance`)
+    :param bool inter_event: `False` to leave the inter-event residual out
+        of the correlated fields (see `setInterEvent()` of the Java
+        calculator); the uncorrelated fields always include it
+    """
+
+    def __init__(self, statistics, truncation_type, truncation_level,
+                 correlation=None, inter_event=True):
+        statistics = numpy.asarray(statistics, dtype=float)
+        self.mean = statistics[MEAN]
+        self.total_std = statistics[TOTAL_STD]
+        self.inter_std = statistics[INTER_STD]
+        self.intra_std = statistics[INTRA_STD]
+        self.truncation_type = truncation_type
+        self.truncation_level = truncation_level
+        self.inter_intra = not (numpy.isnan(self.inter_std).any()
+                                or numpy.isnan(self.intra_std).any())
+        self.inter_event = inter_event or correlation is None
+
+        self.lower_triangular = None
+        if correlation is not None:
+            if not self.inter_intra:
+                raise ValueError(
+                    "The specified attenuation relationship does not provide"
+                    " inter-event and intra-event standard deviations")
+            lons, lats, period, vs30_cluster = correlation
+            # computed once, for all the fields
+            self.lower_triangular = numpy.linalg.cholesky(
+                jb2009_covariance(lons, lats, self.intra_std, period,
+                                  vs30_cluster))
+
+    def generate(self, rng, num_fields):
+        """Draw `num_fields` ground motion fields.
+
+        :param rng: a :class:`numpy.random.RandomState`
+        :returns: the [sites, fields] array of the ground motion values (in
+            the units of the GMPE, i.e. natural logarithms, except for MMI)
+        """
+        num_sites = len(self.mean)
+        draw = lambda size: truncated_normal(
+            rng, size, self.truncation_type, self.truncation_level)
+
+        if not self.inter_intra:
+            return (self.mean[:, None]
+                    + self.total_std[:, None] * draw((num_sites, num_fields)))
+
+        inter = 0.0
+        if self.inter_event:
+            # the Java calculator draws a single inter-event residual with
+            # the standard deviation of the site it computed last
+            inter = self.inter_std[-1] * draw(num_fields)[None, :]
+        devs = draw((num_sites, num_fields))
+        if self.lower_triangular is None:
+            intra = self.intra_std[:, None] * devs
+        else:
+            intra = numpy.dot(self.lower_triangular, devs)
+        return self.mean[:, None] + inter + intra
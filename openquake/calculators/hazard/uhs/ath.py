@@ -16,13 +16,25 @@
 
 """Asynchronous task handler functions. See
 :function:`openquake.utils.tasks.distribute` for more information.
+
+Each :function:`compute_uhs_task` execution pushes an item to a completion
+list in the KVS when it is done (see :func:`signal_completion`): the job
+executor blocks on the list (see :func:`wait_for_completed_tasks`) instead
+of polling the task counters at fixed intervals, so it is woken up as soon
+as a task finishes.
 """
 
-import time
+from functools import wraps
 
+from openquake import kvs
 from openquake import logs
 from openquake.utils import stats
 
+# Maximum time (in seconds) spent waiting for a completion signal before
+# checking the task counters anyway (e.g. if a worker process died before
+# signalling the completion of its task).
+COMPLETION_WAIT_TIMEOUT = 10
+
 
 def completed_task_count(job_id):
     """Given the ID of a currently running calculation, query the stats
@@ -43,63 +55,47 @@ def completed_task_count(job_id):
     return (success_count or 0) + (fail_count or 0)
 
 
-def remaining_tasks_in_block(job_id, num_tasks, start_count):
-    """Figures out the numbers of remaining tasks in the current block. This
-    should only be called during an active job.
-
-    Given the ID of a currently running calculation, query the stats
-    counters in Redis and determine when N :function:`compute_uhs_task` tasks
-    have been completed (where N is ``num_tasks``).
+def signal_completion(func):
+    """Decorator of the UHS tasks: once the decorated task is done (whether
+    it succeeded or not), push an item to the completion list of the job,
+    waking up :func:`wait_for_completed_tasks`.
 
-    The count includes successful task executions as well as failures.
-
-    This function is implemented as a generator which yields the remaining
-    number of tasks to be execute in this block. When the target number of
-    tasks is reached, a :exception:`StopIteration` is raised.
-
-    :param int job_id:
-        ID of the current job.
-    :param int num_tasks:
-        Number of :function:`compute_uhs_task` tasks in this block.
-    :param int start_count:
-        The starting total of :function:`compute_uhs_task` tasks completed.
-
-        At the beginning of the calculation, this will be 0 of course. At the
-        beginning of subsequent blocks, it needs to be computed _before_
-        starting both the block calculation and the async task handler (to
-        avoid a possible race condition with the task counters).
-    :yields:
-        The remaining number of tasks to be executed in this block.
-    :raises:
-        :exception:`StopIteration` when all block tasks are complete
-        (successful or not).
+    The job ID must be the first parameter of the task. This decorator must
+    wrap the progress counting decorator
+    (:class:`openquake.utils.stats.count_progress`), so that the counters
+    are up to date when the item is pushed.
     """
-    target = start_count + num_tasks
-    while completed_task_count(job_id) < target:
-        yield target - completed_task_count(job_id)  # number remaining
+    @wraps(func)
+    def wrapper(job_id, *args, **kwargs):
+        """Call the task and signal its completion."""
+        try:
+            return func(job_id, *args, **kwargs)
+        finally:
+            kvs.get_client().rpush(kvs.tokens.uhs_completion_key(job_id), 1)
 
+    return wrapper
 
-def uhs_task_handler(job_id, num_tasks, start_count):
-    """Async task handler for counting calculation results and determining when
-    a batch of tasks is complete.
 
-    This function periodically polls the task counters in Redis and blocks
-    until the current block of tasks is finished.
+def wait_for_completed_tasks(job_id, target):
+    """Block until (at least) ``target`` :function:`compute_uhs_task` task
+    executions are completed, successful or not.
+
+    The task counters are checked each time a task signals its completion,
+    or after :const:`COMPLETION_WAIT_TIMEOUT` seconds without signals. The
+    completion list is emptied at each wake-up: the counters account for
+    all the signals pushed so far, so the list does not grow with the
+    number of tasks.
 
     :param int job_id:
         The ID of the currently running job.
-    :param int num_tasks:
-        The number of tasks in the current block.
-    :param int start_count:
-        The number of tasks completed so far in the job.
+    :param int target:
+        The number of tasks completed so far in the job to wait for; like
+        the task counters, it counts the sites computed by the tasks.
     """
-    remaining_gen = remaining_tasks_in_block(job_id, num_tasks, start_count)
+    client = kvs.get_client()
+    completion_key = kvs.tokens.uhs_completion_key(job_id)
 
-    while True:
-        time.sleep(0.5)
-        try:
-            remaining_gen.next()
-        except StopIteration:
-            # No more tasks remaining in this batch.
-            break
+    while completed_task_count(job_id) < target:
+        client.blpop(completion_key, COMPLETION_WAIT_TIMEOUT)
+        client.delete(completion_key)
         logs.log_percent_complete(job_id, "hazard")
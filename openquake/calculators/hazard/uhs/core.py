@@ -17,17 +17,20 @@
 """Core functionality of the Uniform Hazard Spectra calculator."""
 
 
+import collections
 import os
 import random
 
 from celery.task import task
 from django.db import transaction
-from django.contrib.gis.geos.geometry import GEOSGeometry
 
 from openquake import java
+from openquake import kvs
+from openquake import writer
 from openquake.calculators.hazard import general
 from openquake.calculators.hazard.uhs.ath import completed_task_count
-from openquake.calculators.hazard.uhs.ath import uhs_task_handler
+from openquake.calculators.hazard.uhs.ath import signal_completion
+from openquake.calculators.hazard.uhs.ath import wait_for_completed_tasks
 from openquake.db.models import Output
 from openquake.db.models import UhSpectra
 from openquake.db.models import UhSpectrum
@@ -42,15 +45,19 @@ from openquake.utils import tasks as utils_tasks
 from openquake.utils.general import block_splitter
 
 
-# Disabling 'Too many local variables'
-# pylint: disable=R0914
-@task(ignore_results=True)
-@stats.count_progress('h', data_arg="site")
+# Per worker process cache of the ids of the hzrdr.uh_spectrum records of
+# the last job: job_id -> {poe: uh_spectrum_id}
+_UH_SPECTRUM_IDS = {}
+
+
+@task(ignore_result=True)
+@signal_completion
+@stats.count_progress('h', data_arg="sites")
 @java.unpack_exception
-def compute_uhs_task(job_id, realization, site):
-    """Compute Uniform Hazard Spectra for a given site of interest and 1 or
-    more Probability of Exceedance values. The bulk of the computation will
-    be done by utilizing the `UHSCalculator` class in the Java code.
+def compute_uhs_task(job_id, realization, sites):
+    """Compute Uniform Hazard Spectra for a block of sites of interest and 1
+    or more Probability of Exceedance values. The bulk of the computation
+    will be done by utilizing the `UHSCalculator` class in the Java code.
 
     UHS results will be written directly to the database.
 
@@ -59,36 +66,33 @@ def compute_uhs_task(job_id, realization, site):
     :param realization:
         Logic tree sample number (from 1 to N, where N is the
         NUMBER_OF_LOGIC_TREE_SAMPLES param defined in the job config.
-    :param site:
-        The site of interest (a :class:`openquake.shapes.Site` object).
+    :param sites:
+        The sites of interest (a list of :class:`openquake.shapes.Site`
+        objects).
     """
     job_ctxt = utils_tasks.get_running_job(job_id)
 
     log_msg = (
-        "Computing UHS for job_id=%s, site=%s, realization=%s."
+        "Computing UHS for job_id=%s, %s sites, realization=%s."
         " UHS results will be serialized to the database.")
-    log_msg %= (job_ctxt.job_id, site, realization)
+    log_msg %= (job_ctxt.job_id, len(sites), realization)
     LOG.info(log_msg)
 
-    uhs_results = compute_uhs(job_ctxt, site)
+    uhs_results = compute_uhs_block(job_ctxt, sites, realization)
 
-    write_uhs_spectrum_data(job_ctxt, realization, site, uhs_results)
+    write_uhs_block_data(job_ctxt, realization, zip(sites, uhs_results))
 
 
-# Disabling 'Too many arguments'
-# pylint: disable=R0913
-def compute_uhs(the_job, site):
-    """Given a `JobContext` and a site of interest, compute UHS. The Java
-    `UHSCalculator` is called to do perform the core computation.
+def _uhs_calculator(the_job, realization=None):
+    """Build the Java `UHSCalculator` of a job, with the ERF and the GMPE map
+    stored in the KVS.
 
     :param the_job:
         :class:`openquake.engine.JobContext` instance.
-    :param site:
-        :class:`openquake.shapes.Site` instance.
-    :returns:
-        An `ArrayList` (Java object) of `UHSResult` objects, one per PoE.
+    :param int realization:
+        The logic tree sample whose source model and GMPE map are used (the
+        ones stored under the job keys if `None`).
     """
-
     periods = list_to_jdouble_array(the_job['UHS_PERIODS'])
     poes = list_to_jdouble_array(the_job['POES'])
     imls = general.get_iml_list(the_job['INTENSITY_MEASURE_LEVELS'],
@@ -99,65 +103,82 @@ def compute_uhs(the_job, site):
         config.get('kvs', 'host'),
         int(config.get('kvs', 'port')))
 
-    erf = general.generate_erf(the_job.job_id, cache)
-    gmpe_map = general.generate_gmpe_map(the_job.job_id, cache)
+    src_key = gmpe_key = None
+    if realization is not None:
+        src_key = kvs.tokens.source_model_key(the_job.job_id, realization)
+        gmpe_key = kvs.tokens.gmpe_key(the_job.job_id, realization)
+
+    erf = general.generate_erf(the_job.job_id, cache, src_key)
+    gmpe_map = general.generate_gmpe_map(the_job.job_id, cache, gmpe_key)
     general.set_gmpe_params(gmpe_map, the_job.params)
 
-    uhs_calc = java.jclass('UHSCalculator')(periods, poes, imls, erf, gmpe_map,
-                                            max_distance)
+    return java.jclass('UHSCalculator')(periods, poes, imls, erf, gmpe_map,
+                                        max_distance)
 
-    site_model = general.get_site_model(the_job.oq_job.id)
 
-    if site_model is not None:
-        sm_data = general.get_closest_site_model_data(site_model, site)
-        vs30_type = sm_data.vs30_type.capitalize()
-        vs30 = sm_data.vs30
-        z1pt0 = sm_data.z1pt0
-        z2pt5 = sm_data.z2pt5
-    else:
-        jp = the_job.oq_job_profile
+def compute_uhs_block(the_job, sites, realization=None):
+    """Compute the UHS of a block of sites. The Java `UHSCalculator` (and the
+    ERF and GMPE map it uses) is built once and the spectra of all the sites
+    are computed with a single call.
 
-        vs30_type = jp.vs30_type.capitalize()
-        vs30 = jp.reference_vs30_value
-        z1pt0 = jp.depth_to_1pt_0km_per_sec
-        z2pt5 = jp.reference_depth_to_2pt5km_per_sec_param
+    :param the_job:
+        :class:`openquake.engine.JobContext` instance.
+    :param sites:
+        List of :class:`openquake.shapes.Site` instances.
+    :param int realization:
+        The logic tree sample to compute (see :func:`_uhs_calculator`).
+    :returns:
+        A `List` (Java object) holding, for each site, the `List` of its
+        `UHSResult` objects, one per PoE.
+    """
+    uhs_calc = _uhs_calculator(the_job, realization)
 
-    uhs_results = _compute_uhs(
-        uhs_calc, site.latitude, site.longitude, vs30_type, vs30, z1pt0, z2pt5
-    )
+    vs30_types, vs30s, z1pt0s, z2pt5s = zip(
+        *general.site_parameters(the_job, sites))
 
-    return uhs_results
+    return _compute_uhs_block(
+        uhs_calc, [site.latitude for site in sites],
+        [site.longitude for site in sites], vs30_types, vs30s, z1pt0s,
+        z2pt5s)
 
 
-def _compute_uhs(calc, lat, lon, vs30_type, vs30, z1pt0, z2pt5):
-    """Helper function for executing `computeUHS` in the java calculator.
+# Disabling 'Too many arguments'
+# pylint: disable=R0913
+def _compute_uhs_block(calc, lats, lons, vs30_types, vs30s, z1pt0s, z2pt5s):
+    """Helper function for executing the batched `computeUHS` in the java
+    calculator, the parameters being sequences with one value per site.
 
     As a separate function, this makes it easier to mock (since we can't really
     mock the java code).
 
-    See also :function:`compute_uhs`.
-
     :param calc:
         jpype `org.gem.calc.UHSCalculator` object.
-    :param float lat:
-        Site latitude.
-    :param float lon:
-        Site longitude.
-    :param vs30_type:
+    :param lats:
+        Site latitudes.
+    :param lons:
+        Site longitudes.
+    :param vs30_types:
         'measured' or 'inferred'. Identifies if vs30 value has been measured or
         inferred.
-    :param float vs30:
+    :param vs30s:
         Average shear wave velocity for top 30 m. Units m/s.
-    :param float z1pt0:
+    :param z1pt0s:
         Depth to shear wave velocity of 1.0 km/s. Units m.
-    :param float z2pt5:
+    :param z2pt5s:
         Depth to shear wave velocity of 2.5 km/s. Units km.
 
     :returns:
-        jpype `java.util.List` of `org.gem.calc.UHSResult` objects, one for
-        each PoE value (which is provided to the ``calc``).
+        jpype `java.util.List` holding a `java.util.List` of
+        `org.gem.calc.UHSResult` objects (one for each PoE) for each site.
     """
-    return calc.computeUHS(lat, lon, vs30_type, vs30, z1pt0, z2pt5)
+    jp = java.jvm()
+    return calc.computeUHS(
+        java.array_to_jdouble_array(lats),
+        java.array_to_jdouble_array(lons),
+        jp.JArray(jp.java.lang.String)(list(vs30_types)),
+        java.array_to_jdouble_array(vs30s),
+        java.array_to_jdouble_array(z1pt0s),
+        java.array_to_jdouble_array(z2pt5s))
 
 
 @transaction.commit_on_success(using='reslt_writer')
@@ -201,10 +222,31 @@ def write_uh_spectra(job_ctxt):
         uh_spectrum.save()
 
 
+def uh_spectrum_ids(job_id):
+    """Return the ids of the hzrdr.uh_spectrum records of a job, keyed by
+    PoE.
+
+    The records are written before the calculation starts (see
+    :func:`write_uh_spectra`) and never change: they are read once per job
+    by each worker process.
+
+    :param int job_id:
+        ID of the job record in the DB/KVS.
+    :returns:
+        A dict mapping each PoE defined in the calculation config to the id
+        of its uh_spectrum record.
+    """
+    if job_id not in _UH_SPECTRUM_IDS:
+        _UH_SPECTRUM_IDS.clear()
+        _UH_SPECTRUM_IDS[job_id] = dict(UhSpectrum.objects.filter(
+            uh_spectra__output__oq_job=job_id).values_list('poe', 'id'))
+    return _UH_SPECTRUM_IDS[job_id]
+
+
 @transaction.commit_on_success(using='reslt_writer')
-def write_uhs_spectrum_data(job_ctxt, realization, site, uhs_results):
-    """Write UHS results for a single ``site`` and ``realization`` to the
-    database.
+def write_uhs_block_data(job_ctxt, realization, site_results):
+    """Write the UHS results of a block of sites for a single
+    ``realization`` to the database, with a single (multi-row) insert.
 
     :param job_ctxt:
         :class:`openquake.engine.JobContext` instance for a UHS
@@ -213,33 +255,30 @@ def write_uhs_spectrum_data(job_ctxt, realization, site, uhs_results):
        The realization number (from 0 to N, where N is the number of logic tree
         samples defined in the calculation config) for which these results have
         been computed.
-    :param site:
-        :class:`openquake.shapes.Site` instance.
-    :param uhs_results:
-        List of `UHSResult` jpype Java objects, one for each PoE defined in the
-        calculation configuration.
+    :param site_results:
+        A sequence of (site, uhs_results) pairs, `site` being a
+        :class:`openquake.shapes.Site` instance and `uhs_results` the list
+        of `UHSResult` jpype Java objects of the site, one for each PoE
+        defined in the calculation configuration.
     """
-    # Get the top-level uh_spectra record for this calculation:
-    oq_job = job_ctxt.oq_job
-    uh_spectra = UhSpectra.objects.get(
-        output__oq_job=oq_job.id)
+    # The uh_spectrum records, one per PoE, to which the results belong.
+    spectrum_ids = uh_spectrum_ids(job_ctxt.oq_job.id)
 
-    location = GEOSGeometry(site.point.to_wkt())
+    inserter = writer.BulkInserter(UhSpectrumData)
 
-    for result in uhs_results:
-        poe = result.getPoe()
-        # Get the uh_spectrum record to which the current result belongs.
-        # Remember, each uh_spectrum record is associated with a partiuclar
-        # PoE.
-        uh_spectrum = UhSpectrum.objects.get(uh_spectra=uh_spectra.id, poe=poe)
+    for site, uhs_results in site_results:
+        location = site.point.to_wkt()
 
-        # getUhs() yields a Java Double[] of SA (Spectral Acceleration) values
-        sa_values = [x.value for x in result.getUhs()]
+        for result in uhs_results:
+            # getUhs() yields a Java Double[] of SA (Spectral Acceleration)
+            # values
+            inserter.add_entry(
+                uh_spectrum_id=spectrum_ids[result.getPoe()],
+                realization=realization,
+                sa_values=[x.value for x in result.getUhs()],
+                location=location)
 
-        uh_spectrum_data = UhSpectrumData(
-            uh_spectrum=uh_spectrum, realization=realization,
-            sa_values=sa_values, location=location)
-        uh_spectrum_data.save()
+    inserter.flush()
 
 
 class UHSCalculator(general.BaseHazardCalculator):
@@ -274,11 +313,18 @@ class UHSCalculator(general.BaseHazardCalculator):
     def execute(self):
         """Loop over realizations (logic tree samples), split the geometry of
         interest into blocks of sites, and distribute Celery tasks to carry out
-        the UHS computation.
+        the UHS computation, each task computing `uhs_sites_per_task` sites
+        (see openquake.cfg) of a block.
+
+        Up to `uhs_prefetch_blocks` blocks are submitted ahead of the block
+        being waited for, possibly across realizations, so that the workers
+        always have tasks to run.
         """
         job_ctxt = self.job_ctxt
         all_sites = job_ctxt.sites_to_compute()
         site_block_size = config.hazard_block_size()
+        sites_per_task = config.hazard_uhs_sites_per_task()
+        prefetch_blocks = config.hazard_uhs_prefetch_blocks()
         job_profile = job_ctxt.oq_job_profile
 
         self.initialize_pr_data(
@@ -287,36 +333,81 @@ class UHSCalculator(general.BaseHazardCalculator):
         src_model_rnd = random.Random(job_profile.source_model_lt_random_seed)
         gmpe_rnd = random.Random(job_profile.gmpe_lt_random_seed)
 
-        for rlz in xrange(job_ctxt.oq_job_profile.realizations):
-
-            # Sample the gmpe and source models:
-            general.store_source_model(
-                job_ctxt.job_id, src_model_rnd.getrandbits(32),
-                job_ctxt.params, self.lt_processor)
-            general.store_gmpe_map(
-                job_ctxt.job_id, gmpe_rnd.getrandbits(32), self.lt_processor)
-
-            for site_block in block_splitter(all_sites, site_block_size):
-
-                tf_args = dict(job_id=job_ctxt.job_id, realization=rlz)
-
-                num_tasks_completed = completed_task_count(job_ctxt.job_id)
-
-                ath_args = dict(job_id=job_ctxt.job_id,
-                                num_tasks=len(site_block),
-                                start_count=num_tasks_completed)
-
-                utils_tasks.distribute(
-                    compute_uhs_task, ('site', site_block), tf_args=tf_args,
-                    ath=uhs_task_handler, ath_args=ath_args)
+        def blocks():
+            """Yield the (realization, site block, last block of the
+            realization?) triples, storing the models of each realization
+            before its first block."""
+            site_blocks = list(block_splitter(all_sites, site_block_size))
+            for rlz in xrange(job_ctxt.oq_job_profile.realizations):
+                self.store_realization_models(
+                    rlz, src_model_rnd.getrandbits(32),
+                    gmpe_rnd.getrandbits(32))
+                for i, site_block in enumerate(site_blocks):
+                    yield rlz, site_block, i == len(site_blocks) - 1
+
+        # (realization, number of completed tasks once the block is done,
+        # last block of the realization?) in submission order
+        in_flight = collections.deque()
+        num_tasks_submitted = completed_task_count(job_ctxt.job_id)
+
+        for rlz, site_block, last in blocks():
+            utils_tasks.distribute(
+                compute_uhs_task,
+                ('sites', list(block_splitter(site_block, sites_per_task))),
+                tf_args=dict(job_id=job_ctxt.job_id, realization=rlz))
+
+            num_tasks_submitted += len(site_block)
+            in_flight.append((rlz, num_tasks_submitted, last))
+
+            while len(in_flight) > prefetch_blocks:
+                self.wait_for_block(*in_flight.popleft())
+
+        while in_flight:
+            self.wait_for_block(*in_flight.popleft())
+
+    def wait_for_block(self, realization, target, last):
+        """Wait for the completion of a block of sites, removing the models
+        of the realization from the KVS if it is its last block.
+
+        :param int target:
+            The number of completed tasks once the block is done (see
+            :func:`wait_for_completed_tasks`).
+        """
+        wait_for_completed_tasks(self.job_ctxt.job_id, target)
+
+        if last:
+            self.delete_realization_models(realization)
+
+    def store_realization_models(self, realization, source_model_seed,
+                                 gmpe_seed):
+        """Sample the source model and GMPE map of the given realization and
+        store them in the KVS, under keys of their own: the tasks of several
+        realizations may be running at the same time."""
+        job_id = self.job_ctxt.job_id
+        general.store_source_model(
+            job_id, source_model_seed, self.job_ctxt.params, self.lt_processor,
+            kvs.tokens.source_model_key(job_id, realization))
+        general.store_gmpe_map(
+            job_id, gmpe_seed, self.lt_processor,
+            kvs.tokens.gmpe_key(job_id, realization))
+
+    def delete_realization_models(self, realization):
+        """Remove the source model and GMPE map of the given realization from
+        the KVS."""
+        job_id = self.job_ctxt.job_id
+        kvs.get_client().delete(
+            kvs.tokens.source_model_key(job_id, realization),
+            kvs.tokens.gmpe_key(job_id, realization))
 
     def post_execute(self):
-        """Clean up stats counters and create XML output artifacts (if
-        requested).
+        """Clean up stats counters and the task completion list and create XML
+        output artifacts (if requested).
         """
         # TODO: export these counters to the database before deleting them
         # See bug https://bugs.launchpad.net/openquake/+bug/925946.
         stats.delete_job_counters(self.job_ctxt.job_id)
+        kvs.get_client().delete(
+            kvs.tokens.uhs_completion_key(self.job_ctxt.job_id))
 
         if 'xml' in self.job_ctxt.serialize_results_to:
             [uhs_output] = Output.objects.filter(
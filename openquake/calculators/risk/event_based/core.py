@@ -114,14 +114,14 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         :type site: instance of :py:class:`openquake.shapes.Site`
         """
 
-        output_ids = models.Output.objects.filter(
-            oq_job=self.job_ctxt.job_id, output_type="gmf")
-
         gh = geohash.encode(site.latitude, site.longitude, precision=12)
+        gmf_sites = models.GmfSite.objects.filter(
+                oq_job=self.job_ctxt.job_id).extra(
+                where=["ST_GeoHash(location, 12) = %s"], params=[gh])
+
         ground_motion_values = models.GmfData.objects.filter(
-                output__in=output_ids).extra(
-                where=["ST_GeoHash(location, 12) = %s"],
-                params=[gh]).order_by("output")
+                site__in=gmf_sites, output__output_type="gmf").order_by(
+                "output")
 
         return [gmv.ground_motion for gmv in ground_motion_values]
 
@@ -21,6 +21,7 @@
 # pylint: disable=C0302
 
 import os
+import numpy
 
 from collections import defaultdict
 
@@ -619,8 +620,33 @@ def load_gmvs_at(job_id, site):
     :returns: List of ground motion values (as floats). Each value represents a
                 realization of the calculation for a single site.
     """
+    return load_gmv_array_at(job_id, site).tolist()
+
+
+def load_gmv_array_at(job_id, site):
+    """
+    Like :func:`load_gmvs_at` but return the ground motion values as a numpy
+    array.
+
+    The values are read from the per site array written by the scenario
+    hazard calculator (see
+    :func:`openquake.kvs.tokens.ground_motion_values_array_key`) or, when
+    there is none, from the per site list of JSON encoded values.
+
+    :param site: :py:class:`openquake.shapes.Site` object
+
+    :returns: 1-dimensional float array, one value per realization
+    """
+    array_key = kvs.tokens.ground_motion_values_array_key(job_id, site)
+    data = kvs.get_client().get(array_key)
+    if data is not None:
+        return numpy.frombuffer(
+            data, dtype=kvs.tokens.GMV_ARRAY_DTYPE).astype(float)
+
     gmfs_key = kvs.tokens.ground_motion_values_key(job_id, site)
-    return [float(x['mag']) for x in kvs.get_list_json_decoded(gmfs_key)]
+    return numpy.array(
+        [float(x['mag']) for x in kvs.get_list_json_decoded(gmfs_key)],
+        dtype=float)
 
 
 def hazard_input_site(job_ctxt, site):
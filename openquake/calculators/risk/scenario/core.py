@@ -196,7 +196,7 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
             lambda site: general.BaseRiskCalculator.assets_at(
                 self.job_ctxt.job_id, site),
             vuln_model,
-            lambda site: general.load_gmvs_at(
+            lambda site: general.load_gmv_array_at(
                 self.job_ctxt.job_id, general.hazard_input_site(
                     self.job_ctxt, site)),
             insured_losses,
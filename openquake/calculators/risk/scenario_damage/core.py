@@ -184,7 +184,7 @@ class ScenarioDamageRiskCalculator(general.BaseRiskCalculator):
         frag_functions = fragility_model.functions_by_taxonomy()
         block = general.Block.from_kvs(self.job_ctxt.job_id, block_id)
 
-        ground_motion_field_loader = lambda site: general.load_gmvs_at(
+        ground_motion_field_loader = lambda site: general.load_gmv_array_at(
             self.job_ctxt.job_id, general.hazard_input_site(
             self.job_ctxt, site))
 
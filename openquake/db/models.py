@@ -1130,13 +1130,24 @@ class HazardCurveData(djm.Model):
         db_table = 'hzrdr\".\"hazard_curve_data'
 
 
+class GmfSite(djm.Model):
+    '''
+    Site of the ground motion fields of a job, shared by all their data
+    '''
+    oq_job = djm.ForeignKey('OqJob')
+    location = djm.PointField(srid=4326)
+
+    class Meta:
+        db_table = 'hzrdr\".\"gmf_site'
+
+
 class GmfData(djm.Model):
     '''
     Ground Motion Field data
     '''
     output = djm.ForeignKey('Output')
     ground_motion = djm.FloatField()
-    location = djm.PointField(srid=4326)
+    site = djm.ForeignKey('GmfSite')
 
     class Meta:
         db_table = 'hzrdr\".\"gmf_data'
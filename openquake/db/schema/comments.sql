@@ -177,7 +177,11 @@ COMMENT ON COLUMN hzrdr.hazard_curve_data.poes IS 'Probabilities of exceedence.'
 
 COMMENT ON TABLE hzrdr.gmf_data IS 'Holds data for the ground motion field';
 COMMENT ON COLUMN hzrdr.gmf_data.ground_motion IS 'Ground motion for a specific site';
-COMMENT ON COLUMN hzrdr.gmf_data.location IS 'Site coordinates';
+COMMENT ON COLUMN hzrdr.gmf_data.site_id IS 'The foreign key to the site of the ground motion value';
+
+
+COMMENT ON TABLE hzrdr.gmf_site IS 'Holds the sites of the ground motion fields of a job, shared by their data';
+COMMENT ON COLUMN hzrdr.gmf_site.location IS 'Site coordinates';
 
 
 COMMENT ON TABLE hzrdr.hazard_map IS 'Holds location/IML data for hazard maps';
@@ -70,6 +70,8 @@ CREATE INDEX hzrdr_hazard_curve_output_id_idx on hzrdr.hazard_curve(output_id);
 CREATE INDEX hzrdr_hazard_curve_data_hazard_curve_id_idx on hzrdr.hazard_curve_data(hazard_curve_id);
 -- gmf
 CREATE INDEX hzrdr_gmf_data_output_id_idx on hzrdr.gmf_data(output_id);
+CREATE INDEX hzrdr_gmf_data_site_id_idx on hzrdr.gmf_data(site_id);
+CREATE UNIQUE INDEX hzrdr_gmf_site_oq_job_id_geohash_uniq_idx ON hzrdr.gmf_site(oq_job_id, ST_GeoHash(location, 12));
 -- uhs
 CREATE INDEX hzrdr_uh_spectra_output_id_idx on hzrdr.uh_spectra(output_id);
 CREATE INDEX hzrdr_uh_spectrum_uh_spectra_id_idx on hzrdr.uh_spectrum(uh_spectra_id);
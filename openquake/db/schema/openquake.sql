@@ -1340,15 +1340,23 @@ SELECT AddGeometryColumn('hzrdr', 'hazard_curve_data', 'location', 4326, 'POINT'
 ALTER TABLE hzrdr.hazard_curve_data ALTER COLUMN location SET NOT NULL;
 
 
+-- GMF sites, shared by the GMF data of a job.
+CREATE TABLE hzrdr.gmf_site (
+    id SERIAL PRIMARY KEY,
+    oq_job_id INTEGER NOT NULL
+) TABLESPACE hzrdr_ts;
+SELECT AddGeometryColumn('hzrdr', 'gmf_site', 'location', 4326, 'POINT', 2);
+ALTER TABLE hzrdr.gmf_site ALTER COLUMN location SET NOT NULL;
+
+
 -- GMF data.
 CREATE TABLE hzrdr.gmf_data (
     id SERIAL PRIMARY KEY,
     output_id INTEGER NOT NULL,
+    site_id INTEGER NOT NULL,
     -- Ground motion value
     ground_motion float NOT NULL
 ) TABLESPACE hzrdr_ts;
-SELECT AddGeometryColumn('hzrdr', 'gmf_data', 'location', 4326, 'POINT', 2);
-ALTER TABLE hzrdr.gmf_data ALTER COLUMN location SET NOT NULL;
 
 
 -- Uniform Hazard Spectra
@@ -1974,10 +1982,18 @@ ALTER TABLE hzrdr.hazard_curve_data
 ADD CONSTRAINT hzrdr_hazard_curve_data_hazard_curve_fk
 FOREIGN KEY (hazard_curve_id) REFERENCES hzrdr.hazard_curve(id) ON DELETE CASCADE;
 
+ALTER TABLE hzrdr.gmf_site
+ADD CONSTRAINT hzrdr_gmf_site_oq_job_fk
+FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
+
 ALTER TABLE hzrdr.gmf_data
 ADD CONSTRAINT hzrdr_gmf_data_output_fk
 FOREIGN KEY (output_id) REFERENCES uiapi.output(id) ON DELETE CASCADE;
 
+ALTER TABLE hzrdr.gmf_data
+ADD CONSTRAINT hzrdr_gmf_data_gmf_site_fk
+FOREIGN KEY (site_id) REFERENCES hzrdr.gmf_site(id) ON DELETE CASCADE;
+
 -- UHS:
 -- uh_spectra -> output FK
 ALTER TABLE hzrdr.uh_spectra
@@ -45,6 +45,7 @@ GRANT ALL ON SEQUENCE hzrdi.site_model_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdi.source_id_seq to GROUP openquake;
 
 GRANT ALL ON SEQUENCE hzrdr.gmf_data_id_seq to GROUP openquake;
+GRANT ALL ON SEQUENCE hzrdr.gmf_site_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_curve_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_curve_data_id_seq to GROUP openquake;
 GRANT ALL ON SEQUENCE hzrdr.hazard_map_data_id_seq to GROUP openquake;
@@ -187,6 +188,10 @@ GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.hazard_curve_data TO oq_reslt_writer;
 GRANT SELECT ON hzrdr.gmf_data TO GROUP openquake;
 GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.gmf_data TO oq_reslt_writer;
 
+-- hzrdr.gmf_site
+GRANT SELECT ON hzrdr.gmf_site TO GROUP openquake;
+GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.gmf_site TO oq_reslt_writer;
+
 -- hzrdr.hazard_map
 GRANT SELECT ON hzrdr.hazard_map TO GROUP openquake;
 GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.hazard_map TO oq_reslt_writer;
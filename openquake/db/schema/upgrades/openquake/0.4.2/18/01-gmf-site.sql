@@ -0,0 +1,64 @@
+/*
+  Store the ground motion field site coordinates once per job, in
+  hzrdr.gmf_site, and reference them from hzrdr.gmf_data.
+
+    Copyright (c) 2010-2012, GEM Foundation.
+
+    OpenQuake is free software: you can redistribute it and/or modify it
+    under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    OpenQuake is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+CREATE TABLE hzrdr.gmf_site (
+    id SERIAL PRIMARY KEY,
+    oq_job_id INTEGER NOT NULL
+) TABLESPACE hzrdr_ts;
+SELECT AddGeometryColumn('hzrdr', 'gmf_site', 'location', 4326, 'POINT', 2);
+
+-- one site per job and location
+INSERT INTO hzrdr.gmf_site (oq_job_id, location)
+SELECT DISTINCT ON (o.oq_job_id, ST_GeoHash(d.location, 12))
+    o.oq_job_id, d.location
+FROM hzrdr.gmf_data AS d, uiapi.output AS o
+WHERE d.output_id = o.id;
+
+ALTER TABLE hzrdr.gmf_site ALTER COLUMN location SET NOT NULL;
+
+ALTER TABLE hzrdr.gmf_data ADD COLUMN site_id INTEGER;
+
+UPDATE hzrdr.gmf_data AS d SET site_id = s.id
+FROM uiapi.output AS o, hzrdr.gmf_site AS s
+WHERE d.output_id = o.id AND s.oq_job_id = o.oq_job_id
+    AND ST_GeoHash(s.location, 12) = ST_GeoHash(d.location, 12);
+
+ALTER TABLE hzrdr.gmf_data ALTER COLUMN site_id SET NOT NULL;
+
+SELECT DropGeometryColumn('hzrdr', 'gmf_data', 'location');
+
+ALTER TABLE hzrdr.gmf_site
+ADD CONSTRAINT hzrdr_gmf_site_oq_job_fk
+FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
+
+ALTER TABLE hzrdr.gmf_data
+ADD CONSTRAINT hzrdr_gmf_data_gmf_site_fk
+FOREIGN KEY (site_id) REFERENCES hzrdr.gmf_site(id) ON DELETE CASCADE;
+
+CREATE INDEX hzrdr_gmf_data_site_id_idx on hzrdr.gmf_data(site_id);
+CREATE UNIQUE INDEX hzrdr_gmf_site_oq_job_id_geohash_uniq_idx ON hzrdr.gmf_site(oq_job_id, ST_GeoHash(location, 12));
+
+GRANT ALL ON SEQUENCE hzrdr.gmf_site_id_seq to GROUP openquake;
+GRANT SELECT ON hzrdr.gmf_site TO GROUP openquake;
+GRANT SELECT,INSERT,UPDATE,DELETE ON hzrdr.gmf_site TO oq_reslt_writer;
+
+COMMENT ON TABLE hzrdr.gmf_site IS 'Holds the sites of the ground motion fields of a job, shared by their data';
+COMMENT ON COLUMN hzrdr.gmf_site.location IS 'Site coordinates';
+COMMENT ON COLUMN hzrdr.gmf_data.site_id IS 'The foreign key to the site of the ground motion value';
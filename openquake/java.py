@@ -18,8 +18,11 @@
 Includes classpath arguments, and heap size."""
 
 import jpype
+import numpy
 import os
 import sys
+import threading
+import time
 import traceback
 import logging
 
@@ -32,6 +35,35 @@ from openquake.utils import config
 # JVM max. memory size (in MB) to be used (per celery worker process!)
 DEFAULT_JVM_MAX_MEM = 768
 
+# Java log events are forwarded to python logging in batches of (at most)
+# JAVA_LOG_BATCH_SIZE events. Warnings (and more severe events) as well as
+# events logged more than JAVA_LOG_MAX_DELAY milliseconds after the last
+# batch are forwarded right away. The events buffered by a task are
+# forwarded when it ends, the ones buffered outside of tasks at most
+# JAVA_LOG_MAX_DELAY milliseconds later (see _flush_logs_periodically()).
+JAVA_LOG_BATCH_SIZE = 100
+JAVA_LOG_MAX_DELAY = 1000
+
+# Python logging levels and the least severe log4j level whose events they
+# do not filter out.
+LOG4J_LEVELS = (
+    (logging.DEBUG, 'DEBUG'),
+    (logging.INFO, 'INFO'),
+    (logging.WARNING, 'WARN'),
+    (logging.ERROR, 'ERROR'),
+    (logging.CRITICAL, 'FATAL'),
+)
+
+# The one-source model used by the warm-up workload, see _warm_up_calc().
+WARM_UP_SOURCE_MODEL = os.path.join(
+    os.path.dirname(__file__), "data", "warm_up_source_model.xml")
+
+# The python logging level currently pushed down to log4j.
+_JAVA_LOG_LEVEL = None
+
+# Number of `unpack_exception` decorated calls (tasks) in progress.
+_TASKS_IN_PROGRESS = 0
+
 
 JAVA_CLASSES = {
     'LogicTreeProcessor': "org.gem.engine.LogicTreeProcessor",
@@ -50,6 +82,7 @@ JAVA_CLASSES = {
     "ArbitrarilyDiscretizedFunc":
         "org.opensha.commons.data.function.ArbitrarilyDiscretizedFunc",
     "ArrayList": "java.util.ArrayList",
+    "Runtime": "java.lang.Runtime",
     "GmpeLogicTreeData": "org.gem.engine.GmpeLogicTreeData",
     "AttenuationRelationship": "org.opensha.sha.imr.AttenuationRelationship",
     "EqkRupForecastAPI": "org.opensha.sha.earthquake.EqkRupForecastAPI",
@@ -76,6 +109,9 @@ JAVA_CLASSES = {
     "PythonBridgeAppender": "org.gem.log.PythonBridgeAppender",
     "DisaggregationCalculator": "org.gem.calc.DisaggregationCalculator",
     "UHSCalculator": "org.gem.calc.UHSCalculator",
+    "TimeSpan": "org.opensha.commons.data.TimeSpan",
+    "TectonicRegionType": "org.opensha.sha.util.TectonicRegionType",
+    "BA_2008_AttenRel": "org.opensha.sha.imr.attenRelImpl.BA_2008_AttenRel",
 }
 
 
@@ -159,6 +195,14 @@ class JavaLoggingBridge(object):
         record.threadName = event.getThreadName()
         logger.handle(record)
 
+    def appendBatch(self, events):  # pylint: disable=C0103
+        """
+        Given a java array of ``LogEvent`` objects log each one of them,
+        see :meth:`append`.
+        """
+        for event in events:
+            self.append(event)
+
 
 def _init_logs():
     """
@@ -171,12 +215,81 @@ def _init_logs():
     # So there will be only one JavaLoggingBridge for all loggers.
     appender.bridge = jpype.JProxy('org.gem.log.PythonBridge',
                                    inst=JavaLoggingBridge())
+    appender.setBatchSize(JAVA_LOG_BATCH_SIZE)
+    appender.setMaxDelay(JAVA_LOG_MAX_DELAY)
+
+    global _JAVA_LOG_LEVEL  # pylint: disable=W0603
+    _JAVA_LOG_LEVEL = logging.getLogger('java').getEffectiveLevel()
+
     props = jclass("Properties")()
-    props.setProperty('log4j.rootLogger', 'debug, pythonbridge')
+    props.setProperty('log4j.rootLogger',
+                      '%s, pythonbridge' % log4j_level(_JAVA_LOG_LEVEL))
     props.setProperty('log4j.appender.pythonbridge',
                       'org.gem.log.PythonBridgeAppender')
     jpype.JClass("org.apache.log4j.PropertyConfigurator").configure(props)
 
+    flusher = threading.Thread(target=_flush_logs_periodically)
+    flusher.daemon = True
+    flusher.start()
+
+
+def _flush_logs_periodically():
+    """
+    Forward the java log events buffered outside of tasks every
+    `JAVA_LOG_MAX_DELAY` milliseconds, even if nothing else is logged.
+
+    The events buffered by a task are left to the task (see
+    :func:`unpack_exception`): the job id of the log records is only known
+    by the thread running it.
+    """
+    jpype.attachThreadToJVM()
+
+    while True:
+        time.sleep(JAVA_LOG_MAX_DELAY / 1000.0)
+        if not _TASKS_IN_PROGRESS:
+            flush_logs()
+
+
+def log4j_level(level):
+    """
+    Return the name of the least severe log4j level whose events would not
+    be discarded by a python logger with the given (effective) `level`.
+
+    >>> log4j_level(logging.INFO)
+    'INFO'
+    >>> log4j_level(25)  # logging.PROGRESS
+    'WARN'
+    >>> log4j_level(logging.NOTSET)
+    'DEBUG'
+    """
+    for py_level, log4j_name in LOG4J_LEVELS:
+        if level <= py_level:
+            return log4j_name
+    return 'OFF'
+
+
+def _sync_log_level():
+    """
+    Push the effective level of the python 'java' logger down to the log4j
+    root logger (if it changed), so that the events python would discard
+    are filtered on the java side and never cross the bridge.
+    """
+    global _JAVA_LOG_LEVEL  # pylint: disable=W0603
+
+    level = logging.getLogger('java').getEffectiveLevel()
+    if level == _JAVA_LOG_LEVEL:
+        return
+
+    jpype.JClass("org.apache.log4j.Logger").getRootLogger().setLevel(
+        jpype.JClass("org.apache.log4j.Level").toLevel(log4j_level(level)))
+    _JAVA_LOG_LEVEL = level
+
+
+def flush_logs():
+    """Forward all the buffered java log events to python logging."""
+    if jpype.isJVMStarted():
+        jclass('PythonBridgeAppender').flushBuffer()
+
 
 def get_jvm_max_mem():
     """
@@ -238,10 +351,98 @@ def jvm():
                 "org.apache.xerces.parsers.XIncludeAwareParserConfiguration")
 
         _init_logs()
+    else:
+        _sync_log_level()
 
     return jpype
 
 
+def preload_classes():
+    """Load all the classes listed in :data:`JAVA_CLASSES`, so that their
+    static initialization does not happen during the first task.
+
+    :returns: the list of class keys that could not be loaded.
+    """
+    failed = []
+    for class_key in sorted(JAVA_CLASSES):
+        try:
+            jclass(class_key)
+        except Exception:  # pylint: disable=W0703
+            failed.append(class_key)
+            logging.getLogger(__name__).warning(
+                'could not preload java class %s', JAVA_CLASSES[class_key])
+    return failed
+
+
+def _warm_up_calc(num_sites=4):
+    """Compute the hazard curves of a few sites for the bundled one-source
+    model (see :data:`WARM_UP_SOURCE_MODEL`), so that the classes and code
+    paths used by every hazard task (source model parsing, ERF, GMPE, site
+    parameterization, curve calculation and array marshalling) are loaded
+    and compiled by the JIT before real tasks arrive."""
+    jpype = jvm()
+
+    sources = jclass("SourceModelReader")(WARM_UP_SOURCE_MODEL, 0.1).read()
+    erf = jclass("GEM1ERF")(sources)
+    time_span = jclass("TimeSpan")(
+        jclass("TimeSpan").NONE, jclass("TimeSpan").YEARS)
+    time_span.setDuration(50.0)
+    erf.setTimeSpan(time_span)
+    erf.updateForecast()
+
+    gmpe = jclass("BA_2008_AttenRel")(None)
+    gmpe.setParamDefaults()
+    jclass("GmpeLogicTreeData").setGmpeParams(
+        "Average Horizontal (GMRotI50)", "PGA", jpype.JDouble(5.0),
+        "2 Sided", jpype.JDouble(3.0), "Total",
+        jpype.JObject(gmpe, jclass("AttenuationRelationship")))
+    gmpe_map = jclass("HashMap")()
+    gmpe_map.put(jclass("TectonicRegionType").ACTIVE_SHALLOW, gmpe)
+
+    jsites = jclass("ArrayList")()
+    for i in xrange(num_sites):
+        jsite = jclass("Site")(jclass("Location")(38.1 + 0.1 * i, -122.0))
+        for name, value in (("Vs30", 760.0), ("Depth 1.0 km/sec", 100.0),
+                            ("Depth 2.5 km/sec", 2.0)):
+            param = jclass("DoubleParameter")(name)
+            param.setValue(value)
+            jsite.addParameter(param)
+        vs30_type = jclass("StringParameter")("Vs30 Type")
+        vs30_type.setValue("Measured")
+        jsite.addParameter(vs30_type)
+        jsites.add(jsite)
+
+    imls = numpy.log([0.005, 0.05, 0.5])
+    jdouble_matrix_to_array(
+        jclass("HazardCalculator").getHazardCurvesAsArray(
+            jsites, erf, gmpe_map, array_to_jdouble_array(imls), 200.0))
+
+
+def warm_up(calc=False):
+    """Start the JVM, preload the engine's Java classes and optionally run a
+    small warm-up workload (see :func:`_warm_up_calc`).
+
+    :param bool calc: whether the warm-up workload should be run.
+    :returns: a dict with the time (in seconds) spent in each step.
+    """
+    timings = dict()
+
+    start = time.time()
+    jvm()
+    timings["jvm_start"] = time.time() - start
+
+    start = time.time()
+    preload_classes()
+    timings["class_preload"] = time.time() - start
+
+    if calc:
+        start = time.time()
+        _warm_up_calc()
+        timings["warm_up_calc"] = time.time() - start
+
+    return timings
+
+
 def _unpickle_javaexception(message, trace):
     """
     Helper function for unpickling :class:`JavaException` objects;
@@ -326,14 +527,21 @@ def unpack_exception(func):
     """
     @wraps(func)
     def unwrap_exception(*targs, **tkwargs):  # pylint: disable=C0111
+        global _TASKS_IN_PROGRESS  # pylint: disable=W0603
+
         jvm_instance = jvm()
 
+        _TASKS_IN_PROGRESS += 1
         try:
             return func(*targs, **tkwargs)
         except jvm_instance.JavaException, e:
             trace = sys.exc_info()[2]
 
             raise JavaException(e), None, trace
+        finally:
+            _TASKS_IN_PROGRESS -= 1
+            # make sure the buffered log events are attributed to this task
+            flush_logs()
 
     return unwrap_exception
 
@@ -348,3 +556,49 @@ def list_to_jdouble_array(float_list):
         jdouble[i] = jp.JClass('java.lang.Double')(val)
 
     return jdouble
+
+
+def array_to_jdouble_array(values):
+    """Convert a 1D sequence of floats (e.g. a `numpy.ndarray`) to a 1D Java
+    primitive double[] (as a jpype object).
+
+    Unlike :func:`list_to_jdouble_array` no boxing takes place: the values
+    are copied in bulk with a single slice assignment (which jpype serves
+    from the array buffer when built with numpy support).
+    """
+    jp = jvm()
+    values = numpy.ascontiguousarray(values, dtype=numpy.float64).ravel()
+    jarray = jp.JArray(jp.JDouble)(len(values))
+
+    if len(values) > 0:
+        jarray[0:len(values)] = values
+
+    return jarray
+
+
+def jdouble_array_to_array(jarray):
+    """Convert a 1D Java double[] (as a jpype object) to a 1D
+    `numpy.ndarray` of float64, reading it with a single slice access."""
+    return numpy.array(jarray[0:len(jarray)], dtype=numpy.float64)
+
+
+def array_to_jdouble_matrix(matrix):
+    """Convert a 2D `numpy.ndarray` (or a sequence of equally sized float
+    sequences) to a Java double[][] (as a jpype object), copying one row at
+    a time in bulk."""
+    jp = jvm()
+    matrix = numpy.ascontiguousarray(matrix, dtype=numpy.float64)
+    assert matrix.ndim == 2, "A 2D matrix was expected"
+
+    jmatrix = jp.JArray(jp.JDouble, 2)(len(matrix))
+    for i, row in enumerate(matrix):
+        jmatrix[i] = array_to_jdouble_array(row)
+
+    return jmatrix
+
+
+def jdouble_matrix_to_array(jmatrix):
+    """Convert a Java double[][] (as a jpype object) with rows of equal size
+    (e.g. a curve matrix, `[sites][imls]`) to a 2D `numpy.ndarray`."""
+    return numpy.array([jdouble_array_to_array(row) for row in jmatrix],
+                       dtype=numpy.float64)
@@ -216,6 +216,8 @@ define_param('EPSILON_BIN_LIMITS', 'epsilon_bin_limits',
              modes='disaggregation', to_job=cttfl)
 define_param('DISTANCE_BIN_LIMITS', 'distance_bin_limits',
              modes='disaggregation', to_job=cttfl)
+define_param('COMPUTE_MEAN_DISAGGREGATION', None, modes='disaggregation',
+             to_job=str2bool)
 
 # Uniform Hazard Spectra parameters:
 define_param('UHS_PERIODS', 'uhs_periods', modes='uhs', to_job=cttfl)
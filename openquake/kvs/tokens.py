@@ -34,6 +34,8 @@ STOCHASTIC_SET_TOKEN = 'ses'
 MEAN_HAZARD_MAP_KEY_TOKEN = 'mean_hazard_map'
 QUANTILE_HAZARD_MAP_KEY_TOKEN = 'quantile_hazard_map'
 GMFS_KEY_TOKEN = 'GMFS'
+GMV_ARRAY_KEY_TOKEN = 'GMV_ARRAY'
+UHS_COMPLETION_TOKEN = 'uhs_completion'
 
 # risk tokens
 BLOCK_KEY_TOKEN = "BLOCK"
@@ -102,14 +104,16 @@ def vuln_key(job_id, retrofitted=False):
                          "retrofitted" if retrofitted else "normal")
 
 
-def source_model_key(job_id):
-    """ Return the KVS key for the source model of the given job"""
-    return _generate_key(job_id, SOURCE_MODEL_TOKEN)
+def source_model_key(job_id, *parts):
+    """ Return the KVS key for the source model of the given job (and
+    optionally of a given logic tree sample, identified by `parts`)"""
+    return _generate_key(job_id, SOURCE_MODEL_TOKEN, *parts)
 
 
-def gmpe_key(job_id):
-    """ Return the KVS key for the GMPE of the given job"""
-    return _generate_key(job_id, GMPE_TOKEN)
+def gmpe_key(job_id, *parts):
+    """ Return the KVS key for the GMPE of the given job (and optionally of
+    a given logic tree sample, identified by `parts`)"""
+    return _generate_key(job_id, GMPE_TOKEN, *parts)
 
 
 def stochastic_set_key(job_id, history, realization):
@@ -117,6 +121,20 @@ def stochastic_set_key(job_id, history, realization):
     return _generate_key(job_id, STOCHASTIC_SET_TOKEN, history, realization)
 
 
+def stochastic_set_part_key(job_id, history, realization, first_rupture,
+                            first_site):
+    """ Return the KVS key for the part of the given stochastic set starting
+    at the given rupture and site indices"""
+    return _generate_key(job_id, STOCHASTIC_SET_TOKEN, history, realization,
+                         first_rupture, first_site)
+
+
+def uhs_completion_key(job_id):
+    """ Return the KVS key of the list signalling the completion of the UHS
+    tasks of the given job"""
+    return _generate_key(job_id, UHS_COMPLETION_TOKEN)
+
+
 def erf_key(job_id):
     """ Return the KVS key for the ERF of the given job"""
     return _generate_key(job_id, ERF_KEY_TOKEN)
@@ -383,3 +401,25 @@ def ground_motion_values_key(job_id, site):
     """
 
     return _generate_key(job_id, GMFS_KEY_TOKEN, hash(site))
+
+
+# The type of the per site ground motion value arrays (see
+# ground_motion_values_array_key()).
+GMV_ARRAY_DTYPE = "<f8"
+
+
+def ground_motion_values_array_key(job_id, site):
+    """
+    Return the key used to store the ground motion values of all the
+    realizations for a single site, as a (little endian) float64 array
+    appended to by blocks of realizations.
+
+    :param job_id: the id of the job.
+    :type job_id: integer
+    :param site: location of the GMF data.
+    :type site: :py:class:`openquake.shapes.Site` object
+    :returns: the key.
+    :rtype: string
+    """
+
+    return _generate_key(job_id, GMV_ARRAY_KEY_TOKEN, hash(site))
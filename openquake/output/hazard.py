@@ -22,7 +22,17 @@ to NRML format.
 """
 
 import logging
-
+import sys
+import threading
+import Queue
+from os.path import basename
+
+import geohash
+import h5py
+import numpy
+from django.db import connections
+from django.db import IntegrityError
+from django.db import transaction
 from lxml import etree
 
 from openquake import shapes
@@ -42,6 +52,13 @@ GMFS_GML_ID = 'gmfs_1'
 GMF_GML_ID = 'gmf_1'
 SRS_EPSG_4326 = 'epsg:4326'
 
+# Number of `gmf_data` rows inserted at once by the GmfBulkWriter.
+GMF_INSERT_CHUNK_SIZE = 5000
+
+# Maximum number of ground motion fields waiting to be serialized by a
+# GmfSetWriter; the producer blocks when the queue is full.
+GMF_WRITER_QUEUE_SIZE = 100
+
 
 class HazardCurveXMLWriter(writer.FileWriter):
     """This class serializes hazard curve information to NRML format."""
@@ -452,6 +469,98 @@ class GMFXMLWriter(writer.XMLFileWriter):
         self.node_counter += 1
 
 
+GMF_NODES_MARKER = "GMFNodes"
+
+GMF_NODE_TEMPLATE = """\
+        <GMFNode gml:id="node%s">
+          <site>
+            <gml:Point>
+              <gml:pos>%s %s</gml:pos>
+            </gml:Point>
+          </site>
+          <groundMotion>%s</groundMotion>
+        </GMFNode>
+"""
+
+
+# Cache of the text preceding and following the nodes of GMF NRML documents.
+_GMF_NRML_SKELETON = []
+
+
+def _gmf_nrml_skeleton():
+    """Return the text preceding and following the GMF nodes of the NRML
+    documents written by :class:`GMFXMLWriter`."""
+    if not _GMF_NRML_SKELETON:
+        _GMF_NRML_SKELETON.extend(_build_gmf_nrml_skeleton())
+    return _GMF_NRML_SKELETON
+
+
+def _build_gmf_nrml_skeleton():
+    """Build the skeleton returned by :func:`_gmf_nrml_skeleton`."""
+    skeleton = GMFXMLWriter(None)
+    skeleton.write_header()
+    skeleton.parent_node.append(etree.Comment(GMF_NODES_MARKER))
+    text = etree.tostring(skeleton.root_node, pretty_print=True,
+                          xml_declaration=True, encoding="UTF-8")
+    marker = "<!--%s-->" % GMF_NODES_MARKER
+    head, tail = text.split(marker)
+    return head.rstrip(" "), tail.lstrip("\n")
+
+
+GMF_TEMPLATE = """\
+      <GMF gml:id="gmf_%s">
+"""
+
+GMF_END = """\
+      </GMF>
+"""
+
+
+# Cache of the text preceding and following the fields of GMF set NRML
+# documents.
+_GMF_SET_NRML_SKELETON = []
+
+
+def _gmf_set_nrml_skeleton():
+    """Return the text preceding and following the GMF elements of the NRML
+    documents written by :class:`GmfSetWriter`."""
+    if not _GMF_SET_NRML_SKELETON:
+        _GMF_SET_NRML_SKELETON.extend(_build_gmf_set_nrml_skeleton())
+    return _GMF_SET_NRML_SKELETON
+
+
+def _build_gmf_set_nrml_skeleton():
+    """Build the skeleton returned by :func:`_gmf_set_nrml_skeleton`."""
+    skeleton = GMFXMLWriter(None)
+    skeleton.write_header()
+    gmf_set_node = skeleton.parent_node.getparent()
+    gmf_set_node.remove(skeleton.parent_node)
+    gmf_set_node.append(etree.Comment(GMF_NODES_MARKER))
+    text = etree.tostring(skeleton.root_node, pretty_print=True,
+                          xml_declaration=True, encoding="UTF-8")
+    marker = "<!--%s-->" % GMF_NODES_MARKER
+    head, tail = text.split(marker)
+    return head.rstrip(" "), tail.lstrip("\n")
+
+
+def write_gmf_nrml(path, coords, gmvs):
+    """Write a ground motion field to NRML, streaming its nodes to the file
+    instead of building the whole document in memory. The document is
+    equivalent to the one written by :class:`GMFXMLWriter`.
+
+    :param str path: the path of the file to write
+    :param coords: the (longitude, latitude) pairs of the sites
+    :param gmvs: the ground motion values, aligned with `coords`
+    """
+    head, tail = _gmf_nrml_skeleton()
+    with open(path, "w") as nrml_file:
+        nrml_file.write(head)
+        for i, ((lon, lat), gmv) in enumerate(zip(coords, gmvs)):
+            nrml_file.write(
+                GMF_NODE_TEMPLATE % (i, str(lon), str(lat), str(gmv)))
+        nrml_file.write(tail)
+
+
 def _set_optional_attributes(element, value_dict, attr_keys):
     """Set the attributes for the given element specified
     in attr_keys if they are present in the value_dict dictionary."""
@@ -756,6 +865,54 @@ class HazardCurveDBWriter(writer.DBWriter):
             location="POINT(%s %s)" % (point.point.x, point.point.y))
 
 
+def gmf_site_ids(job_id, coords):
+    """
+    Return the ids of the `hzrdr.gmf_site` records of the given job at the
+    given sites, inserting the missing ones.
+
+    The sites are shared by all the ground motion fields of the job, so
+    their coordinates are stored once instead of once per ground motion
+    value. A site inserted concurrently by another task (the unique index
+    on the job and the geohash of the location is violated) is read back.
+
+    Must be called in a `reslt_writer` transaction.
+
+    :param int job_id: the id of the job the fields belong to
+    :param coords: the (longitude, latitude) pairs of the sites
+    :returns: the list of the site ids, aligned with `coords`
+    """
+    geohashes = [geohash.encode(lat, lon, precision=12)
+                 for lon, lat in coords]
+
+    def existing_ids():
+        """Map the geohashes of the sites of the job to their ids."""
+        sites = models.GmfSite.objects.using('reslt_writer').filter(
+            oq_job=job_id).extra(
+            select={'geohash': "ST_GeoHash(location, 12)"}).values_list(
+            'geohash', 'id')
+        return dict(sites)
+
+    ids = existing_ids()
+    while True:
+        missing = dict((gh, lon_lat) for gh, lon_lat in zip(geohashes, coords)
+                       if gh not in ids)
+        if not missing:
+            return [ids[gh] for gh in geohashes]
+
+        bulk_inserter = writer.BulkInserter(models.GmfSite)
+        for lon_lat in missing.itervalues():
+            bulk_inserter.add_entry(
+                oq_job_id=job_id, location="POINT(%s %s)" % lon_lat)
+        savepoint = transaction.savepoint(using='reslt_writer')
+        try:
+            bulk_inserter.flush()
+        except IntegrityError:
+            transaction.savepoint_rollback(savepoint, using='reslt_writer')
+        else:
+            transaction.savepoint_commit(savepoint, using='reslt_writer')
+        ids = existing_ids()
+
+
 class GmfDBReader(object):
     """
     Read ground motion field data from the database, returning a data structure
@@ -769,11 +926,12 @@ class GmfDBReader(object):
 
         The structure of the result is documented in :class:`GmfDBWriter`.
         """
-        gmf_data = models.GmfData.objects.filter(output=output_id)
+        gmf_data = models.GmfData.objects.filter(
+            output=output_id).select_related('site')
         points = {}
 
         for datum in gmf_data:
-            loc = datum.location
+            loc = datum.site.location
             points[shapes.Site(loc.x, loc.y)] = {
                 'groundMotion': datum.ground_motion,
             }
@@ -798,10 +956,23 @@ class GmfDBWriter(writer.DBWriter):
         super(GmfDBWriter, self).__init__(nrml_path, oq_job_id)
 
         self.bulk_inserter = writer.BulkInserter(models.GmfData)
+        self.site_ids = {}
 
     def get_output_type(self):
         return "gmf"
 
+    @transaction.commit_on_success('reslt_writer')
+    def serialize(self, iterable):
+        if isinstance(iterable, dict):
+            points = iterable.keys()
+        else:
+            points = [point for point, _ in iterable]
+        coords = [(point.point.x, point.point.y) for point in points]
+        self.site_ids.update(
+            zip(coords, gmf_site_ids(self.oq_job_id, coords)))
+
+        super(GmfDBWriter, self).serialize(iterable)
+
     def insert_datum(self, point, values):
         """
         Insert a single ground motion field entry.
@@ -814,7 +985,254 @@ class GmfDBWriter(writer.DBWriter):
         self.bulk_inserter.add_entry(
             output_id=self.output.id,
             ground_motion=values['groundMotion'],
-            location="POINT(%s %s)" % (point.point.x, point.point.y))
+            site_id=self.site_ids[(point.point.x, point.point.y)])
+
+
+class GmfBulkWriter(object):
+    """
+    Serialize all the ground motion fields of a stochastic event set at
+    once, to the `hzrdr.gmf_data` database table and/or to NRML files.
+
+    As with :class:`GmfDBWriter` an output record is created for each
+    field, but all the rows are inserted in a single transaction, in chunks
+    of `chunk_size` rows. The NRML files are written with
+    :func:`write_gmf_nrml`.
+    """
+
+    def __init__(self, job_id, serialize_to, nrml_path_template=None,
+                 chunk_size=GMF_INSERT_CHUNK_SIZE):
+        """
+        :param int job_id: the id of the job the fields belong to
+        :param serialize_to: where to serialize
+        :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+        :param str nrml_path_template: the path of the NRML file of each
+            field, with a `%s` placeholder for the rupture id; no NRML is
+            written when it is `None`
+        :param int chunk_size: the number of rows inserted at once
+        """
+        self.job_id = job_id
+        self.to_db = 'db' in serialize_to
+        self.to_xml = 'xml' in serialize_to
+        self.nrml_path_template = nrml_path_template
+        self.chunk_size = chunk_size
+
+        if self.to_db:
+            assert job_id, "No job_id supplied"
+            self.job_id = int(job_id)
+
+    @transaction.commit_on_success('reslt_writer')
+    def serialize(self, sites, ruptures):
+        """
+        Serialize the ground motion fields.
+
+        :param sites: the sites of the ground motion fields
+        :type sites: list of :class:`openquake.shapes.Site`
+        :param ruptures: (rupture id, ground motion values) pairs, the values
+            being natural logarithms aligned with `sites`; consumed one at a
+            time
+        :returns: the paths of the NRML files (empty strings when no NRML
+            file name was given), one for each field
+        """
+        coords = [(site.longitude, site.latitude) for site in sites]
+        job = site_ids = None
+        if self.to_db:
+            job = models.OqJob.objects.get(id=self.job_id)
+            site_ids = gmf_site_ids(self.job_id, coords)
+        bulk_inserter = writer.BulkInserter(models.GmfData)
+        files = []
+
+        for rupture, gmvs in ruptures:
+            gmvs = numpy.exp(gmvs).tolist()
+            nrml_path = ''
+            if self.nrml_path_template:
+                nrml_path = self.nrml_path_template % rupture
+
+            if self.to_db:
+                output = models.Output(
+                    owner=job.owner, oq_job=job, db_backed=True,
+                    display_name=basename(nrml_path), output_type="gmf")
+                output.save()
+                for site_id, gmv in zip(site_ids, gmvs):
+                    bulk_inserter.add_entry(
+                        output_id=output.id, ground_motion=gmv,
+                        site_id=site_id)
+                    if bulk_inserter.count >= self.chunk_size:
+                        bulk_inserter.flush()
+
+            if self.to_xml and nrml_path:
+                write_gmf_nrml(nrml_path, coords, gmvs)
+
+            files.append(nrml_path)
+
+        bulk_inserter.flush()
+        LOGGER.info("serialized %s ground motion fields", len(files))
+        return files
+
+
+class GmfSetWriter(object):
+    """
+    Serialize the ground motion fields of a calculation, in the order they
+    are added, on a background thread: the producer only blocks when
+    `queue_size` fields are waiting to be written.
+
+    The fields are written
+
+    * to a single NRML document, with a `GMF` element per field (streamed
+      like :func:`write_gmf_nrml` does);
+    * optionally, to an HDF5 file with the [fields, sites] matrix of the
+      ground motion values (dataset `gmvs`) and the coordinates of the
+      sites (datasets `lons` and `lats`);
+    * to the `hzrdr.gmf_data` database table, with an output record per
+      field, like :class:`GmfBulkWriter` does.
+    """
+
+    _DONE = object()
+
+    def __init__(self, job_id, serialize_to, nrml_path, coords,
+                 hdf5_path=None, queue_size=GMF_WRITER_QUEUE_SIZE,
+                 chunk_size=GMF_INSERT_CHUNK_SIZE):
+        """
+        :param int job_id: the id of the job the fields belong to
+        :param serialize_to: where to serialize
+        :type serialize_to: list of strings. Permitted values: 'db', 'xml'.
+        :param str nrml_path: the path of the NRML file
+        :param coords: the (longitude, latitude) pairs of the sites
+        :param str hdf5_path: the path of the HDF5 file; no HDF5 file is
+            written when it is `None`
+        :param int queue_size: the maximum number of fields waiting to be
+            written
+        :param int chunk_size: the number of rows inserted at once
+        """
+        self.job_id = job_id
+        self.to_db = 'db' in serialize_to
+        self.to_xml = 'xml' in serialize_to
+        self.nrml_path = nrml_path
+        self.hdf5_path = hdf5_path
+        self.coords = coords
+        self.chunk_size = chunk_size
+        self.num_fields = 0
+
+        if self.to_db:
+            assert job_id, "No job_id supplied"
+            self.job_id = int(job_id)
+
+        self._queue = Queue.Queue(queue_size)
+        self._error = None
+        self._done = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, gmvs):
+        """Queue a ground motion field for serialization.
+
+        :param gmvs: the ground motion values, aligned with the coordinates
+            of the sites
+        """
+        self._check_error()
+        self._queue.put(numpy.asarray(gmvs, dtype=float))
+        self.num_fields += 1
+
+    def close(self):
+        """Wait for all the queued fields to be written.
+
+        :raises: the exception raised on the background thread, if any
+        """
+        self._queue.put(self._DONE)
+        self._thread.join()
+        self._check_error()
+        LOGGER.info("serialized %s ground motion fields", self.num_fields)
+
+    def _check_error(self):
+        """Re-raise the exception raised on the background thread."""
+        if self._error is not None:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def _fields(self):
+        """Yield the queued fields until the writer is closed."""
+        while True:
+            gmvs = self._queue.get()
+            if gmvs is self._DONE:
+                self._done = True
+                return
+            yield gmvs
+
+    def _run(self):
+        """Serialize the queued fields, keeping on consuming the queue if
+        an error occurs, so that the producer never blocks."""
+        try:
+            self._serialize(self._fields())
+        except Exception:
+            self._error = sys.exc_info()
+            LOGGER.exception("ground motion field serialization failed")
+            if not self._done:
+                for _ in self._fields():
+                    pass
+        finally:
+            if self.to_db:
+                connections['reslt_writer'].close()
+
+    @transaction.commit_on_success('reslt_writer')
+    def _serialize(self, fields):
+        """Write the given fields to the NRML and HDF5 files and to the
+        database."""
+        nrml_file = hdf5_file = None
+        job = site_ids = None
+        if self.to_db:
+            job = models.OqJob.objects.get(id=self.job_id)
+            site_ids = gmf_site_ids(self.job_id, self.coords)
+        bulk_inserter = writer.BulkInserter(models.GmfData)
+
+        try:
+            if self.to_xml:
+                head, tail = _gmf_set_nrml_skeleton()
+                nrml_file = open(self.nrml_path, "w")
+                nrml_file.write(head)
+            if self.hdf5_path:
+                hdf5_file = h5py.File(self.hdf5_path, "w")
+                lons, lats = zip(*self.coords) if self.coords else ((), ())
+                hdf5_file.create_dataset("lons", data=numpy.array(lons))
+                hdf5_file.create_dataset("lats", data=numpy.array(lats))
+                dataset = hdf5_file.create_dataset(
+                    "gmvs", shape=(0, len(self.coords)), dtype=numpy.float64,
+                    maxshape=(None, len(self.coords)))
+
+            node = 0
+            for index, gmvs in enumerate(fields):
+                if nrml_file is not None:
+                    nrml_file.write(GMF_TEMPLATE % index)
+                    for (lon, lat), gmv in zip(self.coords, gmvs.tolist()):
+                        nrml_file.write(GMF_NODE_TEMPLATE % (
+                            node, str(lon), str(lat), str(gmv)))
+                        node += 1
+                    nrml_file.write(GMF_END)
+
+                if hdf5_file is not None:
+                    dataset.resize((index + 1, len(self.coords)))
+                    dataset[index] = gmvs
+
+                if self.to_db:
+                    output = models.Output(
+                        owner=job.owner, oq_job=job, db_backed=True,
+                        display_name="gmf-%s.xml" % index,
+                        output_type="gmf")
+                    output.save()
+                    for site_id, gmv in zip(site_ids, gmvs.tolist()):
+                        bulk_inserter.add_entry(
+                            output_id=output.id, ground_motion=gmv,
+                            site_id=site_id)
+                        if bulk_inserter.count >= self.chunk_size:
+                            bulk_inserter.flush()
+
+            bulk_inserter.flush()
+            if nrml_file is not None:
+                nrml_file.write(tail)
+        finally:
+            if nrml_file is not None:
+                nrml_file.close()
+            if hdf5_file is not None:
+                hdf5_file.close()
 
 
 def _create_writer(job_id, serialize_to, nrml_path, create_xml_writer,
@@ -31,7 +31,7 @@ class DisaggregationBinaryMatrixXMLWriter(writer.FileWriter):
     """Write a file for a single disaggregation field in NRML format."""
 
     def __init__(self, path, poe, imt, subsets, end_branch_label=None,
-                 statistics=None, quantile_value=None):
+                 statistics=None, quantile_value=None, comment=None):
         """
         :param path:
             Path to the resulting XML file.
@@ -47,6 +47,9 @@ class DisaggregationBinaryMatrixXMLWriter(writer.FileWriter):
         :param end_branch_label: optional
         :param statistics: optional
         :param quantile_value: optional
+        :param comment:
+            Optional text written as an XML comment in the
+            <disaggregationResultField/> element, to document the results.
         """
         writer.FileWriter.__init__(self, path)
 
@@ -56,6 +59,7 @@ class DisaggregationBinaryMatrixXMLWriter(writer.FileWriter):
         self.end_branch_label = end_branch_label
         self.statistics = statistics
         self.quantile_value = quantile_value
+        self.comment = comment
 
         self.id_counter = 0
 
@@ -101,6 +105,10 @@ class DisaggregationBinaryMatrixXMLWriter(writer.FileWriter):
             if value:
                 self.disagg_result_field_el.set(attr, str(value))
 
+        if self.comment:
+            self.disagg_result_field_el.append(
+                etree.Comment(" %s " % self.comment))
+
         disagg_result_types_el = etree.SubElement(
             self.disagg_result_field_el,
             "%sdisaggregationResultTypes" % NRML,
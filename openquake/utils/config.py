@@ -107,20 +107,91 @@ def abort_if_no_config_available():
         sys.exit(2)
 
 
+def _positive_int(section, key, default, allow_zero=False):
+    """Return the integer value of the given setting, or `default` when it
+    is not set or not positive (or negative, with `allow_zero`)."""
+    value = get(section, key)
+    if value is not None:
+        value = int(value.strip())
+
+    if value is not None and (value > 0 or allow_zero and value == 0):
+        return value
+    else:
+        return default
+
+
 def hazard_block_size(default=8192):
     """Return the default or configured hazard block size."""
-    block_size = 0
+    return _positive_int("hazard", "block_size", default)
+
+
+def hazard_site_cache_size(default=65536):
+    """Return the default or configured maximum number of parameterized
+    (Java) sites cached by each worker process; 0 disables the cache."""
+    return _positive_int("hazard", "site_cache_size", default,
+                         allow_zero=True)
+
+
+def hazard_ses_in_flight(default=16):
+    """Return the default or configured maximum number of event based
+    stochastic event sets being computed (or awaiting serialization) at
+    any time."""
+    return _positive_int("hazard", "ses_in_flight", default)
+
+
+def hazard_disagg_tasks_in_flight(default=256):
+    """Return the default or configured maximum number of disaggregation
+    tasks running at any time."""
+    return _positive_int("hazard", "disagg_tasks_in_flight", default)
+
 
-    configured_size = get("hazard", "block_size")
-    if configured_size is not None:
-        configured_size = int(configured_size.strip())
+def hazard_uhs_sites_per_task(default=8):
+    """Return the default or configured maximum number of sites whose
+    Uniform Hazard Spectra are computed by each task."""
+    return _positive_int("hazard", "uhs_sites_per_task", default)
 
-    if configured_size and configured_size > 0:
-        block_size = configured_size
+
+def hazard_uhs_prefetch_blocks(default=1):
+    """Return the default or configured number of blocks of sites submitted
+    ahead of the one the UHS calculator is waiting for."""
+    return _positive_int("hazard", "uhs_prefetch_blocks", default,
+                         allow_zero=True)
+
+
+def hazard_scenario_gmf_chunk_size(default=0):
+    """Return the configured number of scenario ground motion fields
+    computed by each task; 0 (the default) means that all the fields are
+    computed by the job executor process."""
+    return _positive_int("hazard", "scenario_gmf_chunk_size", default)
+
+
+def hazard_scenario_gmf_tasks_in_flight(default=64):
+    """Return the default or configured maximum number of scenario ground
+    motion field tasks running at any time."""
+    return _positive_int("hazard", "scenario_gmf_tasks_in_flight", default)
+
+
+def hazard_scenario_gmf_engine(default="java"):
+    """Return the configured engine generating the scenario ground motion
+    fields: "java" (the default) or "numpy"."""
+    engine = get("hazard", "scenario_gmf_engine")
+    if engine is not None:
+        engine = engine.strip().lower()
+
+    if engine in ("java", "numpy"):
+        return engine
     else:
-        block_size = default
+        return default
+
 
-    return block_size
+def hazard_gmf_split(default=0):
+    """Return the configured (site block size, rupture chunk size) used to
+    split the event based ground motion field calculation of a stochastic
+    event set into tasks; 0 means no split. When both are 0 each stochastic
+    event set is computed by a single task (the default)."""
+    return tuple(_positive_int("hazard", setting, default)
+                 for setting in ("gmf_site_block_size",
+                                 "gmf_rupture_chunk_size"))
 
 
 def flag_set(section, setting):
@@ -92,6 +92,11 @@ STATS_KEYS = {
 #   job_id, computation area, key fragment, counter_type.
 _KEY_TEMPLATE = "oqs/%s/%s/%s/%s"
 
+# Key template for the per worker process statistics, see set_worker_stats().
+_WORKER_KEY_TEMPLATE = "oqs/workers/%s"
+# Worker statistics expire after a week.
+_WORKER_STATS_TTL = 7 * 24 * 3600
+
 
 def kvs_op(dop, *kvs_args):
     """Apply the kvs operation using the predefined key.
@@ -184,6 +189,33 @@ def _redis():
     return redis.Redis(**args)
 
 
+def set_worker_stats(worker_id, data):
+    """Record statistics (e.g. JVM start up timings) for a worker process.
+
+    :param str worker_id: identifies the worker process, e.g. "host:pid"
+    :param dict data: the statistics to record
+    """
+    conn = _redis()
+    key = _WORKER_KEY_TEMPLATE % worker_id
+    conn.hmset(key, data)
+    conn.expire(key, _WORKER_STATS_TTL)
+
+
+def get_worker_stats():
+    """Return the statistics recorded for the worker processes.
+
+    :returns: a dict mapping each worker id to its statistics (a dict with
+        float values)
+    """
+    conn = _redis()
+    prefix = _WORKER_KEY_TEMPLATE % ""
+    result = dict()
+    for key in conn.keys(_WORKER_KEY_TEMPLATE % "*"):
+        result[key[len(prefix):]] = dict(
+            (k, float(v)) for k, v in conn.hgetall(key).iteritems())
+    return result
+
+
 def key_name(job_id, area, key_fragment, counter_type):
     """Return `None` or the full predefined statistics key.
 
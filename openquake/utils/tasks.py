@@ -19,10 +19,17 @@
 
 """Utility functions related to splitting work into tasks."""
 
+import collections
 import itertools
+import os
+import socket
+
+from celery.result import ResultSet
+from celery.signals import worker_process_init
 from celery.task.sets import TaskSet
 
 from openquake import logs
+from openquake.utils import config
 
 
 def distribute(task_func, (name, data), tf_args=None, ath=None, ath_args=None,
@@ -163,3 +170,151 @@ def calculator_for_task(job_id, job_type):
     calculator = CALCS[job_type][calc_mode](job_ctxt)
 
     return calculator
+
+
+class TaskPipeline(object):
+    """Submit celery tasks with at most `max_in_flight` of them running at
+    any time, and collect them in completion order by waiting on a
+    :class:`celery.result.ResultSet` of the tasks in flight.
+
+    The tasks are given as `(submit, context)` pairs, `submit` being a
+    callable submitting a task and returning its asynchronous result (e.g.
+    a partial application of the `delay` method of the task) and `context`
+    any data identifying the task. The tasks of :meth:`run` are submitted
+    lazily, as the running tasks complete; the tasks queued with
+    :meth:`follow_up`, which depend on the results of the former, share the
+    same budget and are submitted first.
+    """
+
+    def __init__(self, max_in_flight):
+        """
+        :param int max_in_flight: maximum number of tasks running at any
+            time
+        """
+        self.max_in_flight = max_in_flight
+        # the (submit, context) pairs of :meth:`run`, None when exhausted
+        self._submissions = None
+        self._follow_ups = collections.deque()
+        self._in_flight = ResultSet([])
+        # the iterator of the completed tasks in flight, None when tasks were
+        # added since it was created
+        self._in_flight_iter = None
+        # task id -> (task, context, is a follow-up task)
+        self._contexts = dict()
+        # is a follow-up task -> number of tasks in flight
+        self._running = {False: 0, True: 0}
+        # is a follow-up task -> completed (task, context) pairs not yet
+        # collected
+        self._completed = {False: collections.deque(),
+                           True: collections.deque()}
+
+    def run(self, submissions):
+        """Submit the tasks of an iterable of `(submit, context)` pairs,
+        consumed lazily, and yield the `(task, context)` pairs as the tasks
+        complete. The follow-up tasks completing in the meantime are kept
+        for :meth:`follow_ups`."""
+        self._submissions = iter(submissions)
+        self._top_up()
+        return self._collect(False, wait=True)
+
+    def follow_up(self, submit, context):
+        """Queue a task depending on the result of a completed one."""
+        self._follow_ups.append((submit, context))
+        self._top_up()
+
+    def follow_ups(self, wait=False):
+        """Yield the `(task, context)` pairs of the completed follow-up
+        tasks; with `wait`, until all the queued ones are completed."""
+        return self._collect(True, wait)
+
+    def _collect(self, follow_up, wait):
+        """Yield the completed tasks of a kind, waiting for the running ones
+        if `wait` is set."""
+        completed = self._completed[follow_up]
+        while True:
+            while completed:
+                yield completed.popleft()
+            if not wait or not self._pending(follow_up):
+                break
+            self._wait()
+
+    def _pending(self, follow_up):
+        """Are there tasks of a kind running or yet to be submitted?"""
+        if follow_up:
+            return self._running[True] or self._follow_ups
+        return self._running[False] or self._submissions is not None
+
+    def _top_up(self):
+        """Submit tasks until `max_in_flight` of them are running, the
+        follow-up tasks first."""
+        while len(self._contexts) < self.max_in_flight:
+            if self._follow_ups:
+                submit, context = self._follow_ups.popleft()
+                follow_up = True
+            elif self._submissions is not None:
+                try:
+                    submit, context = self._submissions.next()
+                except StopIteration:
+                    self._submissions = None
+                    break
+                follow_up = False
+            else:
+                break
+
+            a_task = submit()
+            self._in_flight.add(a_task)
+            self._in_flight_iter = None
+            self._contexts[a_task.task_id] = (a_task, context, follow_up)
+            self._running[follow_up] += 1
+
+    def _wait(self):
+        """Wait for the completion of a task in flight and replace it.
+
+        The same iterator of the completed tasks is used until new tasks are
+        submitted, instead of querying the results of all the tasks in flight
+        each time."""
+        if self._in_flight_iter is None:
+            self._in_flight_iter = self._in_flight.iter_native()
+        task_id, _ = self._in_flight_iter.next()
+        a_task, context, follow_up = self._contexts.pop(task_id)
+        self._in_flight.discard(a_task)
+        self._running[follow_up] -= 1
+        self._completed[follow_up].append((a_task, context))
+        self._top_up()
+
+
+def prewarm_jvm(**_kwargs):
+    """Start the JVM as soon as a celery worker process is started (and
+    restarted, e.g. due to `CELERYD_MAX_TASKS_PER_CHILD`), instead of lazily
+    inside its first task.
+
+    This is a `worker_process_init` signal handler, enabled by the `prewarm`
+    setting in the `java` section of openquake.cfg; `prewarm_calc` turns on
+    the warm-up workload as well. The time spent is recorded in the worker
+    statistics (see :func:`openquake.utils.stats.get_worker_stats`).
+
+    A failed warm-up is logged and does not prevent the worker from starting.
+    """
+    if not config.flag_set("java", "prewarm"):
+        return
+
+    # pylint: disable=W0404
+    from openquake import java
+    from openquake.utils import stats
+
+    try:
+        timings = java.warm_up(calc=config.flag_set("java", "prewarm_calc"))
+    except Exception:  # pylint: disable=W0703
+        # The worker is still usable: the JVM is (re)started lazily by its
+        # first task.
+        logs.LOG.exception("JVM pre-warming failed")
+        return
+
+    logs.LOG.info("JVM pre-warmed in %.2f seconds (%s)"
+                  % (sum(timings.values()), timings))
+
+    worker_id = "%s:%s" % (socket.gethostname(), os.getpid())
+    stats.set_worker_stats(worker_id, timings)
+
+
+worker_process_init.connect(prewarm_jvm)
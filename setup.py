@@ -27,7 +27,7 @@ setup(
                                 'nrml/schema/hazard/*', 'nrml/schema/risk/*', 'nrml/schema/gml/*',
                                 'nrml/schema/GML-SimpleFeaturesProfileSchema.xsd',
                                 'nrml/schema/nrml_common.xsd', 'nrml/schema/nrml.xsd',
-                                'nrml/schema/xlinks/*', 'logging.cfg', 'openquake.cfg', 'README', 'LICENSE' ]},
+                                'nrml/schema/xlinks/*', 'data/*', 'logging.cfg', 'openquake.cfg', 'README', 'LICENSE' ]},
 
     scripts = [
         "bin/openquake", "bin/oq_create_db", "bin/oq_cache_gc",
@@ -23,7 +23,7 @@ from django.db import transaction
 
 from openquake import writer
 
-from openquake.db.models import OqUser, GmfData
+from openquake.db.models import OqUser, GmfSite
 from openquake.writer import BulkInserter
 
 
@@ -123,17 +123,17 @@ class BulkInserterTestCase(unittest.TestCase):
 
     @transaction.commit_on_success('reslt_writer')
     def test_flush_geometry(self):
-        inserter = BulkInserter(GmfData)
+        inserter = BulkInserter(GmfSite)
         connection = writer.connections['reslt_writer']
 
-        inserter.add_entry(location='POINT(1 1)', output_id=1)
+        inserter.add_entry(location='POINT(1 1)', oq_job_id=1)
         fields = inserter.fields
         inserter.flush()
 
-        if fields[0] == 'output_id':
+        if fields[0] == 'oq_job_id':
             values = '%s, GeomFromText(%s, 4326)'
         else:
             values = 'GeomFromText(%s, 4326), %s'
 
-        self.assertEquals('INSERT INTO "hzrdr"."gmf_data" (%s) VALUES (%s)' %
+        self.assertEquals('INSERT INTO "hzrdr"."gmf_site" (%s) VALUES (%s)' %
                           (", ".join(fields), values), connection.sql)
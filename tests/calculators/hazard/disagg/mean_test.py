@@ -0,0 +1,113 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from openquake.shapes import Site
+
+from openquake.calculators.hazard.disagg import mean
+from openquake.calculators.hazard.disagg import store
+
+
+def _file_path(result_dir, realization, gmv, site):
+    return os.path.join(result_dir, '%s-%s-%s-%s.h5' % (
+        realization, gmv, site.longitude, site.latitude))
+
+
+class MeanSubsetsTestCase(unittest.TestCase):
+    """Tests for the mean of the disaggregation subsets across the
+    realizations."""
+
+    SITES = [Site(0.0, 0.0), Site(0.1, 0.0)]
+    SUBSET_TYPES = ['MagPMF', 'LatLonPMF']
+
+    def setUp(self):
+        self.result_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.result_dir)
+
+    def _subsets(self, realization, index):
+        return {'MagPMF': numpy.arange(4.0) * realization + index,
+                'LatLonPMF': numpy.ones((5, 5)) * realization * index}
+
+    def _realization_data(self, realization, consolidated):
+        gmvs = [0.1 * realization + index for index in xrange(2)]
+        if consolidated:
+            path = store.write_store(
+                self.result_dir, realization, 0.1, self.SITES, gmvs,
+                dict((subset_type, [self._subsets(realization, index)[
+                    subset_type] for index in xrange(2)])
+                    for subset_type in self.SUBSET_TYPES))
+            return [(site, gmv, path) for site, gmv in zip(self.SITES, gmvs)]
+
+        data = []
+        for index, (site, gmv) in enumerate(zip(self.SITES, gmvs)):
+            path = _file_path(self.result_dir, realization, gmv, site)
+            with h5py.File(path, 'w') as subsets_file:
+                for subset_type, subset in self._subsets(
+                        realization, index).iteritems():
+                    subsets_file.create_dataset(subset_type, data=subset)
+            data.append((site, gmv, path))
+        return data
+
+    def _check_mean(self, data, read):
+        # the mean of the realizations 1, 2 and 3
+        self.assertEqual(self.SITES, [site for site, _, _ in data])
+        for index, (_, gmv, path) in enumerate(data):
+            self.assertAlmostEqual(0.2 + index, gmv)
+            self.assertTrue(numpy.allclose(
+                numpy.arange(4.0) * 2 + index,
+                read(path, 'MagPMF', index)))
+            self.assertTrue(numpy.allclose(
+                numpy.ones((5, 5)) * 2 * index,
+                read(path, 'LatLonPMF', index)))
+
+    def test_mean_per_site_files(self):
+        mean_subsets = mean.MeanSubsets(self.SITES, self.SUBSET_TYPES)
+        for realization in (1, 2, 3):
+            mean_subsets.add(self._realization_data(realization, False))
+        self.assertEqual(3, mean_subsets.count)
+
+        data = mean_subsets.save(self.result_dir, 0.1, _file_path)
+
+        def read(path, subset_type, _index):
+            with h5py.File(path, 'r') as subsets_file:
+                return subsets_file[subset_type][:]
+
+        self.assertEqual(
+            _file_path(self.result_dir, mean.MEAN, data[0][1], self.SITES[0]),
+            data[0][2])
+        self._check_mean(data, read)
+
+    def test_mean_consolidated(self):
+        mean_subsets = mean.MeanSubsets(self.SITES, self.SUBSET_TYPES,
+                                        consolidated=True)
+        for realization in (1, 2, 3):
+            mean_subsets.add(self._realization_data(realization, True))
+
+        data = mean_subsets.save(self.result_dir, 0.1, _file_path)
+
+        self.assertEqual(store.store_path(self.result_dir, mean.MEAN, 0.1),
+                         data[0][2])
+        self._check_mean(
+            data, lambda path, subset_type, index: store.read_subset(
+                path, subset_type, self.SITES[index]))
@@ -0,0 +1,158 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import mock
+import numpy
+
+from tests.utils import helpers
+
+from openquake.shapes import Site
+
+from openquake.calculators.hazard.disagg import store
+
+
+class DisaggStoreTestCase(unittest.TestCase):
+    """Tests for the consolidated storage of the disaggregation subsets."""
+
+    SITES = [Site(0.0, 0.0), Site(0.1, 0.0), Site(0.0, 0.1)]
+
+    def setUp(self):
+        self.result_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.result_dir)
+
+    def _subsets(self, index):
+        return {'MagPMF': numpy.arange(4.0) + index,
+                'LatLonPMF': numpy.ones((5, 5)) * index}
+
+    def _write_shards(self):
+        # the sites are computed by two worker processes, out of order
+        for index, pid in [(2, 1), (0, 2), (1, 1)]:
+            path = '%s-%s.h5' % (
+                store._shard_prefix(self.result_dir, 1, 0.1), pid)
+            with helpers.patch(
+                    'openquake.calculators.hazard.disagg.store.shard_path'
+                    ) as shard_path:
+                shard_path.return_value = path
+                store.write_to_shard(
+                    self.result_dir, 1, 0.1, [self.SITES[index]],
+                    [0.2 + index],
+                    dict((subset_type, [subset]) for subset_type, subset
+                         in self._subsets(index).iteritems()))
+
+    def test_merge_shards(self):
+        self._write_shards()
+        self.assertEqual(2, len(os.listdir(self.result_dir)))
+
+        path = store.merge_shards(self.result_dir, 1, 0.1, self.SITES)
+
+        self.assertEqual(store.store_path(self.result_dir, 1, 0.1), path)
+        # the shards are deleted
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(self.result_dir))
+
+        with h5py.File(path, 'r') as h5:
+            self.assertEqual([0.0, 0.1, 0.0], h5[store.LONS][:].tolist())
+            self.assertEqual([0.0, 0.0, 0.1], h5[store.LATS][:].tolist())
+            self.assertEqual([0.2, 1.2, 2.2], h5[store.GMVS][:].tolist())
+
+            self.assertEqual((3, 4), h5['MagPMF'].shape)
+            self.assertEqual((1, 4), h5['MagPMF'].chunks)
+            self.assertEqual(store.COMPRESSION, h5['MagPMF'].compression)
+            self.assertEqual((3, 5, 5), h5['LatLonPMF'].shape)
+            self.assertEqual((1, 5, 5), h5['LatLonPMF'].chunks)
+
+            for index in xrange(3):
+                for subset_type, subset in self._subsets(index).items():
+                    self.assertTrue(
+                        (subset == h5[subset_type][index]).all())
+
+    def test_write_to_shard_appends_rows(self):
+        path = store.shard_path(self.result_dir, 1, 0.1)
+        store.write_to_shard(
+            self.result_dir, 1, 0.1, self.SITES[:2], [0.2, 1.2],
+            {'MagPMF': [numpy.arange(4.0), numpy.arange(4.0) + 1]})
+        store.write_to_shard(
+            self.result_dir, 1, 0.1, self.SITES[2:], [2.2],
+            {'MagPMF': [numpy.arange(4.0) + 2]})
+
+        with h5py.File(path, 'r') as h5:
+            self.assertEqual([0.2, 1.2, 2.2], h5[store.GMVS][:].tolist())
+            self.assertEqual((3, 4), h5['MagPMF'].shape)
+            self.assertEqual((1, 4), h5['MagPMF'].chunks)
+            self.assertEqual([2.0, 3.0, 4.0, 5.0],
+                             h5['MagPMF'][2].tolist())
+
+    def test_merge_shards_with_retried_sites(self):
+        self._write_shards()
+        # site 1 computed again by another worker process, the last result
+        # wins
+        with helpers.patch(
+                'openquake.calculators.hazard.disagg.store.shard_path') as (
+                shard_path):
+            shard_path.return_value = '%s-%s.h5' % (
+                store._shard_prefix(self.result_dir, 1, 0.1), 3)
+            store.write_to_shard(
+                self.result_dir, 1, 0.1, [self.SITES[1]], [7.0],
+                dict((subset_type, [subset * 0 + 7]) for subset_type, subset
+                     in self._subsets(1).iteritems()))
+
+        # merged in small blocks
+        with mock.patch(
+                'openquake.calculators.hazard.disagg.store'
+                '.MERGE_BLOCK_SIZE', 1):
+            path = store.merge_shards(self.result_dir, 1, 0.1, self.SITES)
+
+        with h5py.File(path, 'r') as h5:
+            self.assertEqual([0.2, 7.0, 2.2], h5[store.GMVS][:].tolist())
+            self.assertEqual([0.0, 7.0, 2.0],
+                             h5['MagPMF'][:, 0].tolist())
+
+    def test_merge_shards_reports_missing_sites(self):
+        self._write_shards()
+        sites = self.SITES + [Site(1.0, 1.0)]
+
+        try:
+            store.merge_shards(self.result_dir, 1, 0.1, sites)
+        except RuntimeError, e:
+            self.assertTrue("1 of 4 sites" in str(e))
+            self.assertTrue(str(Site(1.0, 1.0)) in str(e))
+        else:
+            self.fail("RuntimeError not raised")
+        # the shards are left in place
+        self.assertEqual(2, len(os.listdir(self.result_dir)))
+
+    def test_merge_shards_without_shards(self):
+        self.assertRaises(RuntimeError, store.merge_shards,
+                          self.result_dir, 1, 0.1, self.SITES)
+
+    def test_read_subset(self):
+        self._write_shards()
+        path = store.merge_shards(self.result_dir, 1, 0.1, self.SITES)
+
+        for index, site in enumerate(self.SITES):
+            self.assertTrue(
+                (numpy.ones((5, 5)) * index
+                 == store.read_subset(path, 'LatLonPMF', site)).all())
+
+        self.assertRaises(KeyError, store.read_subset, path, 'LatLonPMF',
+                          Site(1.0, 1.0))
@@ -24,10 +24,228 @@ import numpy
 from tests.utils import helpers
 
 from openquake.shapes import Site
+from openquake.shapes import hdistance
 
 from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
 from openquake.calculators.hazard.disagg import subsets as disagg_subsets
 
+# pylint: disable=R0913,R0914
+
+# The reference implementations of the subset extractors, summing the full
+# matrix cell by cell.
+
+DATA_TYPE = disagg_subsets.DATA_TYPE
+
+
+def loop_magpmf(site, full_matrix,
+                lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Magnitude PMF extractor (1D).
+    """
+    shape = [nmag - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nmag - 1):
+        ds[i] = sum(full_matrix[j][k][i][l][m]
+                    for j in xrange(nlat - 1)
+                    for k in xrange(nlon - 1)
+                    for l in xrange(neps - 1)
+                    for m in xrange(ntrt))
+    return ds
+
+
+def loop_distgen(site, lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                 nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Common part of the code for all extractors that compute distances.
+    """
+    slat = site.latitude
+    slon = site.longitude
+    enumeration = ((i, j, k, l, m)
+                   for i in xrange(nlat - 1)
+                   for j in xrange(nlon - 1)
+                   for k in xrange(nmag - 1)
+                   for l in xrange(neps - 1)
+                   for m in xrange(ntrt))
+    for i, j, k, l, m in enumeration:
+        meanlat = (lat_bin_edges[i] + lat_bin_edges[i + 1]) / 2
+        meanlon = (lon_bin_edges[j] + lon_bin_edges[j + 1]) / 2
+        dist = hdistance(meanlat, meanlon, slat, slon)
+        if dist < distance_bin_edges[0] \
+                or dist > distance_bin_edges[-1]:
+            continue
+        ii = 0
+        for ii in xrange(ndist - 1):
+            if dist >= distance_bin_edges[ii] \
+                    and dist < distance_bin_edges[ii + 1]:
+                break
+        yield i, j, k, l, m, ii
+
+
+def loop_distpmf(site, full_matrix,
+                 lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                 nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Distance PMF extractor (1D).
+    """
+    shape = [ndist - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    distgen = loop_distgen(site, lat_bin_edges, lon_bin_edges,
+                           distance_bin_edges,
+                           nlat, nlon, nmag, neps, ntrt, ndist)
+    for i, j, k, l, m, ii in distgen:
+        ds[ii] += full_matrix[i][j][k][l][m]
+    return ds
+
+
+def loop_trtpmf(site, full_matrix,
+                lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Tectonic region type PMF extractor (1D).
+    """
+    shape = [ntrt]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(ntrt):
+        ds[i] = sum(full_matrix[j][k][l][m][i]
+                    for j in xrange(nlat - 1)
+                    for k in xrange(nlon - 1)
+                    for l in xrange(nmag - 1)
+                    for m in xrange(neps - 1))
+    return ds
+
+
+def loop_magdistpmf(site, full_matrix,
+                    lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                    nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Magnitude-distance PMF extractor (2D).
+    """
+    ndist = len(distance_bin_edges)
+    shape = [nmag - 1, ndist - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    distgen = loop_distgen(site, lat_bin_edges, lon_bin_edges,
+                           distance_bin_edges,
+                           nlat, nlon, nmag, neps, ntrt, ndist)
+    for i, j, k, l, m, ii in distgen:
+        ds[k][ii] += full_matrix[i][j][k][l][m]
+    return ds
+
+
+def loop_magdistepspmf(site, full_matrix,
+                       lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                       nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Magnitude-distance-epsilon PMF extractor (3D).
+    """
+    shape = [nmag - 1, ndist - 1, neps - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    distgen = loop_distgen(site, lat_bin_edges, lon_bin_edges,
+                           distance_bin_edges,
+                           nlat, nlon, nmag, neps, ntrt, ndist)
+    for i, j, k, l, m, ii in distgen:
+        ds[k][ii][l] += full_matrix[i][j][k][l][m]
+    return ds
+
+
+def loop_latlonpmf(site, full_matrix,
+                   lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                   nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Latitude-longitude PMF extractor (2D).
+    """
+    shape = [nlat - 1, nlon - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nlat - 1):
+        for j in xrange(nlon - 1):
+            ds[i][j] = sum(full_matrix[i][j][k][l][m]
+                           for k in xrange(nmag - 1)
+                           for l in xrange(neps - 1)
+                           for m in xrange(ntrt))
+    return ds
+
+
+def loop_latlonmagpmf(site, full_matrix,
+                      lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                      nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Latitude-longitude-magnitude PMF extractor (3D).
+    """
+    shape = [nlat - 1, nlon - 1, nmag - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nlat - 1):
+        for j in xrange(nlon - 1):
+            for k in xrange(nmag - 1):
+                ds[i][j][k] = sum(full_matrix[i][j][k][l][m]
+                                  for l in xrange(neps - 1)
+                                  for m in xrange(ntrt))
+    return ds
+
+
+def loop_latlonmagepspmf(site, full_matrix,
+                         lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                         nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Latitude-longitude-magnitude-epsilon PMF extractor (4D).
+    """
+    shape = [nlat - 1, nlon - 1, nmag - 1, neps - 1]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nlat - 1):
+        for j in xrange(nlon - 1):
+            for k in xrange(nmag - 1):
+                for l in xrange(neps - 1):
+                    ds[i][j][k][l] = sum(full_matrix[i][j][k][l][m]
+                                         for m in xrange(ntrt))
+    return ds
+
+
+def loop_magtrtpmf(site, full_matrix,
+                   lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                   nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Magnitude -- tectonic region type PMF extractor (2D).
+    """
+    shape = [nmag - 1, ntrt]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nmag - 1):
+        for j in xrange(ntrt):
+            ds[i][j] = sum(full_matrix[k][l][i][m][j]
+                           for k in xrange(nlat - 1)
+                           for l in xrange(nlon - 1)
+                           for m in xrange(neps - 1))
+    return ds
+
+
+def loop_latlontrtpmf(site, full_matrix,
+                      lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                      nlat, nlon, nmag, neps, ntrt, ndist):
+    """
+    Latitude -- longitude -- tectonic region type PMF extractor (3D).
+    """
+    shape = [nlat - 1, nlon - 1, ntrt]
+    ds = numpy.zeros(shape, DATA_TYPE)
+    for i in xrange(nlat - 1):
+        for j in xrange(nlon - 1):
+            for k in xrange(ntrt):
+                ds[i][j][k] = sum(full_matrix[i][j][l][m][k]
+                                  for l in xrange(nmag - 1)
+                                  for m in xrange(neps - 1))
+    return ds
+
+
+LOOP_EXTRACTORS = {
+    "MagPMF": loop_magpmf,
+    "DistPMF": loop_distpmf,
+    "TRTPMF": loop_trtpmf,
+    "MagDistPMF": loop_magdistpmf,
+    "MagDistEpsPMF": loop_magdistepspmf,
+    "LatLonPMF": loop_latlonpmf,
+    "LatLonMagPMF": loop_latlonmagpmf,
+    "LatLonMagEpsPMF": loop_latlonmagepspmf,
+    "MagTRTPMF": loop_magtrtpmf,
+    "LatLonTRTPMF": loop_latlontrtpmf,
+}
+
 
 class SubsetExtractionTestCase(unittest.TestCase):
     FULL_MATRIX_DATA = \
@@ -176,3 +394,100 @@ class SubsetExtractionTestCase(unittest.TestCase):
         actual = h5py.File(target_path, 'r')[subset_name].value
 
         helpers.assertDeepAlmostEqual(self, expected_data, actual)
+
+
+class VectorizedExtractorsTestCase(unittest.TestCase):
+    """
+    The subset extractors give the same results as the reference
+    implementations summing the full matrix cell by cell.
+    """
+
+    def _check_extractors(self, site, lat_bin_edges, lon_bin_edges,
+                          mag_bin_edges, eps_bin_edges, distance_bin_edges,
+                          full_matrix):
+        nlat = len(lat_bin_edges)
+        nlon = len(lon_bin_edges)
+        nmag = len(mag_bin_edges)
+        neps = len(eps_bin_edges)
+        ndist = len(distance_bin_edges)
+        for name, loop_extractor in LOOP_EXTRACTORS.items():
+            args = (site, full_matrix,
+                    lat_bin_edges, lon_bin_edges, distance_bin_edges,
+                    nlat, nlon, nmag, neps, 5, ndist)
+            expected = loop_extractor(*args)
+            actual = disagg_subsets.SUBSET_EXTRACTORS[name](*args)
+            self.assertEqual(expected.shape, actual.shape, name)
+            self.assertEqual(DATA_TYPE, actual.dtype, name)
+            numpy.testing.assert_allclose(expected, actual, rtol=1e-12,
+                                          err_msg=name)
+
+    def test_random_matrices(self):
+        rng = numpy.random.RandomState(42)
+        for _ in xrange(5):
+            nlat, nlon, nmag, neps = rng.randint(2, 7, size=4)
+            lat_bin_edges = list(numpy.cumsum(rng.uniform(0.05, 0.3, nlat))
+                                 - 0.5)
+            lon_bin_edges = list(numpy.cumsum(rng.uniform(0.05, 0.3, nlon))
+                                 - 0.5)
+            mag_bin_edges = range(5, 5 + nmag)
+            eps_bin_edges = range(-1, -1 + neps)
+            distance_bin_edges = [0.0, 15.0, 30.0, 45.0]
+            full_matrix = rng.uniform(
+                size=(nlat - 1, nlon - 1, nmag - 1, neps - 1, 5))
+            site = Site(rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2))
+
+            self._check_extractors(
+                site, lat_bin_edges, lon_bin_edges, mag_bin_edges,
+                eps_bin_edges, distance_bin_edges, full_matrix)
+
+    def test_larger_full_matrix(self):
+        # the matrix can have more bins than the bin edges define
+        # (see bug 932765)
+        rng = numpy.random.RandomState(7)
+        edges = [-0.6, -0.3, -0.1, 0.1, 0.3, 0.6]
+        full_matrix = rng.uniform(size=(5, 5, 4, 4, 5))
+
+        self._check_extractors(
+            Site(0.0, 0.0), edges, edges, [5.0, 6.0, 7.0],
+            [-0.5, 0.5, 1.5], [0.0, 20.0, 40.0, 60.0], full_matrix)
+
+    def test_distance_on_the_bin_edges(self):
+        # a cell center at the upper edge of the distance bins belongs to
+        # the last bin, cells beyond it are ignored
+        edges = [-0.1, 0.1, 0.3]
+        dist = hdistance(0.0, 0.0, 0.2, 0.0)
+        full_matrix = numpy.ones((2, 2, 1, 1, 5))
+
+        self._check_extractors(
+            Site(0.0, 0.0), edges, edges, [5.0, 6.0], [0.0, 1.0],
+            [0.0, dist / 2, dist], full_matrix)
+
+
+class DistanceBinsTestCase(unittest.TestCase):
+    """Tests for the caching of the distance bins of the lat/lon cells."""
+
+    EDGES = [-0.6, -0.3, -0.1, 0.1, 0.3, 0.6]
+    DISTANCE_BIN_LIMITS = [0.0, 20.0, 40.0, 60.0]
+
+    def _distance_bins(self, site, distance_bin_edges=DISTANCE_BIN_LIMITS):
+        return disagg_subsets._distance_bins(
+            site, self.EDGES, self.EDGES, distance_bin_edges,
+            len(self.EDGES), len(self.EDGES), len(distance_bin_edges))
+
+    def test_bins_are_computed_once_per_site(self):
+        site = Site(0.0, 0.0)
+        bins = self._distance_bins(site)
+
+        self.assertTrue(bins is self._distance_bins(Site(0.0, 0.0)))
+        self.assertFalse(bins is self._distance_bins(Site(0.1, 0.0)))
+        for array in bins:
+            self.assertFalse(array.flags.writeable)
+
+    def test_new_bin_edges_clear_the_cache(self):
+        site = Site(0.0, 0.0)
+        bins = self._distance_bins(site)
+        other_bins = self._distance_bins(site, [0.0, 30.0, 60.0])
+
+        self.assertEqual(1, len(disagg_subsets._DISTANCE_BINS_CACHE))
+        self.assertFalse(bins is other_bins)
+        self.assertEqual(2, other_bins[2].max() + 1)
@@ -0,0 +1,350 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import mock
+import numpy
+import os
+import random
+import struct
+import unittest
+
+from openquake import kvs
+from openquake.calculators.hazard.event_based import core
+from openquake.shapes import Site
+
+from tests.utils import helpers
+from tests.utils.tasks import FakeResultSet
+
+
+EB_DEMO_CONFIG_FILE = helpers.demo_file('event_based_hazard/config.gem')
+
+EB_CORE_MODULE = 'openquake.calculators.hazard.event_based.core'
+
+
+class EventBasedBaseTestCase(unittest.TestCase):
+    """Shared functionality for the event based hazard test cases."""
+
+    SITES = [Site(15.48, 38.11 + i * 0.03) for i in xrange(5)]
+
+    def setUp(self):
+        self.job_ctxt = helpers.prepare_job_context(EB_DEMO_CONFIG_FILE)
+        self.job_ctxt.to_kvs()
+        self.job_id = self.job_ctxt.job_id
+        self.calc = core.EventBasedHazardCalculator(self.job_ctxt)
+
+
+class ExecuteBlocksTestCase(EventBasedBaseTestCase):
+    """Tests for
+    :meth:`core.EventBasedHazardCalculator.execute_blocks`."""
+
+    def setUp(self):
+        super(ExecuteBlocksTestCase, self).setUp()
+        self.job_ctxt.params['NUMBER_OF_SEISMICITY_HISTORIES'] = '1'
+        self.job_ctxt.params['NUMBER_OF_LOGIC_TREE_SAMPLES'] = '2'
+        self.result_sets = []
+
+    def _result_set(self, results):
+        """Fake a celery ResultSet, keeping track of it."""
+        self.result_sets.append(FakeResultSet(results))
+        return self.result_sets[-1]
+
+    @staticmethod
+    def _count(job_id, history, realization, seed):
+        """Fake the submission of a count_ruptures task: 5 ruptures."""
+        return mock.Mock(task_id=('count', history, realization),
+                         status='SUCCESS', result=5)
+
+    @staticmethod
+    def _block(job_id, sites, history, realization, seed, rupture_range,
+               site_range):
+        """Fake the submission of a compute_ground_motion_field_block
+        task."""
+        return mock.Mock(
+            task_id=('block', history, realization, rupture_range,
+                     site_range),
+            status='SUCCESS')
+
+    def test_execute_blocks(self):
+        # 5 ruptures and 5 sites, split by 2
+        with mock.patch('%s.count_ruptures' % EB_CORE_MODULE) as count:
+            count.delay.side_effect = self._count
+            with mock.patch('%s.compute_ground_motion_field_block'
+                            % EB_CORE_MODULE) as block_task:
+                block_task.delay.side_effect = self._block
+                with mock.patch('%s.read_stochastic_set'
+                                % EB_CORE_MODULE) as read:
+                    with mock.patch.multiple(
+                            self.calc, store_realization_models=mock.DEFAULT,
+                            delete_realization_models=mock.DEFAULT,
+                            serialize_gmf=mock.DEFAULT) as calc_mocks:
+                        with mock.patch.object(
+                                self.job_ctxt, 'sites_to_compute',
+                                return_value=self.SITES):
+                            with mock.patch(
+                                    'openquake.utils.tasks.ResultSet',
+                                    self._result_set):
+                                with helpers.patch(
+                                        'openquake.utils.config.'
+                                        'hazard_ses_in_flight') as in_flight:
+                                    in_flight.return_value = 3
+                                    self.calc.execute_blocks(
+                                        random.Random(1), random.Random(2),
+                                        random.Random(3), 2, 2)
+
+        # the master does not sample the event sets, the workers do
+        count_calls = count.delay.call_args_list
+        self.assertEqual([(self.job_id, 0, 0), (self.job_id, 0, 1)],
+                         [each[0][:3] for each in count_calls])
+        seeds = [each[0][3] for each in count_calls]
+
+        # the count and block tasks share the budget
+        [result_set] = self.result_sets
+        self.assertEqual(3, result_set.max_size)
+
+        ranges = [(0, 2), (2, 4), (4, 5)]
+        for j, seed in enumerate(seeds):
+            self.assertEqual(
+                sorted((self.job_id, self.SITES, 0, j, seed, rupture_range,
+                        site_range)
+                       for rupture_range in ranges for site_range in ranges),
+                sorted(each[0] for each in block_task.delay.call_args_list
+                       if each[0][3] == j))
+
+        # the parts of the ruptures of each chunk are merged
+        self.assertEqual(
+            [mock.call([[kvs.tokens.stochastic_set_part_key(
+                            self.job_id, 0, j, first_rupture, first_site)
+                         for first_site, _ in ranges]
+                        for first_rupture, _ in ranges])
+             for j in (0, 1)],
+            sorted(read.call_args_list))
+        self.assertEqual(2, calc_mocks['serialize_gmf'].call_count)
+        self.assertEqual(
+            [mock.call(0, 0), mock.call(0, 1)],
+            sorted(calc_mocks['delete_realization_models'].call_args_list))
+
+
+class ExecuteTestCase(EventBasedBaseTestCase):
+    """Tests for :meth:`core.EventBasedHazardCalculator.execute`."""
+
+    def setUp(self):
+        super(ExecuteTestCase, self).setUp()
+        self.job_ctxt.params['NUMBER_OF_SEISMICITY_HISTORIES'] = '1'
+        self.job_ctxt.params['NUMBER_OF_LOGIC_TREE_SAMPLES'] = '5'
+        self.events = []
+
+    def _submit(self, job_id, sites, history, realization, seed):
+        """Fake the submission of a compute_ground_motion_fields task."""
+        self.events.append(('submit', realization))
+        return mock.Mock(task_id=realization, status='SUCCESS')
+
+    def _serialize(self, event_set, sites, ruptures):
+        """Fake the serialization of an event set."""
+        self.events.append(('serialize', int(event_set.split('!')[1])))
+
+    def test_execute_bounds_the_event_sets_in_flight(self):
+        with mock.patch('%s.compute_ground_motion_fields' % EB_CORE_MODULE) \
+                as ses_task:
+            ses_task.delay.side_effect = self._submit
+            with helpers.patch('openquake.utils.config.hazard_gmf_split') \
+                    as gmf_split:
+                gmf_split.return_value = (0, 0)
+                with helpers.patch(
+                        'openquake.utils.config.hazard_ses_in_flight') \
+                        as ses_in_flight:
+                    ses_in_flight.return_value = 2
+                    with mock.patch('%s.read_stochastic_set'
+                                    % EB_CORE_MODULE):
+                        with mock.patch('openquake.utils.tasks.ResultSet',
+                                        FakeResultSet):
+                            with mock.patch.multiple(
+                                    self.calc,
+                                    store_realization_models=mock.DEFAULT,
+                                    delete_realization_models=mock.DEFAULT,
+                                    serialize_gmf=self._serialize):
+                                self.calc.execute()
+
+        # never more than 2 event sets in flight, the next one is submitted
+        # before the completed one is serialized and the event sets are
+        # serialized in completion order (the last submitted one first, see
+        # FakeResultSet)
+        self.assertEqual(
+            [('submit', 0), ('submit', 1),
+             ('submit', 2), ('serialize', 1),
+             ('submit', 3), ('serialize', 2),
+             ('submit', 4), ('serialize', 3),
+             ('serialize', 4), ('serialize', 0)],
+            self.events)
+
+
+class RealizationModelsTestCase(EventBasedBaseTestCase):
+    """Tests for the storage of the models of each stochastic event set."""
+
+    def test_store_and_delete_realization_models(self):
+        client = kvs.get_client()
+        keys = [kvs.tokens.source_model_key(self.job_id, 1, 2),
+                kvs.tokens.gmpe_key(self.job_id, 1, 2)]
+        other_keys = [kvs.tokens.source_model_key(self.job_id, 1, 3),
+                      kvs.tokens.gmpe_key(self.job_id, 1, 3)]
+
+        try:
+            self.calc.store_realization_models(1, 2, 23, 5)
+            self.calc.store_realization_models(1, 3, 23, 5)
+            self.assertTrue(all(client.exists(key)
+                                for key in keys + other_keys))
+
+            self.calc.delete_realization_models(1, 2)
+            self.assertFalse(any(client.exists(key) for key in keys))
+            self.assertTrue(all(client.exists(key) for key in other_keys))
+        finally:
+            client.delete(*(keys + other_keys))
+
+
+class SplitGroundMotionFieldsTestCase(EventBasedBaseTestCase):
+    """The ground motion fields of a split stochastic event set do not depend
+    on how its ruptures are chunked."""
+
+    def _compute_blocks(self, seed, num_ruptures, chunk_size, block_size):
+        """Compute the fields in rupture chunks and site blocks and return
+        them as read from the KVS."""
+        part_keys = []
+        for first_rupture in xrange(0, num_ruptures, chunk_size):
+            chunk_keys = []
+            for first_site in xrange(0, len(self.SITES), block_size):
+                self.calc.compute_ground_motion_field_block(
+                    self.SITES, 0, 0, seed,
+                    (first_rupture,
+                     min(first_rupture + chunk_size, num_ruptures)),
+                    (first_site,
+                     min(first_site + block_size, len(self.SITES))))
+                chunk_keys.append(kvs.tokens.stochastic_set_part_key(
+                    self.job_id, 0, 0, first_rupture, first_site))
+            part_keys.append(chunk_keys)
+        return list(core.read_stochastic_set(part_keys))
+
+    def test_split_ground_motion_fields_do_not_depend_on_chunks(self):
+        seed = 3
+        self.calc.store_realization_models(0, 0, 23, 5)
+
+        try:
+            self.calc.compute_ground_motion_fields(self.SITES, 0, 0, seed)
+            unsplit = list(core.read_stochastic_set([[
+                kvs.tokens.stochastic_set_key(self.job_id, 0, 0)]]))
+
+            num_ruptures = self.calc.count_ruptures(0, 0, seed)
+            self.assertTrue(num_ruptures > 0)
+            self.assertEqual(num_ruptures, len(unsplit))
+
+            chunked = self._compute_blocks(seed, num_ruptures, 2, 2)
+            whole = self._compute_blocks(seed, num_ruptures, num_ruptures, 2)
+        finally:
+            self.calc.delete_realization_models(0, 0)
+
+        self.assertEqual([rupture for rupture, _ in unsplit],
+                         [rupture for rupture, _ in chunked])
+        self.assertEqual([rupture for rupture, _ in unsplit],
+                         [rupture for rupture, _ in whole])
+        for (_, chunked_gmvs), (_, whole_gmvs) in zip(chunked, whole):
+            self.assertEqual(len(self.SITES), len(chunked_gmvs))
+            self.assertTrue((chunked_gmvs == whole_gmvs).all())
+
+
+class ReadStochasticSetTestCase(unittest.TestCase):
+    """Tests for :func:`core.read_stochastic_set`."""
+
+    def setUp(self):
+        self.client = kvs.get_client()
+        self.keys = ['READ_SES_TEST_%s' % i for i in xrange(3)]
+        self.client.delete(*self.keys)
+
+    def tearDown(self):
+        self.client.delete(*self.keys)
+
+    def _store(self, key, first_site, gmvs_by_rupture):
+        """Store one record per rupture at `key`, as the workers do."""
+        for rupture, gmvs in gmvs_by_rupture:
+            self.client.rpush(key, core.GMF_RECORD_HEADER.pack(
+                rupture, first_site, len(gmvs)) +
+                struct.pack(">%sd" % len(gmvs), *gmvs))
+
+    def test_read_stochastic_set(self):
+        # two chunks of ruptures, the first one split in two site blocks
+        self._store(self.keys[0], 0, [(0, [0.1, 0.2]), (1, [0.3, 0.4])])
+        self._store(self.keys[1], 2, [(0, [0.5]), (1, [0.6])])
+        self._store(self.keys[2], 0, [(2, [0.7, 0.8, 0.9])])
+
+        ruptures = core.read_stochastic_set(
+            [self.keys[:2], self.keys[2:]])
+
+        first_rupture, first_gmvs = ruptures.next()
+        self.assertEqual((0, [0.1, 0.2, 0.5]),
+                         (first_rupture, first_gmvs.tolist()))
+        # the records are streamed: no key was consumed yet
+        self.assertEqual(3, len(self.client.keys('READ_SES_TEST_*')))
+        self.assertEqual(
+            [(1, [0.3, 0.4, 0.6]), (2, [0.7, 0.8, 0.9])],
+            [(rupture, gmvs.tolist()) for rupture, gmvs in ruptures])
+        # the keys are deleted once read
+        self.assertEqual([], self.client.keys('READ_SES_TEST_*'))
+
+    def test_read_stochastic_set_in_several_fetches(self):
+        gmvs_by_rupture = [(i, [i * 0.01])
+                           for i in xrange(2 * core.GMF_RECORD_FETCH_SIZE + 1)]
+        self._store(self.keys[0], 0, gmvs_by_rupture)
+
+        self.assertEqual(
+            gmvs_by_rupture,
+            [(rupture, gmvs.tolist()) for rupture, gmvs
+             in core.read_stochastic_set([self.keys[:1]])])
+
+    def test_read_stochastic_set_with_misaligned_records(self):
+        self._store(self.keys[0], 0, [(0, [0.1])])
+        self._store(self.keys[1], 1, [(1, [0.2])])
+
+        self.assertRaises(AssertionError, list,
+                          core.read_stochastic_set([self.keys[:2]]))
+
+
+class SerializeGmfTestCase(EventBasedBaseTestCase):
+    """Tests for
+    :meth:`core.EventBasedHazardCalculator.serialize_gmf`."""
+
+    def setUp(self):
+        super(SerializeGmfTestCase, self).setUp()
+        self.job_ctxt.params['OUTPUT_DIR'] = 'out%put'
+        self.ruptures = iter([(0, numpy.array([0.1] * len(self.SITES)))])
+
+    def test_serialize_gmf(self):
+        with mock.patch('openquake.output.hazard.GmfBulkWriter') as writer:
+            files = self.calc.serialize_gmf('1!2', self.SITES, self.ruptures)
+
+        # the "%" of the output directory is escaped in the template
+        writer.assert_called_once_with(
+            self.job_id, self.job_ctxt.serialize_results_to,
+            os.path.join(self.job_ctxt.base_path, 'out%%put',
+                         'gmf-1_2-%s.xml'))
+        writer.return_value.serialize.assert_called_once_with(
+            self.SITES, self.ruptures)
+        self.assertEqual(writer.return_value.serialize.return_value, files)
+
+    def test_serialize_gmf_without_nrml(self):
+        self.job_ctxt.params['SAVE_GMFS'] = 'false'
+
+        with mock.patch('openquake.output.hazard.GmfBulkWriter') as writer:
+            self.calc.serialize_gmf('1!2', self.SITES, self.ruptures)
+
+        writer.assert_called_once_with(
+            self.job_id, self.job_ctxt.serialize_results_to, None)
@@ -15,6 +15,8 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import mock
+import numpy
 import unittest
 
 from openquake import engine
@@ -70,6 +72,34 @@ class StoreSiteModelTestCase(unittest.TestCase):
         for i, val in enumerate(ret_val):
             self.assertEqual(val, actual_site_model[i])
 
+    def test_store_site_model_bulk(self):
+        inp = models.Input(
+            owner=models.OqUser.objects.get(id=1), path='fake_path',
+            digest='fake_digest', input_type='site_model', size=0)
+        inp.save()
+        site_model = helpers.get_data_path('site_model.xml')
+
+        # A small chunk size, to exercise the intermediate flushes.
+        ret_val = general.store_site_model_bulk(inp, site_model, chunk_size=2)
+
+        actual_site_model = models.SiteModel.objects.filter(
+            input=inp.id).order_by('id')
+
+        self.assertEqual(5, len(actual_site_model))
+        self.assertEqual((5, 2), ret_val.shape)
+
+        for i, act in enumerate(actual_site_model):
+            self.assertAlmostEqual(-122.5 - i * 0.1, act.location.x)
+            self.assertAlmostEqual(37.5 + i * 0.1, act.location.y)
+            self.assertAlmostEqual(800.0 + i, act.vs30)
+            self.assertEqual("measured", act.vs30_type)
+            self.assertAlmostEqual(100.0 + i, act.z1pt0)
+            self.assertAlmostEqual(5.0 + i * 0.1, act.z2pt5)
+
+            # the returned coordinates follow the document order
+            self.assertAlmostEqual(act.location.x, ret_val[i][0])
+            self.assertAlmostEqual(act.location.y, ret_val[i][1])
+
     def test_initialize_stores_site_model(self):
         job_ctxt = helpers.prepare_job_context(
             helpers.demo_file(
@@ -204,14 +234,223 @@ class ValidateSiteModelTestCase(unittest.TestCase):
         )
 
         calc = general.BaseHazardCalculator(job_ctxt)
-        patch_path = 'openquake.calculators.hazard.general.validate_site_model'
+        patch_path = ('openquake.calculators.hazard.general.'
+                      'validate_site_model_coords')
 
         with helpers.patch(patch_path) as validate_patch:
             calc.initialize()
-            # validate_site_model itself is tested in another test
+            # validate_site_model_coords itself is tested in another test
             # here, we just make sure it gets called
             self.assertEqual(1, validate_patch.call_count)
 
+    def test_validate_site_model_coords(self):
+        # The vectorized check must agree with `validate_site_model` on the
+        # very same boundary cases.
+        sm_coords = numpy.array(
+            [(n.location.x, n.location.y) for n in self.site_model_nodes])
+
+        general.validate_site_model_coords(sm_coords, [
+            shapes.Site(9.9999999, 0), shapes.Site(-9.9999999, 0),
+            shapes.Site(0, 10.1507381), shapes.Site(0, -10.1507381),
+            shapes.Site(-10, 10), shapes.Site(10, 10),
+            shapes.Site(-10, -10), shapes.Site(10, -10),
+            shapes.Site(0.0, 0.0), shapes.Site(2.5, -2.5),
+        ])
+
+        outside = [
+            shapes.Site(10.0000001, 0), shapes.Site(-10.0000001, 0),
+            shapes.Site(0, 10.1507382), shapes.Site(0, -10.1507382),
+            shapes.Site(-10.0000001, 10), shapes.Site(10, -10.0000001),
+        ]
+        for site in outside:
+            self.assertRaises(
+                ValidationException, general.validate_site_model_coords,
+                sm_coords, [site])
+
+
+class SiteCacheTestCase(unittest.TestCase):
+    """Tests for :class:`openquake.calculators.hazard.general.SiteCache`."""
+
+    SITES_A = [shapes.Site(1.0, 1.0), shapes.Site(2.0, 2.0)]
+    SITES_B = [shapes.Site(3.0, 3.0), shapes.Site(4.0, 4.0)]
+
+    def setUp(self):
+        self.cache = general.SiteCache(max_sites=4, max_heap_ratio=0.75)
+        self.heap_patch = helpers.patch(
+            'openquake.calculators.hazard.general.SiteCache._heap_is_full')
+        self.heap_mock = self.heap_patch.start()
+        self.heap_mock.return_value = False
+
+    def tearDown(self):
+        self.heap_patch.stop()
+
+    def test_digest(self):
+        self.assertEqual(self.cache.digest(list(self.SITES_A)),
+                         self.cache.digest(self.SITES_A))
+        self.assertNotEqual(self.cache.digest(self.SITES_A),
+                            self.cache.digest(self.SITES_B))
+
+    def test_get_put(self):
+        digest = self.cache.digest(self.SITES_A)
+        self.assertIsNone(self.cache.get(1, digest))
+
+        self.cache.put(1, digest, 'jsites_a', 2)
+        self.assertEqual('jsites_a', self.cache.get(1, digest))
+        # a different job never sees the entry
+        self.assertIsNone(self.cache.get(2, digest))
+
+    def test_lru_eviction(self):
+        digest_a = self.cache.digest(self.SITES_A)
+        digest_b = self.cache.digest(self.SITES_B)
+        digest_c = self.cache.digest(self.SITES_A + self.SITES_B)
+
+        self.cache.put(1, digest_a, 'jsites_a', 2)
+        self.cache.put(1, digest_b, 'jsites_b', 2)
+        # touch `a`, so that `b` is the least recently used entry
+        self.cache.get(1, digest_a)
+        self.cache.put(1, digest_c, 'jsites_c', 2)
+
+        self.assertEqual('jsites_a', self.cache.get(1, digest_a))
+        self.assertIsNone(self.cache.get(1, digest_b))
+        self.assertEqual('jsites_c', self.cache.get(1, digest_c))
+        self.assertEqual(4, self.cache.num_sites)
+
+    def test_new_job_clears_cache(self):
+        digest = self.cache.digest(self.SITES_A)
+
+        self.cache.put(1, digest, 'jsites_1', 2)
+        self.cache.put(2, digest, 'jsites_2', 2)
+
+        self.assertIsNone(self.cache.get(1, digest))
+        self.assertEqual('jsites_2', self.cache.get(2, digest))
+        self.assertEqual(2, self.cache.num_sites)
+
+    def test_fetch(self):
+        builds = []
+
+        def build():
+            builds.append(1)
+            return 'jsites_a'
+
+        digest = self.cache.digest(self.SITES_A)
+        self.assertEqual('jsites_a', self.cache.fetch(1, digest, 2, build))
+        self.assertEqual('jsites_a', self.cache.fetch(1, digest, 2, build))
+        self.assertEqual(1, len(builds))
+
+        # nothing is cached if the cache is disabled
+        self.cache.max_sites = 0
+        self.cache.fetch(2, digest, 2, build)
+        self.cache.fetch(2, digest, 2, build)
+        self.assertEqual(3, len(builds))
+
+    def test_too_many_sites_are_not_cached(self):
+        sites = self.SITES_A + self.SITES_B + [shapes.Site(5.0, 5.0)]
+        digest = self.cache.digest(sites)
+
+        self.cache.put(1, digest, 'jsites', len(sites))
+        self.assertIsNone(self.cache.get(1, digest))
+
+    def test_heap_eviction(self):
+        digest_a = self.cache.digest(self.SITES_A)
+        digest_b = self.cache.digest(self.SITES_B)
+
+        self.cache.put(1, digest_a, 'jsites_a', 2)
+        self.heap_mock.return_value = True
+        self.cache.put(1, digest_b, 'jsites_b', 2)
+
+        self.assertEqual(0, len(self.cache.entries))
+        self.assertEqual(0, self.cache.num_sites)
+
+    def test_max_entries(self):
+        # The Python side entries are bounded by their number, the JVM heap
+        # is not looked at.
+        cache = general.SiteCache(max_sites=100, max_entries=2)
+
+        for i in xrange(3):
+            cache.put(1, 'digest%s' % i, 'params%s' % i, 1)
+
+        self.assertIsNone(cache.get(1, 'digest0'))
+        self.assertEqual('params1', cache.get(1, 'digest1'))
+        self.assertEqual('params2', cache.get(1, 'digest2'))
+        self.assertEqual(2, cache.num_sites)
+        self.assertEqual(0, self.heap_mock.call_count)
+
+
+class SiteParametersTestCase(unittest.TestCase):
+    """Tests for :function:`general.site_parameters`."""
+
+    SITES = [shapes.Site(1.0, 1.0), shapes.Site(2.0, 2.0)]
+
+    def setUp(self):
+        self.job_ctxt = helpers.prepare_job_context(
+            helpers.demo_file(
+                'simple_fault_demo_hazard/config_with_site_model.gem'))
+        general.site_parameters_cache().clear()
+
+    def test_site_cache_is_created_lazily(self):
+        with mock.patch(
+                'openquake.calculators.hazard.general._SITE_CACHE', None):
+            with helpers.patch('openquake.utils.config.'
+                               'hazard_site_cache_size') as size_mock:
+                size_mock.return_value = 16
+
+                cache = general.site_cache()
+
+                self.assertEqual(16, cache.max_sites)
+                self.assertEqual(general.SITE_CACHE_MAX_HEAP_RATIO,
+                                 cache.max_heap_ratio)
+                self.assertIs(cache, general.site_cache())
+                self.assertEqual(1, size_mock.call_count)
+
+    def test_site_parameters_cache_is_created_lazily(self):
+        with mock.patch('openquake.calculators.hazard.general.'
+                        '_SITE_PARAMETERS_CACHE', None):
+            with helpers.patch('openquake.utils.config.'
+                               'hazard_site_cache_size') as size_mock:
+                size_mock.return_value = 16
+
+                cache = general.site_parameters_cache()
+
+                self.assertEqual(16, cache.max_sites)
+                self.assertEqual(general.SITE_PARAMETERS_CACHE_ENTRIES,
+                                 cache.max_entries)
+                self.assertIsNone(cache.max_heap_ratio)
+                self.assertIs(cache, general.site_parameters_cache())
+
+    def test_site_parameters_are_cached(self):
+        # The site model lookups are not repeated for the next realizations
+        # (or task types) computing the same sites.
+        expected = [('Measured', 800, 100, 200)] * 2
+
+        with helpers.patch(
+                'openquake.calculators.hazard.general.get_site_model'):
+            with helpers.patch('openquake.calculators.hazard.general.'
+                               'get_closest_site_model_data') as closest:
+                closest.return_value = models.SiteModel(
+                    vs30=800, vs30_type='measured', z1pt0=100, z2pt5=200)
+
+                self.assertEqual(
+                    expected,
+                    general.site_parameters(self.job_ctxt, self.SITES))
+                self.assertEqual(
+                    expected,
+                    general.site_parameters(self.job_ctxt, self.SITES))
+                self.assertEqual(2, closest.call_count)
+
+    def test_site_parameters_without_site_model(self):
+        jp = self.job_ctxt.oq_job_profile
+
+        with helpers.patch(
+                'openquake.calculators.hazard.general.get_site_model'
+                ) as get_sm:
+            get_sm.return_value = None
+
+            self.assertEqual(
+                [(jp.vs30_type.capitalize(), jp.reference_vs30_value,
+                  jp.depth_to_1pt_0km_per_sec,
+                  jp.reference_depth_to_2pt5km_per_sec_param)] * 2,
+                general.site_parameters(self.job_ctxt, self.SITES))
+
 
 class GetSiteModelTestCase(unittest.TestCase):
 
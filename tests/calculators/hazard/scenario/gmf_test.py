@@ -0,0 +1,131 @@
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+
+from openquake.calculators.hazard.scenario import gmf
+
+
+NAN = float("nan")
+
+
+class TruncatedNormalTestCase(unittest.TestCase):
+
+    def test_no_truncation(self):
+        rng = gmf.random_state(42)
+        expected = gmf.random_state(42).standard_normal((3, 4))
+
+        self.assertTrue(numpy.array_equal(
+            expected, gmf.truncated_normal(rng, (3, 4), "None", 0.1)))
+
+    def test_one_sided_truncation(self):
+        devs = gmf.truncated_normal(gmf.random_state(42), 10000, "1 Sided",
+                                    -0.5)
+
+        self.assertTrue((devs <= -0.5).all())
+
+    def test_two_sided_truncation(self):
+        devs = gmf.truncated_normal(gmf.random_state(42), 10000, "2 sided",
+                                    1.0)
+
+        self.assertTrue((abs(devs) <= 1.0).all())
+        self.assertTrue((devs < -0.9).any() and (devs > 0.9).any())
+
+
+class GmfGeneratorTestCase(unittest.TestCase):
+
+    STATISTICS = [[-1.0, -2.0, -3.0],
+                  [0.5, 0.5, 0.5],
+                  [0.3, 0.3, 0.3],
+                  [0.4, 0.4, 0.4]]
+
+    def test_total_std_only(self):
+        statistics = self.STATISTICS[:2] + [[NAN] * 3] * 2
+        generator = gmf.GmfGenerator(statistics, "None", 3.0)
+
+        fields = generator.generate(gmf.random_state(42), 20000)
+
+        self.assertEqual((3, 20000), fields.shape)
+        self.assertTrue(numpy.allclose([-1, -2, -3], fields.mean(axis=1),
+                                       atol=0.02))
+        self.assertTrue(numpy.allclose(numpy.diag([0.25] * 3),
+                                       numpy.cov(fields), atol=0.01))
+
+    def test_uncorrelated(self):
+        generator = gmf.GmfGenerator(self.STATISTICS, "None", 3.0)
+
+        fields = generator.generate(gmf.random_state(42), 20000)
+
+        # the inter-event residual is shared by all the sites
+        expected = 0.09 * numpy.ones((3, 3)) + numpy.diag([0.16] * 3)
+        self.assertTrue(numpy.allclose(expected, numpy.cov(fields),
+                                       atol=0.01))
+
+    def test_correlated(self):
+        lons = [0.0, 0.05, 1.0]
+        lats = [0.0, 0.0, 0.0]
+        generator = gmf.GmfGenerator(self.STATISTICS, "None", 3.0,
+                                     (lons, lats, 0.0, False))
+
+        fields = generator.generate(gmf.random_state(42), 20000)
+
+        correlation = numpy.exp(
+            -3 * gmf.horizontal_distances(lons, lats) / 8.5)
+        # beyond twice the correlation range
+        correlation[2, :2] = correlation[:2, 2] = 0
+        expected = 0.09 + 0.16 * correlation
+        self.assertTrue(numpy.allclose(expected, numpy.cov(fields),
+                                       atol=0.01))
+
+    def test_correlated_without_inter_event_residual(self):
+        lons = [0.0, 0.05, 0.1]
+        lats = [0.0, 0.0, 0.0]
+        generator = gmf.GmfGenerator(self.STATISTICS, "None", 3.0,
+                                     (lons, lats, 0.0, True),
+                                     inter_event=False)
+
+        fields = generator.generate(gmf.random_state(42), 20000)
+
+        # the correlation range of clustered Vs30 values is 40.7 km
+        expected = 0.16 * numpy.exp(
+            -3 * gmf.horizontal_distances(lons, lats) / 40.7)
+        self.assertTrue(numpy.allclose(expected, numpy.cov(fields),
+                                       atol=0.01))
+
+    def test_inter_event_std_of_the_last_site(self):
+        statistics = numpy.array(self.STATISTICS)
+        statistics[gmf.INTER_STD] = [0.1, 0.2, 0.3]
+        generator = gmf.GmfGenerator(statistics, "None", 3.0)
+
+        fields = generator.generate(gmf.random_state(42), 20000)
+
+        expected = 0.09 * numpy.ones((3, 3)) + numpy.diag([0.16] * 3)
+        self.assertTrue(numpy.allclose(expected, numpy.cov(fields),
+                                       atol=0.01))
+
+    def test_correlated_needs_inter_and_intra_std(self):
+        statistics = self.STATISTICS[:2] + [[NAN] * 3] * 2
+
+        self.assertRaises(ValueError, gmf.GmfGenerator, statistics, "None",
+                          3.0, ([0, 1, 2], [0, 0, 0], 0.0, False))
+
+    def test_same_seed_same_fields(self):
+        generator = gmf.GmfGenerator(self.STATISTICS, "2 Sided", 1.0)
+
+        self.assertTrue(numpy.array_equal(
+            generator.generate(gmf.random_state(7), 5),
+            generator.generate(gmf.random_state(7), 5)))
@@ -14,11 +14,14 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from openquake import kvs
 from openquake.calculators.hazard.uhs.ath import completed_task_count
-from openquake.calculators.hazard.uhs.ath import remaining_tasks_in_block
+from openquake.calculators.hazard.uhs.ath import signal_completion
+from openquake.calculators.hazard.uhs.ath import wait_for_completed_tasks
 from openquake.utils import stats
 
 from tests.calculators.hazard.uhs.core_test import UHSBaseTestCase
+from tests.utils import helpers
 
 
 class UHSTaskHandlerTestCase(UHSBaseTestCase):
@@ -46,46 +49,49 @@ class UHSTaskHandlerTestCase(UHSBaseTestCase):
         stats.pk_inc(self.job_id, "nhzrd_failed")
         self.assertEqual(2, completed_task_count(self.job_id))
 
-    def test_remaining_tasks_in_block(self):
-        # Tasks should be submitted to works for one block (of sites) at a
-        # time. For each block, we want to look at Redis counters to determine
-        # when the block is finished calculating.
-        # `remaining_tasks_in_block` is a generator that yields the remaining
-        # number of tasks in a block. When there are no more tasks left in the
-        # block, a `StopIteration` is raised.
-        gen = remaining_tasks_in_block(self.job_id, 4, 0)
-
-        incr_count = lambda: stats.pk_inc(self.job_id, "nhzrd_done")
-
-        self.assertEqual(4, gen.next())
-        incr_count()
-        self.assertEqual(3, gen.next())
-        incr_count()
-        incr_count()
-        self.assertEqual(1, gen.next())
-        incr_count()
-        self.assertRaises(StopIteration, gen.next)
-
-    def test_remaining_tasks_in_block_nonzero_start_count(self):
-        # Same as the above test, except test with the start_count
-        # set to something > 0 (to simulate a mid-calculation block).
-
-        incr_count = lambda: stats.pk_inc(self.job_id, "nhzrd_done")
-
-        # Just for variety, set 5 successful and 5 failed task counters:
+    def test_signal_completion(self):
+        # Each task execution pushes an item to the completion list of the
+        # job, even if it fails.
+        completion_key = kvs.tokens.uhs_completion_key(self.job_id)
+        client = kvs.get_client()
+
+        @signal_completion
+        def a_task(job_id, fail=False):
+            if fail:
+                raise RuntimeError()
+            return job_id
+
+        self.assertEqual(self.job_id, a_task(self.job_id))
+        self.assertEqual(1, client.llen(completion_key))
+
+        self.assertRaises(RuntimeError, a_task, self.job_id, fail=True)
+        self.assertEqual(2, client.llen(completion_key))
+
+    def test_wait_for_completed_tasks(self):
+        # `wait_for_completed_tasks` blocks on the completion list until
+        # the task counters reach the target.
+        completed = lambda *_args: stats.pk_inc(self.job_id, "nhzrd_done")
+
+        with helpers.patch('openquake.kvs.get_client') as get_client:
+            get_client.return_value.blpop.side_effect = completed
+
+            wait_for_completed_tasks(self.job_id, 3)
+
+            self.assertEqual(3, get_client.return_value.blpop.call_count)
+            self.assertEqual(3, completed_task_count(self.job_id))
+            # the completion list is drained at each wake-up
+            self.assertEqual(
+                [((kvs.tokens.uhs_completion_key(self.job_id),), {})] * 3,
+                get_client.return_value.delete.call_args_list)
+
+    def test_wait_for_completed_tasks_nonzero_start_count(self):
+        # No waiting at all if the tasks are already completed.
         for _ in xrange(5):
             stats.pk_inc(self.job_id, "nhzrd_done")
         for _ in xrange(5):
             stats.pk_inc(self.job_id, "nhzrd_failed")
 
-        # count starts at 10
-        gen = remaining_tasks_in_block(self.job_id, 4, 10)
-
-        self.assertEqual(4, gen.next())
-        incr_count()
-        self.assertEqual(3, gen.next())
-        incr_count()
-        incr_count()
-        self.assertEqual(1, gen.next())
-        incr_count()
-        self.assertRaises(StopIteration, gen.next)
+        with helpers.patch('openquake.kvs.get_client') as get_client:
+            wait_for_completed_tasks(self.job_id, 10)
+
+            self.assertEqual(0, get_client.return_value.blpop.call_count)
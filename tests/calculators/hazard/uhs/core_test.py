@@ -14,16 +14,19 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import mock
 import numpy
 import unittest
 
 from openquake import engine
 from openquake import java
+from openquake import kvs
 from openquake.calculators.hazard.uhs.core import UHSCalculator
-from openquake.calculators.hazard.uhs.core import compute_uhs
+from openquake.calculators.hazard.uhs.core import compute_uhs_block
 from openquake.calculators.hazard.uhs.core import compute_uhs_task
+from openquake.calculators.hazard.uhs.core import uh_spectrum_ids
 from openquake.calculators.hazard.uhs.core import write_uh_spectra
-from openquake.calculators.hazard.uhs.core import write_uhs_spectrum_data
+from openquake.calculators.hazard.uhs.core import write_uhs_block_data
 from openquake.db.models import Output
 from openquake.db.models import SiteModel
 from openquake.db.models import UhSpectra
@@ -70,28 +73,23 @@ class UHSCoreTestCase(UHSBaseTestCase):
                 0.6185688023781438,
                 0.11843417899553109])]
 
-    def test_compute_uhs(self):
-        # Test the :function:`openquake.hazard.uhs.core.compute_uhs`
-        # function. This function makes use of the Java `UHSCalculator` and
-        # performs the main UHS computation.
-
-        # The results of the computation are a sequence of Java `UHSResult`
-        # objects.
+    def test_compute_uhs_block(self):
+        # The spectra of a block of sites are computed with the same Java
+        # calculator.
         the_job = helpers.job_from_file(UHS_DEMO_CONFIG_FILE)
 
-        site = Site(0.0, 0.0)
-
         helpers.store_hazard_logic_trees(the_job)
 
-        uhs_results = compute_uhs(the_job, site)
+        block_results = compute_uhs_block(
+            the_job, [Site(0.0, 0.0), Site(0.0, 0.0)])
 
-        for i, result in enumerate(uhs_results):
-            poe = result.getPoe()
-            uhs = result.getUhs()
-
-            self.assertEquals(self.UHS_RESULTS[i][0], poe)
-            self.assertTrue(numpy.allclose(self.UHS_RESULTS[i][1],
-                                           [x.value for x in uhs]))
+        self.assertEqual(2, len(block_results))
+        for uhs_results in block_results:
+            for i, result in enumerate(uhs_results):
+                self.assertEquals(self.UHS_RESULTS[i][0], result.getPoe())
+                self.assertTrue(numpy.allclose(
+                    self.UHS_RESULTS[i][1],
+                    [x.value for x in result.getUhs()]))
 
     def test_compute_uhs_with_site_model(self):
         the_job = helpers.prepare_job_context(
@@ -107,7 +105,7 @@ class UHSCoreTestCase(UHSBaseTestCase):
         get_closest_patch = helpers.patch(
             'openquake.calculators.hazard.general.get_closest_site_model_data')
         compute_patch = helpers.patch(
-            'openquake.calculators.hazard.uhs.core._compute_uhs')
+            'openquake.calculators.hazard.uhs.core._compute_uhs_block')
 
         get_sm_mock = get_sm_patch.start()
         get_closest_mock = get_closest_patch.start()
@@ -116,7 +114,7 @@ class UHSCoreTestCase(UHSBaseTestCase):
         get_closest_mock.return_value = SiteModel(
             vs30=800, vs30_type='measured', z1pt0=100, z2pt5=200)
         try:
-            compute_uhs(the_job, site)
+            compute_uhs_block(the_job, [site])
 
             self.assertEqual(1, get_sm_mock.call_count)
             self.assertEqual(1, get_closest_mock.call_count)
@@ -153,40 +151,42 @@ class UHSCoreTestCase(UHSBaseTestCase):
         self.assertEqual(
             set(self.job_profile.poes), set([x.poe for x in uh_spectrums]))
 
-    def test_write_uhs_spectrum_data(self):
-        # Test `write_uhs_spectrum_data`.
-
-        # To start with, we need to write the 'container' records for the UHS
-        # results:
+    def test_write_uhs_block_data(self):
+        # The results of a block of sites are written at once.
         write_uh_spectra(self.job_ctxt)
 
-        uhs_results = []  # The results we want to write to HDF5
         uhs_result = java.jvm().JClass('org.gem.calc.UHSResult')
+        sites = [Site(0.0, 0.0), Site(0.1, 0.1)]
+        site_results = [
+            (site, [uhs_result(poe, list_to_jdouble_array(uhs))
+                    for poe, uhs in self.UHS_RESULTS])
+            for site in sites]
 
-        # Build up a result list that we can pass to the function under test:
-        for poe, uhs in self.UHS_RESULTS:
-            uhs_results.append(uhs_result(poe, list_to_jdouble_array(uhs)))
+        write_uhs_block_data(self.job_ctxt, 1, site_results)
 
-        realization = 0
-        test_site = Site(0.0, 0.0)
+        uhs_data = UhSpectrumData.objects.filter(
+            uh_spectrum__uh_spectra__output__oq_job=self.job.id)
 
-        # Call the function under test
-        write_uhs_spectrum_data(
-            self.job_ctxt, realization, test_site, uhs_results)
+        self.assertEqual(len(sites) * len(self.UHS_RESULTS), len(uhs_data))
+        self.assertTrue(all([x.realization == 1 for x in uhs_data]))
+        self.assertEqual(
+            set(site.point.to_wkt() for site in sites),
+            set(x.location.wkt for x in uhs_data))
 
-        uhs_data = UhSpectrumData.objects.filter(
-            uh_spectrum__uh_spectra__output__oq_job=(
-            self.job.id))
+    def test_uh_spectrum_ids(self):
+        # The ids of the uh_spectrum records are read once per job.
+        write_uh_spectra(self.job_ctxt)
 
-        self.assertEqual(len(self.UHS_RESULTS), len(uhs_data))
-        self.assertTrue(all([x.realization == 0 for x in uhs_data]))
+        uh_spectrums = UhSpectrum.objects.filter(
+            uh_spectra__output__oq_job=self.job.id)
+        expected = dict((x.poe, x.id) for x in uh_spectrums)
 
-        uhs_results_dict = dict(self.UHS_RESULTS)  # keyed by PoE
-        for uhs_datum in uhs_data:
-            self.assertTrue(
-                numpy.allclose(uhs_results_dict[uhs_datum.uh_spectrum.poe],
-                               uhs_datum.sa_values))
-            self.assertEqual(test_site.point.to_wkt(), uhs_datum.location.wkt)
+        self.assertEqual(expected, uh_spectrum_ids(self.job.id))
+
+        with helpers.patch('%s.UhSpectrum' % self.UHS_CORE_MODULE,
+                           mocksignature=False) as uh_spectrum_mock:
+            self.assertEqual(expected, uh_spectrum_ids(self.job.id))
+            self.assertEqual(0, uh_spectrum_mock.objects.filter.call_count)
 
     def test_compute_uhs_task_calls_compute_and_write(self):
         # The celery task `compute_uhs_task` basically just calls a few other
@@ -194,14 +194,14 @@ class UHSCoreTestCase(UHSBaseTestCase):
         # have their own test coverage; in this test, we just want to make
         # sure they get called.
 
-        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs')
+        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs_block')
         write_uhs_data = '%s.%s' % (self.UHS_CORE_MODULE,
-                                    'write_uhs_spectrum_data')
+                                    'write_uhs_block_data')
         with helpers.patch(cmpt_uhs) as compute_mock:
             with helpers.patch(write_uhs_data) as write_mock:
                 # Call the function under test as a normal function, not a
                 # @task:
-                compute_uhs_task(self.job_id, 0, site=Site(0.0, 0.0))
+                compute_uhs_task(self.job_id, 0, sites=[Site(0.0, 0.0)])
 
                 self.assertEqual(1, compute_mock.call_count)
                 self.assertEqual(1, write_mock.call_count)
@@ -216,9 +216,9 @@ class UHSTaskProgressIndicatorTestCase(UHSBaseTestCase):
 
         # Mock out the two 'heavy' functions called by this task;
         # we don't need to do these and we don't want to waste the cycles.
-        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs')
+        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs_block')
         write_uhs_data = '%s.%s' % (self.UHS_CORE_MODULE,
-                                    'write_uhs_spectrum_data')
+                                    'write_uhs_block_data')
         with helpers.patch(cmpt_uhs):
             with helpers.patch(write_uhs_data):
 
@@ -230,17 +230,17 @@ class UHSTaskProgressIndicatorTestCase(UHSBaseTestCase):
                 realization = 0
                 site = Site(0.0, 0.0)
                 # execute the task as a plain old function
-                compute_uhs_task(self.job_id, realization, site=site)
+                compute_uhs_task(self.job_id, realization, sites=[site])
                 self.assertEqual(1, get_counter())
 
-                compute_uhs_task(self.job_id, realization, site=site)
+                compute_uhs_task(self.job_id, realization, sites=[site])
                 self.assertEqual(2, get_counter())
 
     def test_compute_uhs_task_pi_failure_counter(self):
         # Same as the previous test, except that we want to make sure task
         # failure counters are properly incremented if a task fails.
 
-        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs')
+        cmpt_uhs = '%s.%s' % (self.UHS_CORE_MODULE, 'compute_uhs_block')
         with helpers.patch(cmpt_uhs) as compute_mock:
 
             # We want to force a failure to occur in the task:
@@ -252,14 +252,14 @@ class UHSTaskProgressIndicatorTestCase(UHSBaseTestCase):
             self.assertEqual(0, get_counter())
 
             self.assertRaises(RuntimeError, compute_uhs_task,
-                              self.job_id, 0, site=Site(0.0, 0.0))
+                              self.job_id, 0, sites=[Site(0.0, 0.0)])
             self.assertEqual(1, get_counter())
 
             # Create two more failures:
             self.assertRaises(RuntimeError, compute_uhs_task,
-                              self.job_id, 0, site=Site(0.0, 0.0))
+                              self.job_id, 0, sites=[Site(0.0, 0.0)])
             self.assertRaises(RuntimeError, compute_uhs_task,
-                              self.job_id, 0, site=Site(0.0, 0.0))
+                              self.job_id, 0, sites=[Site(0.0, 0.0)])
             self.assertEqual(3, get_counter())
 
 
@@ -298,8 +298,69 @@ class UHSCalculatorTestCase(UHSBaseTestCase):
 
         expected_call_args = ((self.job_id,), {})
 
+        completion_key = kvs.tokens.uhs_completion_key(self.job_id)
+        kvs.get_client().rpush(completion_key, 1)
+
         with helpers.patch(
             'openquake.utils.stats.delete_job_counters') as del_mock:
             calc.post_execute()
             self.assertEqual(1, del_mock.call_count)
             self.assertEqual(expected_call_args, del_mock.call_args)
+
+        # the task completion list is deleted
+        self.assertFalse(kvs.get_client().exists(completion_key))
+
+    def test_execute_submits_ahead(self):
+        # The tasks are submitted asynchronously, and the next block of sites
+        # is submitted before the previous one is waited for.
+        self.assertTrue(compute_uhs_task.ignore_result)
+
+        sites = [Site(0.0, 0.1 * i) for i in xrange(5)]
+        self.job_profile.realizations = 2
+        calc = UHSCalculator(self.job_ctxt)
+        events = []
+
+        def distribute(task_func, (name, data), tf_args=None, **_kwargs):
+            self.assertEqual((compute_uhs_task, 'sites'), (task_func, name))
+            events.append(('submit', tf_args['realization'],
+                           [len(task_sites) for task_sites in data]))
+
+        def wait(job_id, target):
+            self.assertEqual(self.job_id, job_id)
+            events.append(('wait', target))
+
+        patchers = [
+            mock.patch('openquake.utils.tasks.distribute',
+                       mock.Mock(side_effect=distribute)),
+            mock.patch('%s.wait_for_completed_tasks' % self.UHS_CORE_MODULE,
+                       mock.Mock(side_effect=wait)),
+            mock.patch('%s.completed_task_count' % self.UHS_CORE_MODULE,
+                       mock.Mock(return_value=0)),
+            mock.patch('openquake.utils.config.hazard_block_size',
+                       mock.Mock(return_value=2)),
+            mock.patch('openquake.utils.config.hazard_uhs_sites_per_task',
+                       mock.Mock(return_value=1)),
+            mock.patch('openquake.utils.config.hazard_uhs_prefetch_blocks',
+                       mock.Mock(return_value=1)),
+            mock.patch.object(self.job_ctxt, 'sites_to_compute',
+                              mock.Mock(return_value=sites)),
+            mock.patch.object(calc, 'initialize_pr_data'),
+            mock.patch.object(calc, 'store_realization_models'),
+            mock.patch.object(
+                calc, 'delete_realization_models',
+                mock.Mock(side_effect=lambda rlz: events.append(
+                    ('delete', rlz))))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        calc.execute()
+
+        self.assertEqual(
+            [('submit', 0, [1, 1]), ('submit', 0, [1, 1]), ('wait', 2),
+             ('submit', 0, [1]), ('wait', 4),
+             ('submit', 1, [1, 1]), ('wait', 5), ('delete', 0),
+             ('submit', 1, [1, 1]), ('wait', 7),
+             ('submit', 1, [1]), ('wait', 9),
+             ('wait', 10), ('delete', 1)],
+            events)
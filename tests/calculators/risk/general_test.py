@@ -16,11 +16,13 @@
 import os
 import unittest
 import json
+import numpy
 
 from django.contrib.gis import geos
 
 from openquake.calculators.risk.classical.core import ClassicalRiskCalculator
 from openquake.calculators.risk.general import BaseRiskCalculator
+from openquake.calculators.risk.general import load_gmv_array_at
 from openquake.calculators.risk.general import load_gmvs_at
 from openquake.calculators.risk.general import hazard_input_site
 from openquake.job import config
@@ -313,6 +315,23 @@ class LoadGroundMotionValuesTestCase(unittest.TestCase):
         actual_gmvs = load_gmvs_at(self.job_id, point)
         self.assertEqual(expected_gmvs, actual_gmvs)
 
+    def test_load_gmv_array_at(self):
+        """
+        The ground motion values are read from the per site array, when
+        present.
+        """
+        point = self.region.grid.point_at(shapes.Site(0.1, 0.2))
+        gmvs = numpy.array([0.117, 0.167, 0.542])
+
+        key = kvs.tokens.ground_motion_values_array_key(self.job_id, point)
+        kvs.get_client().append(key, gmvs[:2].astype("<f8").tostring())
+        kvs.get_client().append(key, gmvs[2:].astype("<f8").tostring())
+
+        actual_gmvs = load_gmv_array_at(self.job_id, point)
+        self.assertTrue(isinstance(actual_gmvs, numpy.ndarray))
+        self.assertEqual(gmvs.tolist(), actual_gmvs.tolist())
+        self.assertEqual(gmvs.tolist(), load_gmvs_at(self.job_id, point))
+
 
 class HazardInputSiteTestCase(unittest.TestCase):
 
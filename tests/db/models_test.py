@@ -97,26 +97,26 @@ class ModelEqualsTestCase(unittest.TestCase):
         self.assertFalse(models.model_equals(self.o1, gmf))
 
     def test_model_equals_with_geometry(self):
-        gmf_data_1 = models.GmfData(
-            ground_motion=5.0,
+        gmf_site_1 = models.GmfSite(
+            oq_job_id=1,
             location=GEOSGeometry("POINT (30.0 10.0)"))
 
-        gmf_data_2 = models.GmfData(
-            ground_motion=5.0,
+        gmf_site_2 = models.GmfSite(
+            oq_job_id=1,
             location=GEOSGeometry("POINT (30.0 10.0)"))
 
-        self.assertTrue(models.model_equals(gmf_data_1, gmf_data_2))
+        self.assertTrue(models.model_equals(gmf_site_1, gmf_site_2))
 
     def test_model_equals_with_different_geometry(self):
-        gmf_data_1 = models.GmfData(
-            ground_motion=5.0,
+        gmf_site_1 = models.GmfSite(
+            oq_job_id=1,
             location=GEOSGeometry("POINT (30.0 10.0)"))
 
-        gmf_data_2 = models.GmfData(
-            ground_motion=5.0,
+        gmf_site_2 = models.GmfSite(
+            oq_job_id=1,
             location=GEOSGeometry("POINT (30.0 10.1)"))
 
-        self.assertFalse(models.model_equals(gmf_data_1, gmf_data_2))
+        self.assertFalse(models.model_equals(gmf_site_1, gmf_site_2))
 
 
 class Profile4JobTestCase(helpers.DbTestCase):
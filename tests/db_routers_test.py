@@ -134,7 +134,7 @@ class OQRouterTestCase(unittest.TestCase):
         for read operations.
         '''
         classes = [HazardMap, HazardMapData, HazardCurve, HazardCurveData,
-            GmfData]
+            GmfData, GmfSite]
         expected_db = 'job_init'
 
         self._db_for_read_helper(classes, expected_db)
@@ -145,7 +145,7 @@ class OQRouterTestCase(unittest.TestCase):
         for write operations.
         '''
         classes = [HazardMap, HazardMapData, HazardCurve, HazardCurveData,
-            GmfData]
+            GmfData, GmfSite]
 
         expected_db = 'reslt_writer'
 
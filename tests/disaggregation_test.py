@@ -16,8 +16,10 @@
 
 
 import h5py
+import mock
 import numpy
 import os
+import shutil
 import tempfile
 import unittest
 
@@ -26,6 +28,7 @@ from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
 from openquake.calculators.hazard.disagg import core as disagg_core
 
 from tests.utils import helpers
+from tests.utils.tasks import FakeResultSet
 
 DISAGG_DEMO_CONFIG_FILE = helpers.demo_file('disaggregation/config.gem')
 
@@ -142,6 +145,63 @@ class DisaggregationTaskTestCase(unittest.TestCase):
             compute_patch.stop()
             save_patch.stop()
 
+    def test_compute_disagg_subsets(self):
+        # The matrices of all the PoEs are computed at once; the subsets are
+        # extracted from the matrices in memory, the full matrices are not
+        # saved.
+        the_job = helpers.job_from_file(DISAGG_DEMO_CONFIG_FILE)
+
+        helpers.store_hazard_logic_trees(the_job, realization=1)
+
+        site = shapes.Site(0.0, 0.0)
+        result_dir = tempfile.mkdtemp()
+        matrix_results = []
+        for gmv, value in [(0.2, 1.0), (0.3, 2.0)]:
+            matrix_result = mock.Mock()
+            matrix_result.getGMV.return_value = gmv
+            matrix_result.getMatrix.return_value = numpy.ones(
+                (5, 5, 4, 4, 5)) * value
+            matrix_results.append(matrix_result)
+
+        compute_patch = helpers.patch(
+            'openquake.calculators.hazard.disagg.core._compute_matrices')
+        save_patch = helpers.patch(
+            'openquake.calculators.hazard.disagg.core.save_5d_matrix_to_h5')
+
+        compute_mock = compute_patch.start()
+        compute_mock.return_value = matrix_results
+        save_mock = save_patch.start()
+
+        try:
+            results = disagg_core.compute_disagg_subsets(
+                the_job, site, [0.1, 0.01], 1, result_dir,
+                ['MagPMF', 'LatLonPMF'])
+
+            self.assertEqual(1, compute_mock.call_count)
+            self.assertEqual([0.1, 0.01], compute_mock.call_args[0][5])
+            self.assertEqual(0, save_mock.call_count)
+            self.assertEqual(2, len(results))
+
+            for (gmv, subsets_path), (exp_gmv, value) in zip(
+                    results, [(0.2, 1.0), (0.3, 2.0)]):
+                self.assertEqual(exp_gmv, gmv)
+                self.assertEqual(
+                    disagg_core.subsets_file_path(result_dir, 1, gmv, site),
+                    subsets_path)
+                with h5py.File(subsets_path, 'r') as subsets_file:
+                    self.assertEqual(['LatLonPMF', 'MagPMF'],
+                                     sorted(subsets_file.keys()))
+                    self.assertTrue(
+                        (subsets_file['MagPMF'].value
+                         == value * 5 * 5 * 4 * 5).all())
+                    self.assertTrue(
+                        (subsets_file['LatLonPMF'].value
+                         == value * 4 * 4 * 5).all())
+        finally:
+            compute_patch.stop()
+            save_patch.stop()
+            shutil.rmtree(result_dir)
+
 
 class DisaggHazardCalculatorTestCase(unittest.TestCase):
     """Test for the
@@ -199,3 +259,130 @@ class DisaggHazardCalculatorTestCase(unittest.TestCase):
         self.assertRaises(
             OSError, disagg_core.DisaggHazardCalculator.create_result_dir,
             tmp_dir, job_id)
+
+    def test_execute_shares_the_task_budget(self):
+        """The matrix and subset extraction tasks share the in-flight
+        budget, and the subsets of every site are collected."""
+        job_ctxt = helpers.job_from_file(DISAGG_DEMO_CONFIG_FILE)
+        job_ctxt.params['NUMBER_OF_LOGIC_TREE_SAMPLES'] = '2'
+        job_ctxt.params['POES'] = '0.1, 0.02'
+        job_ctxt.params['COMPUTE_MEAN_DISAGGREGATION'] = 'false'
+        sites = [shapes.Site(0.0, 0.0), shapes.Site(0.1, 0.1)]
+        calc = disagg_core.DisaggHazardCalculator(job_ctxt)
+
+        result_sets = []
+        submitted = []
+        serialized = []
+
+        def result_set(results):
+            result_sets.append(FakeResultSet(results))
+            return result_sets[-1]
+
+        def matrix_task(job_id, rlz, poe, result_dir, site):
+            name = ('matrix', rlz, poe, sites.index(site))
+            submitted.append(name)
+            return mock.Mock(task_id=name,
+                             result=(poe * 10, '%s-%s-%s.h5' % name[1:]))
+
+        def subsets_task(job_id, site, matrix_path, *_args):
+            name = ('subsets', matrix_path)
+            submitted.append(name)
+            return mock.Mock(task_id=name)
+
+        def serialize_nrml(the_job, subset_types, subsets_data):
+            serialized.extend(subsets_data)
+
+        core = 'openquake.calculators.hazard.disagg.core'
+        patchers = [
+            mock.patch('openquake.utils.tasks.ResultSet', result_set),
+            mock.patch.object(disagg_core.compute_disagg_matrix_task,
+                              'delay', mock.Mock(side_effect=matrix_task)),
+            mock.patch.object(disagg_core.subsets.extract_subsets, 'delay',
+                              mock.Mock(side_effect=subsets_task)),
+            mock.patch('%s.DisaggHazardCalculator.serialize_nrml' % core,
+                       mock.Mock(side_effect=serialize_nrml)),
+            mock.patch('%s.DisaggHazardCalculator.create_result_dir' % core,
+                       mock.Mock(return_value=tempfile.gettempdir())),
+            mock.patch('openquake.utils.config.hazard_disagg_tasks_in_flight',
+                       mock.Mock(return_value=2)),
+            mock.patch('openquake.utils.config.flag_set',
+                       mock.Mock(return_value=False)),
+            mock.patch('openquake.input.logictree.LogicTreeProcessor'),
+            mock.patch('openquake.logs.log_percent_complete'),
+            mock.patch.object(job_ctxt, 'sites_to_compute',
+                              mock.Mock(return_value=sites)),
+            mock.patch.object(calc, 'initialize_pr_data'),
+            mock.patch.object(calc, '_store_models',
+                              mock.Mock(side_effect=lambda rlzs: iter(
+                                  xrange(1, rlzs + 1)))),
+            mock.patch.object(calc, '_delete_models')]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch('os.unlink') as unlink:
+            calc.execute()
+
+        # a single budget for all the tasks
+        self.assertEqual([2], [each.max_size for each in result_sets])
+        self.assertEqual(16, len(submitted))
+
+        self.assertEqual(
+            [(1, 0.02), (1, 0.1), (2, 0.02), (2, 0.1)],
+            sorted((rlz, poe) for rlz, poe, _ in serialized))
+        for rlz, poe, data in serialized:
+            self.assertEqual(
+                [(site, poe * 10) for site in sites],
+                [(site, gmv) for site, gmv, _ in data])
+
+        self.assertEqual(
+            sorted('%s-%s-%s.h5' % (rlz, poe, index) for rlz in (1, 2)
+                   for poe in (0.1, 0.02) for index in (0, 1)),
+            sorted(args[0] for args, _ in unlink.call_args_list))
+        self.assertEqual([((1,), {}), ((2,), {})],
+                         sorted(calc._delete_models.call_args_list))
+
+    def test_with_mean_subsets(self):
+        """The mean subsets of a PoE are yielded as soon as all its
+        realizations have come in, whatever the order of the results."""
+        calc = disagg_core.DisaggHazardCalculator(
+            helpers.job_from_file(DISAGG_DEMO_CONFIG_FILE))
+        sites = [shapes.Site(0.0, 0.0), shapes.Site(0.1, 0.1)]
+        result_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, result_dir)
+
+        def subsets_data(rlz, poe):
+            data = []
+            for index, site in enumerate(sites):
+                gmv = poe * rlz + index
+                path = disagg_core.subsets_file_path(
+                    result_dir, rlz, gmv, site)
+                with h5py.File(path, 'w') as subsets_file:
+                    subsets_file.create_dataset(
+                        'MagPMF', data=numpy.arange(3.0) * rlz * poe + index)
+                data.append((site, gmv, path))
+            return rlz, poe, data
+
+        results = [subsets_data(1, 0.1), subsets_data(2, 0.02),
+                   subsets_data(1, 0.02), subsets_data(2, 0.1)]
+
+        with mock.patch('openquake.utils.config.flag_set',
+                        mock.Mock(return_value=False)):
+            output = list(calc.with_mean_subsets(
+                iter(results), sites, 2, ['MagPMF'], result_dir))
+
+        self.assertEqual(
+            [(1, 0.1), (2, 0.02), (1, 0.02), (disagg_core.mean.MEAN, 0.02),
+             (2, 0.1), (disagg_core.mean.MEAN, 0.1)],
+            [(rlz, poe) for rlz, poe, _ in output])
+        self.assertEqual(results, [output[i] for i in (0, 1, 2, 4)])
+
+        for _, poe, data in (output[3], output[5]):
+            self.assertEqual(sites, [site for site, _, _ in data])
+            for index, (_, gmv, path) in enumerate(data):
+                # the mean of the realizations 1 and 2
+                self.assertAlmostEqual(poe * 1.5 + index, gmv)
+                with h5py.File(path, 'r') as subsets_file:
+                    self.assertTrue(numpy.allclose(
+                        numpy.arange(3.0) * 1.5 * poe + index,
+                        subsets_file['MagPMF'][:]))
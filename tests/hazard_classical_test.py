@@ -21,6 +21,7 @@ Unit tests for classic PSHA hazard computations with the hazard engine.
 """
 
 import mock
+import numpy
 import os
 import unittest
 
@@ -133,6 +134,45 @@ class DoCurvesTestCase(unittest.TestCase):
             self.fail("RuntimeError not raised")
 
 
+class ComputeHazardCurveTestCase(unittest.TestCase):
+    """Tests for ClassicalHazardCalculator.compute_hazard_curve()."""
+
+    SITES = [shapes.Site(-121.9, 38.0), shapes.Site(-121.8, 38.0)]
+
+    def setUp(self):
+        params = dict(
+            CALCULATION_MODE='Hazard',
+            SOURCE_MODEL_LOGIC_TREE_FILE_PATH=SIMPLE_FAULT_SRC_MODEL_LT,
+            GMPE_LOGIC_TREE_FILE_PATH=SIMPLE_FAULT_GMPE_LT,
+            BASE_PATH=SIMPLE_FAULT_BASE_PATH, OUTPUT_DIR="output",
+            NUMBER_OF_LOGIC_TREE_SAMPLES=2, WIDTH_OF_MFD_BIN=1)
+
+        self.job_ctxt = create_job(params, job_id=99)
+        self.calculator = classical.ClassicalHazardCalculator(self.job_ctxt)
+        self.keys = [
+            kvs.tokens.hazard_curve_poes_key(self.job_ctxt.job_id, 1, site)
+            for site in self.SITES]
+
+    def tearDown(self):
+        kvs.get_client().delete(*self.keys)
+
+    def test_compute_hazard_curve(self):
+        # The curves computed as a primitive matrix are stored in the KVS,
+        # one JSON list of PoEs per site.
+        poes = numpy.array([[0.9, 0.5, 0.1], [0.8, 0.4, 0.0]])
+
+        with patch('openquake.calculators.hazard.classical.core.'
+                   'ClassicalHazardCalculator.compute_hazard_curves_array'
+                   ) as array_mock:
+            array_mock.return_value = poes
+
+            keys = self.calculator.compute_hazard_curve(self.SITES, 1)
+
+        self.assertEqual(self.keys, keys)
+        self.assertEqual(
+            poes.tolist(), [kvs.get_value_json_decoded(key) for key in keys])
+
+
 class DoMeansTestCase(unittest.TestCase):
     """Tests the behaviour of ClassicalHazardCalculator.do_means()."""
 
@@ -19,6 +19,7 @@
 import os
 import unittest
 
+import h5py
 from lxml import etree
 
 from openquake import shapes
@@ -65,6 +66,68 @@ class GMFXMLWriterTestCase(unittest.TestCase):
         self.assertEqual(check_data, GMF_NORUPTURE_TEST_DATA)
 
 
+class WriteGmfNrmlTestCase(unittest.TestCase):
+    """Unit tests for write_gmf_nrml(), which streams ground motion fields
+    to NRML."""
+
+    def test_write_gmf_nrml(self):
+        path = helpers.get_output_path(GMF_NORUPTURE_TEST_FILE)
+        sites = GMF_NORUPTURE_TEST_DATA.keys()
+        hazard_output.write_gmf_nrml(
+            path, [(site.longitude, site.latitude) for site in sites],
+            [GMF_NORUPTURE_TEST_DATA[site]['groundMotion'] for site in sites])
+
+        check_data = {}
+        reader = hazard_parser.GMFReader(path)
+        for curr_site, curr_attribute in reader:
+            check_data[curr_site] = curr_attribute
+
+        self.assertEqual(check_data, GMF_NORUPTURE_TEST_DATA)
+
+
+class GmfSetWriterTestCase(unittest.TestCase):
+    """Unit tests for the GmfSetWriter class, which serializes multiple
+    ground motion fields to a single NRML file, on a background thread."""
+
+    def test_writes_all_the_fields(self):
+        nrml_path = helpers.get_output_path("gmfs.xml")
+        hdf5_path = helpers.get_output_path("gmfs.hdf5")
+        coords = [(-116.0, 41.0), (-117.0, 40.0)]
+        fields = [[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]]
+
+        writer = hazard_output.GmfSetWriter(
+            None, ["xml"], nrml_path, coords, hdf5_path=hdf5_path,
+            queue_size=1)
+        for gmvs in fields:
+            writer.add(gmvs)
+        writer.close()
+
+        tree = etree.parse(nrml_path)
+        self.assertEqual(3, len(tree.findall(".//%sGMF" % xml.NRML)))
+        expected = [(shapes.Site(lon, lat), {'groundMotion': gmv})
+                    for gmvs in fields
+                    for (lon, lat), gmv in zip(coords, gmvs)]
+        self.assertEqual(expected, list(hazard_parser.GMFReader(nrml_path)))
+
+        with h5py.File(hdf5_path, "r") as hdf5_file:
+            self.assertEqual(fields, hdf5_file["gmvs"][:].tolist())
+            self.assertEqual([-116.0, -117.0], hdf5_file["lons"][:].tolist())
+            self.assertEqual([41.0, 40.0], hdf5_file["lats"][:].tolist())
+
+    def test_serialization_errors_are_raised(self):
+        path = os.path.join(helpers.get_output_path("missing-dir"),
+                            "gmfs.xml")
+
+        writer = hazard_output.GmfSetWriter(None, ["xml"], path, [(0, 0)],
+                                            queue_size=1)
+        for _ in range(3):
+            try:
+                writer.add([0.1])
+            except IOError:
+                break
+        self.assertRaises(IOError, writer.close)
+
+
 class HazardCurveXMLWriterTestCase(unittest.TestCase):
     """Unit tests for the HazardCurveXMLWriter class, which serializes
     hazard curves to NRML."""
@@ -326,6 +389,21 @@ class DisaggregationBinaryMatrixXMLWriterTestCase(unittest.TestCase):
 
         self.assertTrue(xml.validates_against_xml_schema(self.FILENAME))
 
+    def test_comment(self):
+        """The optional comment is written in the
+        disaggregationResultField."""
+        writer = hazard_disagg.DisaggregationBinaryMatrixXMLWriter(
+            self.FILENAME, self.POE, self.IMT, self.SUBSETS,
+            statistics=self.STATISTICS, comment="mean values")
+        writer.serialize([(shapes.Site(0.0, 0.0),
+                           {"groundMotionValue": 0.25, "path": "filea"})])
+
+        [comment] = self._xpath(
+            "/nrml:nrml/nrml:disaggregationResultField/comment()")
+        self.assertEquals(" mean values ", comment.text)
+
+        self.assertTrue(xml.validates_against_xml_schema(self.FILENAME))
+
     def test_write_single_result_node(self):
         result_data = dict(groundMotionValue=0.25, path="filea")
         expected_result_attrib = dict(groundMotionValue="0.25", path="filea")
@@ -22,6 +22,7 @@ Tests for the Python-Java code layer.
 """
 
 import cPickle
+import numpy
 import os
 import unittest
 
@@ -223,3 +224,49 @@ class JavaUtilsTestCase(unittest.TestCase):
         # Now check that the len and values are correct:
         self.assertEqual(len(test_input), len(jdouble_a))
         self.assertEqual(test_input, [x.doubleValue() for x in jdouble_a])
+
+    def test_array_to_jdouble_array(self):
+        """Test construction of a double[] (Java array) from a numpy array.
+        """
+        test_input = numpy.array([0.01, 0.02, 0.03, 0.04])
+
+        jdouble_a = java.array_to_jdouble_array(test_input)
+
+        # It should be a jpype primitive double[] type:
+        self.assertEqual('double[]', jdouble_a.__class__.__name__)
+        self.assertEqual(test_input.tolist(), list(jdouble_a))
+
+    def test_jdouble_array_round_trip(self):
+        test_input = numpy.linspace(0.0, 1.0, 101)
+
+        result = java.jdouble_array_to_array(
+            java.array_to_jdouble_array(test_input))
+
+        self.assertTrue(isinstance(result, numpy.ndarray))
+        self.assertTrue(numpy.array_equal(test_input, result))
+
+    def test_empty_jdouble_array_round_trip(self):
+        result = java.jdouble_array_to_array(
+            java.array_to_jdouble_array([]))
+
+        self.assertEqual((0,), result.shape)
+
+    def test_jdouble_matrix_round_trip(self):
+        test_input = numpy.arange(12, dtype=numpy.float64).reshape((3, 4))
+
+        jmatrix = java.array_to_jdouble_matrix(test_input)
+        self.assertEqual('double[][]', jmatrix.__class__.__name__)
+
+        result = java.jdouble_matrix_to_array(jmatrix)
+        self.assertEqual((3, 4), result.shape)
+        self.assertTrue(numpy.array_equal(test_input, result))
+
+    def test_warm_up(self):
+        timings = java.warm_up(calc=True)
+
+        self.assertEqual(set(["jvm_start", "class_preload", "warm_up_calc"]),
+                         set(timings))
+        self.assertTrue(java.jvm().isJVMStarted())
+
+    def test_preload_classes(self):
+        self.assertEqual([], java.preload_classes())
@@ -37,17 +37,19 @@ from tests.utils import helpers
 
 class JavaLogsTestCase(unittest.TestCase):
     def setUp(self):
-        self.jvm = java.jvm()
         self.handler = logging.handlers.BufferingHandler(capacity=float('inf'))
         self.python_logger = logging.getLogger('java')
         self.python_logger.addHandler(self.handler)
         self.python_logger.setLevel(logging.DEBUG)
+        # (re)starting the bridge pushes the python level down to log4j
+        self.jvm = java.jvm()
 
         jlogger_class = self.jvm.JClass("org.apache.log4j.Logger")
         self.root_logger = jlogger_class.getRootLogger()
         self.other_logger = jlogger_class.getLogger('other_logger')
 
     def tearDown(self):
+        java.flush_logs()
         self.python_logger.removeHandler(self.handler)
         self.python_logger.setLevel(logging.NOTSET)
 
@@ -72,6 +74,8 @@ class JavaLogsTestCase(unittest.TestCase):
 
     def test_debug(self):
         self.other_logger.debug('this is verbose debug info')
+        # debug/info events are buffered until a batch is forwarded
+        java.flush_logs()
         [record] = self.handler.buffer
         self.assertEqual(record.levelno, logging.DEBUG)
         self.assertEqual(record.levelname, 'DEBUG')
@@ -89,6 +93,7 @@ class JavaLogsTestCase(unittest.TestCase):
 
     def test_info(self):
         self.root_logger.info('information message')
+        java.flush_logs()
         [record] = self.handler.buffer
         self.assertEqual(record.levelno, logging.INFO)
         self.assertEqual(record.levelname, 'INFO')
@@ -97,6 +102,7 @@ class JavaLogsTestCase(unittest.TestCase):
 
     def test_record_serializability(self):
         self.root_logger.info('whatever')
+        java.flush_logs()
         [record] = self.handler.buffer
         # original args are tuple which becomes list
         # being encoded to json and back
@@ -104,6 +110,47 @@ class JavaLogsTestCase(unittest.TestCase):
         self.assertEqual(json.loads(json.dumps(record.__dict__)),
                          record.__dict__)
 
+    def test_info_batch(self):
+        for i in xrange(3):
+            self.root_logger.info('message %s' % i)
+        # a warning flushes the whole batch, in order
+        self.root_logger.warn('warning')
+
+        self.assertEqual(['message 0', 'message 1', 'message 2', 'warning'],
+                         [record.msg for record in self.handler.buffer])
+
+    def test_events_are_flushed_at_task_end(self):
+        @java.unpack_exception
+        def a_task():
+            self.root_logger.info('logged by a task')
+
+        a_task()
+
+        [record] = self.handler.buffer
+        self.assertEqual('logged by a task', record.msg)
+
+    def test_events_outside_tasks_are_flushed_on_a_timer(self):
+        # nothing else is logged, nor explicitly flushed
+        self.root_logger.info('logged outside of tasks')
+        time.sleep(2 * java.JAVA_LOG_MAX_DELAY / 1000.0)
+
+        [record] = self.handler.buffer
+        self.assertEqual('logged outside of tasks', record.msg)
+
+    def test_python_level_is_pushed_down_to_log4j(self):
+        self.python_logger.setLevel(logging.WARNING)
+        java.jvm()
+
+        self.assertEqual('WARN', str(self.root_logger.getLevel()))
+        self.assertFalse(self.root_logger.isInfoEnabled())
+        self.root_logger.info('filtered on the java side')
+        java.flush_logs()
+        self.assertEqual([], self.handler.buffer)
+
+        self.python_logger.setLevel(logging.DEBUG)
+        java.jvm()
+        self.assertEqual('DEBUG', str(self.root_logger.getLevel()))
+
     def test_custom_level(self):
         # checking that logging with custom levels issues a warning but works
 
@@ -17,12 +17,14 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import math
 import os
 import unittest
 
 from openquake.db import models
 from openquake.shapes import Site
 from openquake.utils import round_float
+from openquake.output.hazard import GmfBulkWriter
 from openquake.output.hazard import GmfDBReader
 from openquake.output.hazard import GmfDBWriter
 from openquake.output.hazard import HazardCurveDBReader
@@ -480,13 +482,24 @@ class GmfDBWriterTestCase(GmfDBBaseTestCase):
         inserted_data = []
 
         for gmfd in output.gmfdata_set.all():
-            location = gmfd.location
+            location = gmfd.site.location
             inserted_data.append((Site(location.x, location.y),
                                   {'groundMotion': gmfd.ground_motion}))
 
         self.assertEquals(self.normalize(GMF_DATA().items()),
                           self.normalize(inserted_data))
 
+    def test_serialize_shares_the_sites(self):
+        """The fields of a job reference the same gmf_site records."""
+        self.writer.serialize(GMF_DATA())
+        other_writer = GmfDBWriter("gmf-other.xml", self.job.id)
+        other_writer.serialize(GMF_DATA())
+
+        sites = models.GmfSite.objects.filter(oq_job=self.job)
+        self.assertEqual(4, len(sites))
+        for site in sites:
+            self.assertEqual(2, len(site.gmfdata_set.all()))
+
 
 class GmfDBReaderTestCase(GmfDBBaseTestCase):
     """
@@ -507,3 +520,31 @@ class GmfDBReaderTestCase(GmfDBBaseTestCase):
 
         self.assertEquals(self.normalize(GMF_DATA().items()),
                           self.normalize(data.items()))
+
+
+class GmfBulkWriterTestCase(GmfDBBaseTestCase):
+    """
+    Unit tests for the GmfBulkWriter class, which serializes the ground
+    motion fields of a whole stochastic event set to the database.
+    """
+    def test_serialize(self):
+        """serialize() inserts one output per field and the gmf_data
+        records, in chunks."""
+        sites = [Site(-117, 40), Site(-116, 40), Site(-116, 41)]
+        fields = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]
+        writer = GmfBulkWriter(self.job.id, ['db'], chunk_size=2)
+
+        files = writer.serialize(
+            sites, [(i, [math.log(gmv) for gmv in field])
+                    for i, field in enumerate(fields)])
+        self.assertEqual(['', ''], files)
+
+        outputs = self.job.output_set.order_by('id')
+        self.assertEqual(2, len(outputs))
+
+        for output, field in zip(outputs, fields):
+            self.assertEqual("gmf", output.output_type)
+            data = GmfDBReader.deserialize(output.id)
+            self.assertEqual(3, len(data))
+            for site, gmv in zip(sites, field):
+                self.assertAlmostEqual(gmv, data[site]['groundMotion'])
@@ -23,12 +23,15 @@ event based job.
 
 import os
 import math
+import mock
+import numpy
 import unittest
 
 from django.contrib.gis.geos import GEOSGeometry
 
 from tests.utils import helpers
 from tests.utils.helpers import patch
+from tests.utils.tasks import FakeResultSet
 
 from openquake import engine
 from openquake import java
@@ -36,6 +39,9 @@ from openquake import kvs
 from openquake import shapes
 from openquake.engine import JobContext
 from openquake.calculators.hazard.scenario import core as scenario
+from openquake.calculators.hazard.scenario import gmf as numpy_gmf
+from openquake.calculators.risk import general as risk_general
+from openquake.parser import hazard as hazard_parser
 
 SCENARIO_SMOKE_TEST = helpers.testdata_path("scenario/config.gem")
 NUMBER_OF_CALC_KEY = "NUMBER_OF_GROUND_MOTION_FIELDS_CALCULATIONS"
@@ -104,6 +110,7 @@ class ScenarioHazardCalculatorTestCase(unittest.TestCase):
         """
 
         self.job_ctxt.params[NUMBER_OF_CALC_KEY] = "3"
+        self.job_ctxt.params["GROUND_MOTION_CORRELATION"] = "false"
         self.job_profile.gmf_calculation_number = 3
         self.job_profile.save()
 
@@ -122,6 +129,7 @@ class ScenarioHazardCalculatorTestCase(unittest.TestCase):
         # A GMF is serialized for each calculation.
         self.job_ctxt.params[NUMBER_OF_CALC_KEY] = "3"
         self.job_ctxt.params["SAVE_GMFS"] = "true"
+        self.job_ctxt.params["GROUND_MOTION_CORRELATION"] = "false"
         self.job_profile.gmf_calculation_number = 3
         self.job_profile.save()
 
@@ -139,6 +147,178 @@ class ScenarioHazardCalculatorTestCase(unittest.TestCase):
 
         self.assertEquals(3, serialize_mock.call_count)
 
+    def test_compute_ground_motion_fields_uses_derived_seeds(self):
+        # Each field of a chunk is computed with its own, derived seed.
+        self.job_ctxt.params["GMF_RANDOM_SEED"] = "7"
+        self.job_ctxt.params["GROUND_MOTION_CORRELATION"] = "false"
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        seeds = []
+
+        def compute_gmf(_self, random_generator):
+            seeds.append(random_generator.nextLong())
+            return compute_ground_motion_field(_self, random_generator)
+
+        scenario.ScenarioHazardCalculator.compute_ground_motion_field = \
+            compute_gmf
+        coords, fields = calculator.compute_ground_motion_fields([3, 4])
+
+        expected = [java.jclass("Random")(
+                        scenario.derive_seed(7, cnum)).nextLong()
+                    for cnum in [3, 4]]
+        self.assertEqual(expected, seeds)
+
+        num_sites = len(self.job_ctxt.sites_to_compute())
+        self.assertEqual(num_sites, len(coords))
+        self.assertEqual(2, len(fields))
+        for gmvs in fields:
+            self.assertEqual([math.exp(0.5)] * num_sites, gmvs)
+
+    def test_compute_correlated_gmfs(self):
+        # A batch of correlated fields sharing a random number generator is
+        # the same as the fields computed one at a time.
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        imt = self.job_ctxt.params["INTENSITY_MEASURE_TYPE"]
+
+        coords, fields = calculator.compute_correlated_gmfs(
+            [java.jclass("Random")(5)] * 2)
+
+        self.assertEqual(len(self.job_ctxt.sites_to_compute()), len(coords))
+        self.assertEqual((len(coords), 2), fields.shape)
+        random_generator = java.jclass("Random")(5)
+        for values in fields.T:
+            gmf = calculator.compute_ground_motion_field(random_generator)
+            gmf_coords, expected = scenario.gmf_to_arrays(gmf, imt)
+            self.assertTrue(numpy.allclose(
+                scenario.align_gmvs(coords, gmf_coords, expected), values))
+
+    def test_compute_gmfs_with_the_numpy_engine(self):
+        # The numpy engine draws the fields from the GMPE statistics.
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+
+        with patch('openquake.utils.config.hazard_scenario_gmf_engine') as (
+                engine_mock):
+            engine_mock.return_value = "numpy"
+            self.assertTrue(calculator.batch_gmfs())
+            coords, fields = calculator.compute_gmfs(
+                [calculator.new_random_generator(5)] * 3)
+            _, expected = calculator.compute_gmfs(
+                [calculator.new_random_generator(5)] * 3)
+
+        self.assertEqual(len(self.job_ctxt.sites_to_compute()), len(coords))
+        self.assertEqual((len(coords), 3), fields.shape)
+        self.assertTrue((fields > 0).all())
+        self.assertTrue(numpy.array_equal(expected, fields))
+
+    def test_numpy_covariance_matches_java(self):
+        # The covariance matrix of the intra-event residuals of the numpy
+        # engine is the one of the Java calculator, with and without Vs30
+        # clustering.
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        gmf_calculator = calculator.gmf_calculator(
+            self.job_ctxt.sites_to_compute())
+        statistics = numpy.array(
+            [row[:] for row in gmf_calculator.getGroundMotionStatistics()])
+        lons, lats = zip(*calculator.site_coords())
+
+        try:
+            for vs30_cluster in (False, True):
+                gmf_calculator.setJB2009_Vs30ClusterParam(vs30_cluster)
+                expected = numpy.array([
+                    row[:] for row in
+                    gmf_calculator.getCovarianceMatrixAsArray_JB2009()])
+                covariance = numpy_gmf.jb2009_covariance(
+                    lons, lats, statistics[numpy_gmf.INTRA_STD], 0.0,
+                    vs30_cluster)
+                self.assertTrue(numpy.allclose(expected, covariance))
+        finally:
+            gmf_calculator.setJB2009_Vs30ClusterParam(False)
+
+    def test_gmv_array_store(self):
+        # The ground motion values are appended to per site arrays, in
+        # realization order, whatever the order of the sites.
+        coords = [(1.0, 2.0), (1.5, 2.5), (2.0, 3.0)]
+        store = scenario.GmvArrayStore(self.job_ctxt.job_id, chunk_size=2)
+        store.add(coords, [0.1, 0.2, 0.3])
+        store.add(coords[::-1], [1.3, 1.2, 1.1])
+        store.add(coords, [2.1, 2.2, 2.3])
+        store.flush()
+
+        expected = [[0.1, 1.1, 2.1], [0.2, 1.2, 2.2], [0.3, 1.3, 2.3]]
+        for (lon, lat), site_gmvs in zip(coords, expected):
+            gmvs = risk_general.load_gmv_array_at(
+                self.job_ctxt.job_id, shapes.Site(lon, lat))
+            self.assertEqual(site_gmvs, gmvs.tolist())
+
+    def test_gmv_array_store_out_of_order(self):
+        # Stores of disjoint ranges of realizations write at the position
+        # of their indices, whatever the order they are flushed in.
+        coords = [(1.0, 2.0), (1.5, 2.5)]
+        second = scenario.GmvArrayStore(self.job_ctxt.job_id, first=2)
+        second.add(coords, [2.1, 2.2])
+        second.flush()
+        first = scenario.GmvArrayStore(self.job_ctxt.job_id)
+        first.add(coords, [0.1, 0.2])
+        first.add(coords[::-1], [1.2, 1.1])
+        first.flush()
+
+        expected = [[0.1, 1.1, 2.1], [0.2, 1.2, 2.2]]
+        for (lon, lat), site_gmvs in zip(coords, expected):
+            gmvs = risk_general.load_gmv_array_at(
+                self.job_ctxt.job_id, shapes.Site(lon, lat))
+            self.assertEqual(site_gmvs, gmvs.tolist())
+
+        reader = scenario.GmvArrayStore(self.job_ctxt.job_id)
+        self.assertEqual([[1.2, 2.2], [1.1, 2.1]],
+                         reader.read(coords[::-1], 1, 2).tolist())
+
+    def test_store_ground_motion_fields(self):
+        # The workers store the values of their fields at the position of
+        # the field indices and return the number of fields.
+        self.job_ctxt.params["GROUND_MOTION_CORRELATION"] = "false"
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        scenario.ScenarioHazardCalculator.compute_ground_motion_field = \
+            compute_ground_motion_field
+
+        self.assertEqual(2, calculator.store_ground_motion_fields([1, 2]))
+
+        for site in self.job_ctxt.sites_to_compute():
+            gmvs = risk_general.load_gmv_array_at(self.job_ctxt.job_id, site)
+            self.assertEqual([0.0] + [math.exp(0.5)] * 2, gmvs.tolist())
+
+    def test_distribute_ground_motion_fields_to_a_single_file(self):
+        # The tasks complete in any order, but the fields are added to the
+        # single GMF set file in field order.
+        coords = [(site.longitude, site.latitude)
+                  for site in self.job_ctxt.sites_to_compute()]
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        added = []
+
+        def delay(job_id, realizations):
+            store = scenario.GmvArrayStore(job_id, first=realizations[0])
+            for cnum in realizations:
+                store.add(coords, [cnum + 0.5] * len(coords))
+            store.flush()
+            return mock.Mock(task_id=realizations[0], status='SUCCESS')
+
+        def add_to_gmf_set(_coords, values):
+            added.append(values.tolist())
+
+        calculator.single_gmf_file = lambda: True
+        calculator.site_coords = lambda: coords
+        calculator._add_to_gmf_set = add_to_gmf_set
+        with mock.patch('openquake.calculators.hazard.scenario.core'
+                        '.compute_ground_motion_fields.delay',
+                        mock.Mock(side_effect=delay)):
+            with mock.patch('openquake.utils.tasks.ResultSet',
+                            FakeResultSet):
+                with mock.patch('openquake.utils.config'
+                                '.hazard_scenario_gmf_tasks_in_flight',
+                                mock.Mock(return_value=2)):
+                    calculator.distribute_ground_motion_fields(5, 2)
+
+        self.assertEqual(
+            [[cnum + 0.5] * len(coords) for cnum in xrange(5)], added)
+
     def test__serialize_gmf_no_serialization_if_gmf_output_not_set(self):
         # The GMFs will only be serialized if SAVE_GMFS == True
         calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
@@ -179,6 +359,31 @@ class ScenarioHazardCalculatorTestCase(unittest.TestCase):
             self.assertTrue(
                 os.path.isfile(path), "GMF file not found (%s)" % path)
 
+    def test__serialize_gmfs_to_a_single_file(self):
+        # All the GMFs are serialized to a single file, when configured.
+        self.job_ctxt.params[NUMBER_OF_CALC_KEY] = "2"
+        self.job_ctxt.params["SAVE_GMFS"] = "true"
+        self.job_ctxt.params["GROUND_MOTION_CORRELATION"] = "false"
+        self.job_profile.gmf_calculation_number = 2
+        self.job_profile.save()
+
+        calculator = scenario.ScenarioHazardCalculator(self.job_ctxt)
+        scenario.ScenarioHazardCalculator.compute_ground_motion_field = \
+            compute_ground_motion_field
+
+        with patch('openquake.utils.config.flag_set') as flag_set_mock:
+            flag_set_mock.side_effect = lambda _section, setting: (
+                setting == "scenario_gmfs_single_file")
+            calculator.execute()
+
+        path = os.path.join(self.job_ctxt.base_path,
+                            self.job_ctxt['OUTPUT_DIR'], "gmfs.xml")
+        num_sites = len(self.job_ctxt.sites_to_compute())
+        gmfs = list(hazard_parser.GMFReader(path))
+        self.assertEqual(2 * num_sites, len(gmfs))
+        for _site, gmv in gmfs:
+            self.assertAlmostEqual(math.exp(0.5), gmv["groundMotion"])
+
     def test__prepare_gmf_serialization_with_mmi(self):
         # In case of imt == mmi the GMF values are left unchanged
         location1 = java.jclass("Location")(1.0, 2.0)
@@ -46,6 +46,7 @@ from openquake.calculators.hazard.general import store_source_model
 from openquake.db import models
 from openquake.engine import JobContext
 from openquake import engine
+from openquake import kvs
 from openquake import logs
 from openquake import producer
 from openquake.input.logictree import LogicTreeProcessor
@@ -215,13 +216,16 @@ def run_job(config_file, params=None, check_output=False):
         return subprocess.check_call(args)
 
 
-def store_hazard_logic_trees(a_job):
+def store_hazard_logic_trees(a_job, realization=None):
     """Helper function to store the source model and GMPE logic trees in the
     KVS so that it can be read by the Java code. This is basically what the
     @preload decorator does.
 
     :param a_job:
         :class:`openquake.engine.JobContext` instance.
+    :param realization:
+        if given, the models are stored under the KVS keys of this
+        realization instead of the ones of the job.
     """
     lt_proc = LogicTreeProcessor(
         a_job['BASE_PATH'],
@@ -236,9 +240,14 @@ def store_hazard_logic_trees(a_job):
     gmpe_rnd = random.Random()
     gmpe_rnd.seed(gmpe_seed)
 
+    src_key = gmpe_key = None
+    if realization is not None:
+        src_key = kvs.tokens.source_model_key(a_job.job_id, realization)
+        gmpe_key = kvs.tokens.gmpe_key(a_job.job_id, realization)
+
     store_source_model(a_job.job_id, src_model_rnd.getrandbits(32),
-                       a_job.params, lt_proc)
-    store_gmpe_map(a_job.job_id, gmpe_rnd.getrandbits(32), lt_proc)
+                       a_job.params, lt_proc, src_key)
+    store_gmpe_map(a_job.job_id, gmpe_rnd.getrandbits(32), lt_proc, gmpe_key)
 
 
 class WordProducer(producer.FileProducer):
@@ -22,6 +22,8 @@ Task functions for our unit tests.
 """
 
 
+import mock
+
 from celery.task import task
 
 from openquake import java
@@ -146,3 +148,34 @@ def ignore_result(data):
     helpers.TestStore.set(key, value)
     # Results will be ignored.
     return data
+
+
+class FakeResultSet(object):
+    """Stand-in for :class:`celery.result.ResultSet`, the last added task
+    being the first one to complete."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.max_size = len(self.results)
+        self.iterations = 0
+
+    def add(self, result):
+        self.results.append(result)
+        self.max_size = max(self.max_size, len(self.results))
+
+    def discard(self, result):
+        self.results.remove(result)
+
+    def iter_native(self):
+        self.iterations += 1
+        return iter([(r.task_id, {}) for r in reversed(self.results)])
+
+
+def fake_submit(name, submitted):
+    """Return a callable submitting a fake task named `name`."""
+
+    def submit():
+        submitted.append(name)
+        return mock.Mock(task_id=name, result=name)
+
+    return submit
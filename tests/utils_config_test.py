@@ -327,6 +327,66 @@ class HazardBlockSizeTestCase(unittest.TestCase):
             self.assertRaises(ValueError, config.hazard_block_size)
 
 
+class HazardZeroSettingsTestCase(unittest.TestCase):
+    """Tests the settings accepting 0, e.g.
+    utils.config.hazard_uhs_prefetch_blocks()."""
+
+    def test_zero(self):
+        """0 is a valid setting, unlike for hazard_ses_in_flight()."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = "0"
+            self.assertEqual(0, config.hazard_uhs_prefetch_blocks())
+            self.assertEqual(0, config.hazard_site_cache_size())
+            self.assertEqual(16, config.hazard_ses_in_flight())
+
+    def test_negative(self):
+        """Negative settings are ignored."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = "-1"
+            self.assertEqual(1, config.hazard_uhs_prefetch_blocks())
+            self.assertEqual(65536, config.hazard_site_cache_size())
+
+
+class HazardGmfSplitTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.config.hazard_gmf_split()."""
+
+    def test_not_configured(self):
+        """No split unless configured in openquake.cfg."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = None
+            self.assertEqual((0, 0), config.hazard_gmf_split())
+
+    def test_configured(self):
+        """The site block and rupture chunk sizes *were* configured."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.side_effect = lambda _s, setting: dict(
+                gmf_site_block_size="100",
+                gmf_rupture_chunk_size="-1")[setting]
+            self.assertEqual((100, 0), config.hazard_gmf_split())
+
+
+class HazardScenarioGmfEngineTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.config.hazard_scenario_gmf_engine()."""
+
+    def test_not_configured(self):
+        """The Java engine is used unless configured in openquake.cfg."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = None
+            self.assertEqual("java", config.hazard_scenario_gmf_engine())
+
+    def test_configured(self):
+        """The engine *was* configured."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = " NumPy "
+            self.assertEqual("numpy", config.hazard_scenario_gmf_engine())
+
+    def test_configuration_invalid(self):
+        """Unknown engines are ignored."""
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = "fortran"
+            self.assertEqual("java", config.hazard_scenario_gmf_engine())
+
+
 class FlagSetTestCase(ConfigTestCase, unittest.TestCase):
     """
     Tests for openquake.utils.config.flag_set()
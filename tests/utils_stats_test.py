@@ -227,6 +227,26 @@ class DeleteJobCountersTestCase(helpers.RedisTestCase, unittest.TestCase):
         stats.delete_job_counters(sys.maxint)
 
 
+class WorkerStatsTestCase(helpers.RedisTestCase, unittest.TestCase):
+    """Tests the behaviour of utils.stats.(set|get)_worker_stats()."""
+
+    def test_set_and_get_worker_stats(self):
+        stats.set_worker_stats("host-a:123", dict(jvm_start=1.5))
+        stats.set_worker_stats(
+            "host-b:456", dict(jvm_start=2.0, class_preload=0.25))
+
+        worker_stats = stats.get_worker_stats()
+
+        self.assertEqual(dict(jvm_start=1.5), worker_stats["host-a:123"])
+        self.assertEqual(dict(jvm_start=2.0, class_preload=0.25),
+                         worker_stats["host-b:456"])
+
+    def test_worker_stats_are_not_job_counters(self):
+        stats.set_worker_stats("host-c:789", dict(jvm_start=1.0))
+        stats.delete_job_counters(789)
+        self.assertTrue("host-c:789" in stats.get_worker_stats())
+
+
 class PkSetTestCase(helpers.RedisTestCase, unittest.TestCase):
     """Tests the behaviour of utils.stats.pk_set()."""
 
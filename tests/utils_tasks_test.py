@@ -22,6 +22,7 @@ Unit tests for the utils.tasks module.
 """
 
 import mock
+import os
 import unittest
 import time
 import uuid
@@ -36,6 +37,7 @@ from tests.utils.helpers import TestStore
 from tests.utils.tasks import (
     failing_task, ignore_result, just_say_1, just_say_hello, reflect_args,
     reflect_data_to_be_processed, single_arg_called_a)
+from tests.utils.tasks import FakeResultSet, fake_submit
 
 
 # The keyword args below are injected by the celery framework.
@@ -314,3 +316,88 @@ class CalculatorForTaskTestCase(unittest.TestCase):
 
             self.assertTrue(isinstance(calculator, ClassicalHazardCalculator))
             self.assertEqual(1, grc_mock.call_count)
+
+
+class PrewarmJvmTestCase(unittest.TestCase):
+    """Tests for :function:`openquake.utils.tasks.prewarm_jvm`."""
+
+    def test_prewarm_jvm_disabled(self):
+        with patch('openquake.utils.config.flag_set') as flag_mock:
+            flag_mock.return_value = False
+            with patch('openquake.java.warm_up') as warm_up_mock:
+                tasks.prewarm_jvm()
+                self.assertEqual(0, warm_up_mock.call_count)
+
+    def test_prewarm_jvm_records_timings(self):
+        timings = dict(jvm_start=1.0, class_preload=0.5)
+        with patch('openquake.utils.config.flag_set') as flag_mock:
+            flag_mock.return_value = True
+            with patch('openquake.java.warm_up') as warm_up_mock:
+                warm_up_mock.return_value = timings
+                with patch('openquake.utils.stats.set_worker_stats') as ws:
+                    tasks.prewarm_jvm()
+
+                    self.assertEqual(1, warm_up_mock.call_count)
+                    self.assertEqual(1, ws.call_count)
+                    [worker_id, data] = ws.call_args[0]
+                    self.assertEqual(timings, data)
+                    self.assertTrue(worker_id.endswith(":%s" % os.getpid()))
+
+    def test_prewarm_jvm_failure_is_logged(self):
+        with patch('openquake.utils.config.flag_set') as flag_mock:
+            flag_mock.return_value = True
+            with mock.patch('openquake.java.warm_up',
+                            mock.Mock(side_effect=RuntimeError("no JVM"))):
+                with mock.patch('openquake.logs.LOG.exception') as log_mock:
+                    with patch('openquake.utils.stats.set_worker_stats') as ws:
+                        # does not raise
+                        tasks.prewarm_jvm()
+
+                        self.assertEqual(1, log_mock.call_count)
+                        self.assertEqual(0, ws.call_count)
+
+
+class TaskPipelineTestCase(unittest.TestCase):
+    """Tests for :class:`openquake.utils.tasks.TaskPipeline`."""
+
+    def setUp(self):
+        self.submitted = []
+        patcher = mock.patch(
+            'openquake.utils.tasks.ResultSet', FakeResultSet)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pipeline = tasks.TaskPipeline(2)
+
+    def submissions(self, names):
+        for name in names:
+            yield fake_submit(name, self.submitted), name
+
+    def test_run(self):
+        """The tasks are yielded as they complete, with at most
+        `max_in_flight` of them running at any time."""
+        completed = []
+        for a_task, name in self.pipeline.run(self.submissions('abcde')):
+            self.assertEqual(name, a_task.result)
+            completed.append(name)
+
+        self.assertEqual(['b', 'c', 'd', 'e', 'a'], completed)
+        self.assertEqual(list('abcde'), self.submitted)
+        self.assertEqual(2, self.pipeline._in_flight.max_size)
+        # the last task is collected without querying the results again
+        self.assertEqual(4, self.pipeline._in_flight.iterations)
+
+    def test_follow_ups(self):
+        """The follow-up tasks share the budget, are submitted first and are
+        all collected."""
+        completed = []
+        for _, name in self.pipeline.run(self.submissions('abc')):
+            completed.append(name)
+            self.pipeline.follow_up(
+                fake_submit('x' + name, self.submitted), 'x' + name)
+            completed.extend(name for _, name in self.pipeline.follow_ups())
+        completed.extend(
+            name for _, name in self.pipeline.follow_ups(wait=True))
+
+        self.assertEqual(['b', 'c', 'a', 'xb', 'xc', 'xa'], completed)
+        self.assertEqual(['a', 'b', 'c', 'xb', 'xc', 'xa'], self.submitted)
+        self.assertEqual(2, self.pipeline._in_flight.max_size)